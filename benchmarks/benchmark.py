@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+
+from argparse import SUPPRESS, ArgumentParser
+from collections import Counter
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# This script is run directly rather than as part of a package. Add the repo root directory to the import search path
+# for the wrapper itself, and the tests directory for the fake Balena backends that serve the synthetic fleet.
+REPO_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for path in (REPO_DIR, os.path.join(REPO_DIR, 'tests')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from fake_api import FakeApiServer
+from fake_sdk import FakeBalena, FakeFleet, generate_devices
+from point_one.balena import cache
+from point_one.balena.auth import authenticate, get_api_endpoint, get_balena_host
+from point_one.balena.device import get_device_uuid
+from point_one.balena.fleet import list_devices
+from point_one.balena.index import AMBIGUOUS, FOUND, NOT_FOUND, DeviceIndex
+from point_one.balena.sync import DeviceSync
+
+# Benchmarks for device lookups, authentication, and CLI wrapper startup, run against a synthetic fleet so they do not
+# require a Balena account or network access. Results are written as JSON so they can be compared between commits:
+#
+#   python3 benchmarks/benchmark.py --output before.json
+#   (make changes)
+#   python3 benchmarks/benchmark.py --output after.json --compare before.json
+
+__logger = logging.getLogger("point_one.balena.benchmark")
+
+# Increment this if the structure of the results file changes.
+RESULTS_VERSION = 1
+
+DEFAULT_FLEET_SIZES = (100, 1000, 10000)
+DEFAULT_REPEAT = 5
+
+# The token used for all benchmark queries. The fake backends accept any token.
+BENCHMARK_TOKEN = 'benchmark-token'
+
+LOOKUP_TYPES = ('exact_uuid', 'exact_name', 'partial_name', 'partial_uuid', 'substring_name', 'ambiguous')
+
+# - live: No device cache. Every lookup queries the (fake) API.
+# - live_parallel: Same as live, but the API queries are run at the same time (get_device_uuid(parallel=True)).
+# - cold_cache: The device cache is enabled but empty, so each lookup lists the fleet and writes the cache.
+# - warm_cache: The device cache is populated, so lookups are answered without any API requests.
+CACHE_MODES = ('live', 'live_parallel', 'cold_cache', 'warm_cache')
+
+
+def _get_stats(durations_sec):
+    durations_ms = [d * 1e3 for d in durations_sec]
+    return {
+        'min_ms': min(durations_ms),
+        'median_ms': statistics.median(durations_ms),
+        'mean_ms': statistics.mean(durations_ms),
+        'max_ms': max(durations_ms),
+    }
+
+
+def _get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def pick_queries(devices):
+    # Pick a query string for each lookup type that is known to produce the expected result for this fleet, so results
+    # are comparable between fleet sizes: every query except `ambiguous` matches exactly one device.
+    index = DeviceIndex(devices)
+    name_counts = Counter(d['device_name'] for d in devices)
+
+    queries = {}
+    # Start from the middle of the fleet so the target is not trivially the first device listed.
+    for device in devices[len(devices) // 2:] + devices[:len(devices) // 2]:
+        name = device['device_name']
+        if name_counts[name] != 1:
+            continue
+
+        # Note: Device names are of the form rover-<site>-<vehicle>-<role>.
+        partial_name = name[:-2]
+        substring_name = name.split('-', 1)[1]
+        partial_uuid = device['uuid'][:8]
+        if (len(index.find_by_name_prefix(partial_name)) == 1 and
+                len(index.find_by_name_prefix(substring_name)) == 0 and len(index.search(substring_name)) == 1 and
+                len(index.find_by_uuid_prefix(partial_uuid)) == 1):
+            queries['exact_uuid'] = device['uuid']
+            queries['exact_name'] = name
+            queries['partial_name'] = partial_name
+            queries['partial_uuid'] = partial_uuid
+            queries['substring_name'] = substring_name
+            break
+
+    # Use an exactly duplicated device name if there is one (as happens in real fleets), otherwise a common prefix.
+    duplicates = sorted(name for name, count in name_counts.items() if count > 1)
+    queries['ambiguous'] = duplicates[0] if len(duplicates) > 0 else 'rover-'
+
+    return queries
+
+
+def _run_lookup(balena, query, use_cache, parallel=False):
+    from balena.exceptions import DeviceNotFound
+
+    try:
+        get_device_uuid(query, balena=balena, auth_token=BENCHMARK_TOKEN, use_cache=use_cache, use_daemon=False,
+                        parallel=parallel)
+        return FOUND
+    except DeviceNotFound:
+        return NOT_FOUND
+    except ValueError:
+        return AMBIGUOUS
+
+
+def benchmark_lookups(devices, backend='sdk', latency_sec=0.0, repeat=DEFAULT_REPEAT):
+    queries = pick_queries(devices)
+
+    server = None
+    if backend == 'api':
+        server = FakeApiServer(devices=devices, latency_sec=latency_sec).start()
+        balena = server.connect(BENCHMARK_TOKEN)
+    else:
+        balena = FakeBalena(devices=devices, latency_sec=latency_sec)
+
+    def _get_counters():
+        if server is not None:
+            return server.request_count, server.bytes_sent
+        else:
+            return balena.models.device.request_count, None
+
+    results = []
+    try:
+        for mode in CACHE_MODES:
+            for lookup_type in LOOKUP_TYPES:
+                query = queries.get(lookup_type, None)
+                if query is None:
+                    __logger.warning("No suitable %s query for %d devices. Skipping." % (lookup_type, len(devices)))
+                    continue
+
+                if mode == 'warm_cache':
+                    cache.save_devices(get_api_endpoint(), BENCHMARK_TOKEN, devices)
+
+                durations = []
+                statuses = set()
+                start_requests, start_bytes = _get_counters()
+                for _ in range(repeat):
+                    if mode == 'cold_cache':
+                        cache.clear_devices()
+
+                    start = time.perf_counter()
+                    statuses.add(_run_lookup(balena, query, use_cache=mode not in ('live', 'live_parallel'),
+                                             parallel=mode == 'live_parallel'))
+                    durations.append(time.perf_counter() - start)
+                end_requests, end_bytes = _get_counters()
+
+                result = {
+                    'benchmark': 'lookup',
+                    'name': lookup_type,
+                    'mode': mode,
+                    'fleet_size': len(devices),
+                    'query': query,
+                    'status': statuses.pop() if len(statuses) == 1 else 'inconsistent',
+                    'requests': (end_requests - start_requests) / float(repeat),
+                    'bytes': (end_bytes - start_bytes) / float(repeat) if end_bytes is not None else None,
+                }
+                result.update(_get_stats(durations))
+                results.append(result)
+                _print_result(result)
+    finally:
+        cache.clear_devices()
+        if server is not None:
+            server.stop()
+
+    return results
+
+
+def benchmark_authenticate(repeat=DEFAULT_REPEAT):
+    # Note: Specifying the host explicitly makes the SDK keep its settings in memory (see authenticate()). Otherwise,
+    # logging in would replace the token in the user's ~/.balena/balena.cfg with the benchmark token.
+    balena_host = get_balena_host()
+
+    results = []
+    for name, reuse_session in (('new_session', False), ('reused_session', True)):
+        # Make sure there is an existing session to reuse.
+        authenticate(BENCHMARK_TOKEN, balena_host=balena_host)
+
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            authenticate(BENCHMARK_TOKEN, reuse_session=reuse_session, balena_host=balena_host)
+            durations.append(time.perf_counter() - start)
+
+        result = {'benchmark': 'authenticate', 'name': name, 'mode': None, 'fleet_size': None, 'status': 'ok'}
+        result.update(_get_stats(durations))
+        results.append(result)
+        _print_result(result)
+    return results
+
+
+def benchmark_startup(devices, work_dir, repeat=DEFAULT_REPEAT):
+    # Time complete wrapper invocations, from process start to exit, with a stub `balena` executable standing in for the
+    # real Balena CLI. The stub exits immediately, so the measurement is entirely wrapper overhead.
+    stub_dir = os.path.join(work_dir, 'bin')
+    stub_path = os.path.join(stub_dir, 'balena')
+    if not os.path.exists(stub_path):
+        os.makedirs(stub_dir, exist_ok=True)
+        with open(stub_path, 'w') as f:
+            f.write('#!/bin/sh\nexit 0\n')
+        os.chmod(stub_path, 0o755)
+
+    env = dict(os.environ)
+    env['PATH'] = stub_dir + os.pathsep + env.get('PATH', '')
+    env['BALENA_AUTH_TOKEN'] = BENCHMARK_TOKEN
+
+    # Device commands are resolved from a populated cache, so no API requests are needed.
+    cache.save_devices(get_api_endpoint(), BENCHMARK_TOKEN, devices)
+    queries = pick_queries(devices)
+
+    cli_path = os.path.join(REPO_DIR, 'point_one', 'balena', 'cli.py')
+    commands = [
+        # Baselines: the cost of the stub itself and of starting the Python interpreter.
+        ('stub', [stub_path, 'fleets']),
+        ('python', [sys.executable, '-c', 'pass']),
+        ('passthrough', [sys.executable, cli_path, 'fleets']),
+        ('device_uuid', [sys.executable, cli_path, 'ssh', queries['exact_uuid']]),
+        ('device_name', [sys.executable, cli_path, 'ssh', queries['exact_name']]),
+        ('device_partial_name', [sys.executable, cli_path, 'ssh', queries['partial_name']]),
+        ('uuid_command', [sys.executable, cli_path, 'uuid', queries['exact_name']]),
+    ]
+
+    results = []
+    try:
+        for name, command in commands:
+            durations = []
+            exit_codes = set()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                exit_codes.add(subprocess.call(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                durations.append(time.perf_counter() - start)
+
+            result = {
+                'benchmark': 'startup',
+                'name': name,
+                'mode': 'warm_cache',
+                'fleet_size': len(devices),
+                'status': 'ok' if exit_codes == {0} else 'exit %s' % ','.join(str(c) for c in sorted(exit_codes)),
+            }
+            result.update(_get_stats(durations))
+            results.append(result)
+            _print_result(result)
+    finally:
+        cache.clear_devices()
+
+    return results
+
+
+def _run_concurrent_worker(num_devices, query, latency_sec=0.0):
+    # Run a single lookup in this process with an empty cache, as one of the processes started by
+    # benchmark_concurrent(), and print the number of (fake) API requests it made.
+    balena = FakeBalena(devices=generate_devices(num_devices), latency_sec=latency_sec)
+    status = _run_lookup(balena, query, use_cache=True)
+    print(json.dumps({'status': status, 'requests': balena.models.device.request_count}))
+
+
+def benchmark_concurrent(devices, num_processes, latency_sec=0.0, repeat=DEFAULT_REPEAT):
+    # Start many wrapper processes at once, all missing the cache, as happens when a set of parallel CI jobs start. Only
+    # one of them should list the fleet: the rest should wait for its result.
+    query = pick_queries(devices)['partial_name']
+    command = [sys.executable, os.path.abspath(__file__), '--concurrent-worker', str(len(devices)), query,
+               '--latency', str(latency_sec)]
+
+    durations = []
+    statuses = set()
+    total_requests = 0
+    for _ in range(repeat):
+        cache.clear_devices()
+        start = time.perf_counter()
+        processes = [subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                     for _ in range(num_processes)]
+        for process in processes:
+            output, _ = process.communicate()
+            try:
+                worker_result = json.loads(output)
+                statuses.add(worker_result['status'])
+                total_requests += worker_result['requests']
+            except ValueError:
+                statuses.add('exit %d' % process.returncode)
+        durations.append(time.perf_counter() - start)
+    cache.clear_devices()
+
+    result = {
+        'benchmark': 'concurrent',
+        'name': '%d_processes' % num_processes,
+        'mode': 'cold_cache',
+        'fleet_size': len(devices),
+        'query': query,
+        'status': statuses.pop() if len(statuses) == 1 else 'inconsistent',
+        'requests': total_requests / float(repeat),
+    }
+    result.update(_get_stats(durations))
+    _print_result(result)
+    return [result]
+
+
+def benchmark_memory(devices, repeat=DEFAULT_REPEAT):
+    # Measure the memory held by a device index built from the device cache, as used by the resolver daemon and by
+    # library callers that keep an index around. This includes the trigram index used for substring searches. The time
+    # reported is the time to load the cache and build both indexes.
+    query = pick_queries(devices)['substring_name']
+    cache.save_devices(get_api_endpoint(), BENCHMARK_TOKEN, devices)
+    try:
+        durations = []
+        memory_bytes = []
+        for _ in range(repeat):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                device_index = DeviceIndex(cache.load_devices(get_api_endpoint(), BENCHMARK_TOKEN))
+                device_index.search(query)
+                durations.append(time.perf_counter() - start)
+                gc.collect()
+                memory_bytes.append(tracemalloc.get_traced_memory()[0])
+            finally:
+                tracemalloc.stop()
+            del device_index
+    finally:
+        cache.clear_devices()
+
+    result = {
+        'benchmark': 'memory',
+        'name': 'device_index',
+        'mode': 'warm_cache',
+        'fleet_size': len(devices),
+        'query': query,
+        'status': FOUND,
+        'memory_bytes': min(memory_bytes),
+        'bytes_per_device': min(memory_bytes) / float(max(len(devices), 1)),
+    }
+    result.update(_get_stats(durations))
+    _print_result(result)
+    return [result]
+
+
+def benchmark_sync(devices, latency_sec=0.0, repeat=DEFAULT_REPEAT):
+    # Measure the cost of keeping a local copy of the fleet up to date (see sync.py), using the real SDK against a fleet
+    # that changes between syncs. For comparison, `list_devices` is a plain listing of the entire fleet. Each sync is
+    # checked against the current fleet: the status is `in_sync` if the local copy matches it exactly.
+    fleet = FakeFleet(devices=[dict(d) for d in devices])
+    server = FakeApiServer(devices=fleet.devices, latency_sec=latency_sec).start()
+    balena = server.connect(BENCHMARK_TOKEN)
+    device_sync = DeviceSync(api_endpoint=server.url)
+
+    def _rename_and_add():
+        fleet.rename(10)
+        fleet.add(5)
+
+    steps = (
+        ('list_devices', None, None),
+        ('full_sync', None, {'full': True}),
+        ('no_changes', None, {'check_deletions': False}),
+        ('rename_and_add', _rename_and_add, {'check_deletions': False}),
+        ('delete_and_check', lambda: fleet.remove(5), {'check_deletions': True}),
+    )
+
+    results = []
+    try:
+        for name, modify_fleet, sync_options in steps:
+            durations = []
+            statuses = set()
+            total_requests = 0
+            total_bytes = 0
+            for _ in range(repeat):
+                if modify_fleet is not None:
+                    modify_fleet()
+
+                server.reset_counters()
+                start = time.perf_counter()
+                if sync_options is None:
+                    listed_devices = list_devices(balena)
+                else:
+                    listed_devices = device_sync.sync(balena, **sync_options).devices
+                durations.append(time.perf_counter() - start)
+                total_requests += server.request_count
+                total_bytes += server.bytes_sent
+
+                expected_devices = sorted((d['uuid'], d['device_name']) for d in fleet.devices)
+                statuses.add('in_sync' if sorted(listed_devices) == expected_devices else 'stale')
+
+            result = {
+                'benchmark': 'sync',
+                'name': name,
+                'mode': 'live',
+                'fleet_size': len(devices),
+                'query': None,
+                'status': statuses.pop() if len(statuses) == 1 else 'inconsistent',
+                'requests': total_requests / float(repeat),
+                'bytes': total_bytes / float(repeat),
+            }
+            result.update(_get_stats(durations))
+            results.append(result)
+            _print_result(result)
+    finally:
+        server.stop()
+
+    return results
+
+
+def _get_result_key(result):
+    return result['benchmark'], result['name'], result['mode'], result['fleet_size']
+
+
+def _print_result(result):
+    __logger.info("%-12s %-20s %-13s %7s  %-9s  median %9.3f ms  min %9.3f ms%s%s%s" %
+                  (result['benchmark'], result['name'], result['mode'] or '-',
+                   result['fleet_size'] if result['fleet_size'] is not None else '-', result['status'],
+                   result['median_ms'], result['min_ms'],
+                   '  %.1f requests' % result['requests'] if result.get('requests') is not None else '',
+                   '  %.1f KB' % (result['bytes'] / 1024.0) if result.get('bytes') is not None else '',
+                   '  %.1f bytes/device' % result['bytes_per_device'] if 'bytes_per_device' in result else ''))
+
+
+def print_comparison(baseline, results):
+    baseline_results = {_get_result_key(r): r for r in baseline['results']}
+
+    print("Comparison against %s:" % (baseline.get('git_commit', None) or 'baseline'))
+    for result in results['results']:
+        previous = baseline_results.get(_get_result_key(result), None)
+        if previous is None:
+            continue
+
+        ratio = result['median_ms'] / previous['median_ms'] if previous['median_ms'] > 0 else float('inf')
+        print("  %-12s %-20s %-13s %7s  %9.3f ms -> %9.3f ms  (%.2fx)" %
+              (result['benchmark'], result['name'], result['mode'] or '-',
+               result['fleet_size'] if result['fleet_size'] is not None else '-',
+               previous['median_ms'], result['median_ms'], ratio))
+        if 'memory_bytes' in result and 'memory_bytes' in previous:
+            print("  %-12s %-20s %-13s %7s  %9.1f KB -> %9.1f KB  (%.2fx)" %
+                  ('', '', '', '', previous['memory_bytes'] / 1024.0, result['memory_bytes'] / 1024.0,
+                   result['memory_bytes'] / float(previous['memory_bytes'])))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""\
+Benchmark device lookups, authentication, and Balena CLI wrapper startup against
+a synthetic fleet served by a fake Balena backend. No Balena account or network
+access is required.""")
+    parser.add_argument('--devices', type=str, default=','.join(str(n) for n in DEFAULT_FLEET_SIZES),
+                        help="A comma-separated list of fleet sizes to benchmark (e.g., 100,1000,10000,100000).")
+    parser.add_argument('--backend', choices=('sdk', 'api'), default='sdk',
+                        help="The fake backend to use. 'sdk' replaces the Balena SDK with an in-memory stand-in. 'api' "
+                             "uses the real SDK with a local HTTP server emulating the Balena API, which includes "
+                             "request and JSON decoding overhead, and reports bytes transferred.")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Artificial delay (in seconds) to add to each API request.")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="The number of times to run each benchmark.")
+    parser.add_argument('--skip-startup', action='store_true',
+                        help="Do not run the wrapper startup benchmarks.")
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help="If > 0, also start this many lookup processes at the same time with an empty cache, and "
+                             "report the total number of API requests they make.")
+    parser.add_argument('--concurrent-worker', nargs=2, metavar=('NUM_DEVICES', 'QUERY'), default=None,
+                        help=SUPPRESS)
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="The path to a JSON file to write the results to. If not specified, results are written "
+                             "to stdout.")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="The path to a previous results file to compare against.")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Print verbose/trace debugging messages.")
+
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO, stream=sys.stderr)
+    if options.verbose > 0:
+        logging.getLogger("point_one.balena").setLevel(logging.DEBUG)
+    else:
+        # Ambiguous lookups are expected, so hide the resulting warnings.
+        for name in ("point_one.balena.device", "point_one.balena.auth", "point_one.balena.cache"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    if options.concurrent_worker is not None:
+        _run_concurrent_worker(int(options.concurrent_worker[0]), options.concurrent_worker[1],
+                               latency_sec=options.latency)
+        sys.exit(0)
+
+    fleet_sizes = [int(n) for n in options.devices.split(',')]
+
+    # Use a temporary cache directory so the benchmarks do not touch (or get sped up by) the user's device cache, and
+    # make sure the resolver daemon and the user's accounts file are never used. Wrapper processes started by the
+    # benchmarks also get a temporary home directory, so the SDK cannot modify the user's ~/.balena settings.
+    with tempfile.TemporaryDirectory(prefix='balena-benchmark-') as work_dir:
+        os.environ['HOME'] = work_dir
+        os.environ['BALENA_WRAPPER_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+        os.environ['BALENA_WRAPPER_SOCKET'] = os.path.join(work_dir, 'resolver.sock')
+        os.environ['BALENA_WRAPPER_ACCOUNTS'] = ''
+        os.environ.pop('BALENA_WRAPPER_CACHE_TTL', None)
+
+        results = []
+        results.extend(benchmark_authenticate(repeat=options.repeat))
+        for num_devices in fleet_sizes:
+            devices = generate_devices(num_devices)
+            results.extend(benchmark_lookups(devices, backend=options.backend, latency_sec=options.latency,
+                                             repeat=options.repeat))
+            if not options.skip_startup:
+                results.extend(benchmark_startup(devices, work_dir=work_dir, repeat=options.repeat))
+            results.extend(benchmark_memory(devices, repeat=options.repeat))
+            results.extend(benchmark_sync(devices, latency_sec=options.latency, repeat=options.repeat))
+            if options.concurrency > 0:
+                results.extend(benchmark_concurrent(devices, options.concurrency, latency_sec=options.latency,
+                                                    repeat=options.repeat))
+
+    output = {
+        'version': RESULTS_VERSION,
+        'timestamp': time.time(),
+        'git_commit': _get_git_commit(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {
+            'fleet_sizes': fleet_sizes,
+            'backend': options.backend,
+            'latency_sec': options.latency,
+            'repeat': options.repeat,
+            'concurrency': options.concurrency,
+        },
+        'results': results,
+    }
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        __logger.info("Results written to '%s'." % options.output)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if options.compare is not None:
+        with open(options.compare, 'r') as f:
+            print_comparison(json.load(f), output)
@@ -19,4 +19,6 @@ get_parent_dir() {
 SCRIPT_DIR=$(get_parent_dir)
 REPO_DIR="${SCRIPT_DIR}/.."
 
-python3 "${REPO_DIR}/point_one/balena/cli.py" $*
+# Replace this shell with the wrapper rather than running it as a child process, and pass all arguments through with
+# their original quoting.
+exec python3 "${REPO_DIR}/point_one/balena/cli.py" "$@"
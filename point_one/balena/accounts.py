@@ -0,0 +1,505 @@
+from collections import namedtuple
+import json
+import logging
+import os
+
+from . import cache, profiling, sync
+from .auth import authenticate, get_api_endpoint, get_auth_token, get_balena_host
+from .fleet import list_devices
+from .index import AMBIGUOUS, FOUND, NOT_FOUND, Device, DeviceIndex, DeviceQueryResult
+
+__logger = logging.getLogger("point_one.balena.accounts")
+
+# Multiple Balena accounts.
+#
+# Normally, the wrapper uses a single account: the token from BALENA_AUTH_TOKEN or ~/.balena, on the server selected by
+# BALENARC_BALENA_URL. If devices are spread across several accounts (e.g., production and staging orgs, or a
+# self-hosted openBalena server), list them in an accounts file (see get_accounts_path()):
+#
+#   {
+#     "accounts": [
+#       {"name": "production"},
+#       {"name": "staging", "token_file": "~/.balena-staging/token"},
+#       {"name": "lab", "url": "openbalena.example.com", "token_env": "LAB_BALENA_TOKEN"}
+#     ]
+#   }
+#
+# Each account has a name, an optional server (`url`, same as BALENARC_BALENA_URL; default: balena-cloud.com), and a
+# token (`token`, `token_file`, or `token_env`). An account without a token uses the default token.
+#
+# Device queries are then resolved against all accounts at once, each with its own device cache. A query matching
+# devices in more than one account is ambiguous, like any other query matching more than one device. The account that
+# owns each device found is remembered, so later queries for it try that account first, and the Balena CLI is run with
+# that account's credentials.
+
+# The maximum number of remembered query/device -> account entries. The oldest entries are dropped first.
+MAX_OWNER_ENTRIES = 10000
+
+# The maximum number of suggestions returned for a query that was not found in any account.
+MAX_SUGGESTIONS = 5
+
+OWNERS_FORMAT_VERSION = 1
+
+
+class Account(namedtuple('Account', ['name', 'balena_host', 'auth_token', 'cli_data_dir'])):
+    # `cli_data_dir` is the Balena CLI data directory containing the account's token file, or None to use the CLI's
+    # default (~/.balena).
+    __slots__ = ()
+
+    @property
+    def api_endpoint(self):
+        return get_api_endpoint(self.balena_host)
+
+
+# A Device record found in a specific account.
+class AccountDevice(Device):
+    __slots__ = ('_account',)
+
+    def __init__(self, uuid, name, account):
+        super().__init__(uuid, name)
+        self._account = account
+
+    @property
+    def account(self):
+        return self._account
+
+    def __getitem__(self, key):
+        if key == 'account':
+            return self._account
+        else:
+            return super().__getitem__(key)
+
+    def __repr__(self):
+        return 'AccountDevice(uuid=%r, name=%r, account=%r)' % (self.uuid, self._name, self._account)
+
+    def to_json(self):
+        result = super().to_json()
+        result['account'] = self._account
+        return result
+
+
+def get_accounts_path():
+    # The accounts file is $BALENA_WRAPPER_ACCOUNTS if set, or ~/.config/point_one/balena/accounts.json. Set
+    # BALENA_WRAPPER_ACCOUNTS to an empty string to ignore the accounts file. Returns None if disabled.
+    path = os.environ.get("BALENA_WRAPPER_ACCOUNTS", None)
+    if path is None:
+        xdg_config_dir = os.environ.get("XDG_CONFIG_HOME", None)
+        if not xdg_config_dir:
+            xdg_config_dir = os.path.expanduser("~/.config")
+        path = os.path.join(xdg_config_dir, "point_one", "balena", "accounts.json")
+    elif path == "":
+        return None
+    return os.path.expanduser(path)
+
+
+def is_configured():
+    path = get_accounts_path()
+    return path is not None and os.path.exists(path)
+
+
+def _get_cli_data_root():
+    return os.path.join(cache.get_cache_dir(), "accounts")
+
+
+def _parse_account(entry):
+    name = entry['name']
+    balena_host = entry.get('url', None) or get_balena_host()
+    cli_data_dir = None
+    if entry.get('token', None):
+        auth_token = entry['token']
+    elif entry.get('token_file', None):
+        token_file = os.path.expanduser(entry['token_file'])
+        with open(token_file, 'r') as f:
+            auth_token = f.read().strip()
+        if auth_token == "":
+            raise ValueError("Auth token file empty (%s)." % token_file)
+        # If this is a Balena CLI data directory, the CLI can use it as is.
+        if os.path.basename(token_file) == 'token':
+            cli_data_dir = os.path.dirname(os.path.abspath(token_file))
+    elif entry.get('token_env', None):
+        auth_token = os.environ.get(entry['token_env'], "")
+        if auth_token == "":
+            raise ValueError("Environment variable %s not set." % entry['token_env'])
+    else:
+        return Account(name, balena_host, get_auth_token(), None)
+
+    if cli_data_dir is None:
+        # The Balena CLI can only read the token from a file in its data directory, so give each account its own (see
+        # get_cli_environment()).
+        cache_key = cache.get_cache_key(get_api_endpoint(balena_host), auth_token)
+        cli_data_dir = os.path.join(_get_cli_data_root(), cache_key)
+    return Account(name, balena_host, auth_token, cli_data_dir)
+
+
+def load_accounts(names=None, path=None):
+    # Load the accounts file. If `names` is specified, only return those accounts, in the order listed in the file.
+    # Returns an empty list if there is no accounts file.
+    #
+    # An account whose token cannot be read (e.g., a missing token file) is skipped with a warning, so the other
+    # accounts can still be used.
+    if path is None:
+        path = get_accounts_path()
+    if path is None or not os.path.exists(path):
+        if names:
+            raise ValueError("Account '%s' not found: no accounts file." % names[0])
+        return []
+
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        entries = data['accounts']
+        if not isinstance(entries, list):
+            raise TypeError()
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid accounts file '%s': expected a JSON object with an 'accounts' list." % path)
+
+    accounts = []
+    seen_names = set()
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('name', None), str) or entry['name'] == '':
+            raise ValueError("Invalid account entry in '%s': each account must have a name." % path)
+        elif entry['name'] in seen_names:
+            raise ValueError("Duplicate account '%s' in '%s'." % (entry['name'], path))
+        seen_names.add(entry['name'])
+
+        if names and entry['name'] not in names:
+            continue
+
+        try:
+            accounts.append(_parse_account(entry))
+        except (OSError, RuntimeError, ValueError) as e:
+            __logger.warning("Warning: Skipping account '%s': %s" % (entry['name'], str(e)))
+
+    if names:
+        for name in names:
+            if name not in seen_names:
+                raise ValueError("Account '%s' not found in '%s'." % (name, path))
+    return accounts
+
+
+def get_cli_environment(account):
+    # Get the environment variables needed to run the Balena CLI (or another wrapper process) with an account's
+    # credentials.
+    env = {
+        'BALENARC_BALENA_URL': account.balena_host,
+        'BALENA_AUTH_TOKEN': account.auth_token,
+    }
+
+    if account.cli_data_dir is not None:
+        # Write the token to the account's own data directory if we manage it, and it is missing or out of date.
+        if os.path.dirname(account.cli_data_dir) == _get_cli_data_root():
+            token_path = os.path.join(account.cli_data_dir, 'token')
+            try:
+                with open(token_path, 'r') as f:
+                    current_token = f.read().strip()
+            except OSError:
+                current_token = None
+
+            if current_token != account.auth_token:
+                os.makedirs(account.cli_data_dir, mode=0o700, exist_ok=True)
+                fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(account.auth_token)
+        env['BALENARC_DATA_DIRECTORY'] = account.cli_data_dir
+
+    return env
+
+
+def describe_device(device):
+    # Format a device for an error message, including its account if known.
+    if isinstance(device, AccountDevice):
+        return "%s (%s) [%s]" % (device.name, device.uuid, device.account)
+    else:
+        return "%s (%s)" % (device['device_name'], device['uuid'])
+
+
+def get_candidate_accounts(result):
+    # Get the names of the accounts containing the candidates for an ambiguous query, in order.
+    names = []
+    for device in result.candidates:
+        account = getattr(device, 'account', None)
+        if account is not None and account not in names:
+            names.append(account)
+    return names
+
+
+def _get_owners_path():
+    return os.path.join(cache.get_cache_dir(), "accounts-owners.json")
+
+
+def _load_owners():
+    data = cache.read_json(_get_owners_path())
+    if data is None or data.get('version', None) != OWNERS_FORMAT_VERSION or not isinstance(data.get('owners'), dict):
+        return {}
+    return data['owners']
+
+
+def _save_owners(owners):
+    # Drop the oldest entries. Entries are moved to the end when they are updated (see _remember_owner()).
+    if len(owners) > MAX_OWNER_ENTRIES:
+        for key in list(owners.keys())[:len(owners) - MAX_OWNER_ENTRIES]:
+            del owners[key]
+
+    try:
+        cache.atomic_write_json(_get_owners_path(), {"version": OWNERS_FORMAT_VERSION, "owners": owners})
+    except OSError as e:
+        __logger.debug("Unable to save device accounts: %s" % str(e))
+
+
+def _remember_owner(owners, key, account_name):
+    if owners.get(key, None) == account_name:
+        return False
+    owners.pop(key, None)
+    owners[key] = account_name
+    return True
+
+
+def _list_account_devices(account, use_cache=True):
+    # List all devices in an account. If `use_cache` is set, the account's device cache is brought up to date with an
+    # incremental sync (see sync.py), and other processes listing the same account at the same time share the result.
+    def _sync_devices():
+        balena = authenticate(account.auth_token, balena_host=account.balena_host)
+        return sync.sync_devices(balena, account.api_endpoint, account.auth_token).devices
+
+    __logger.debug("Listing devices for account '%s'." % account.name)
+    if use_cache:
+        devices = cache.fetch_devices(account.api_endpoint, account.auth_token, _sync_devices, max_age_sec=0.0)
+    else:
+        devices = list_devices(authenticate(account.auth_token, balena_host=account.balena_host))
+    return DeviceIndex(devices)
+
+
+def _list_accounts(accounts, use_cache=True):
+    # List the devices in several accounts at the same time. Returns a dict of account name -> DeviceIndex. Accounts
+    # that could not be listed (e.g., an expired token, or an unreachable server) are left out, with a warning.
+    from concurrent.futures import ThreadPoolExecutor
+
+    if len(accounts) == 0:
+        return {}
+
+    with profiling.span('list_accounts'):
+        with ThreadPoolExecutor(max_workers=len(accounts)) as executor:
+            futures = [(account, executor.submit(_list_account_devices, account, use_cache)) for account in accounts]
+
+    indexes = {}
+    for account, future in futures:
+        try:
+            indexes[account.name] = future.result()
+        except Exception as e:
+            __logger.warning("Warning: Unable to list devices for account '%s': %s" % (account.name, str(e)))
+    profiling.count('accounts_listed', len(accounts))
+    return indexes
+
+
+def _merge_results(query, account_results, check_exact_match=False):
+    # Combine the results of a query in each account, listed in order of preference, into a single DeviceQueryResult.
+    found = []
+    ambiguous = []
+    suggestions = []
+    seen = set()
+    for account, result in account_results:
+        if result.status == FOUND:
+            # The same device may be visible to more than one account (e.g., two tokens for the same org).
+            key = (account.api_endpoint, result.uuid)
+            if key not in seen:
+                seen.add(key)
+                found.append(AccountDevice(result.uuid, result.name, account.name))
+        elif result.status == AMBIGUOUS:
+            ambiguous.extend(AccountDevice(d.uuid, d.name, account.name) for d in result.candidates)
+        else:
+            suggestions.extend(AccountDevice(d.uuid, d.name, account.name) for d in result.candidates)
+
+    # As within a single account, an exact name or UUID match takes precedence over partial matches elsewhere.
+    if check_exact_match and len(found) + len(ambiguous) > 1:
+        exact = [d for d in found if d.name == query or d.uuid == query.lower()]
+        if len(exact) == 1:
+            found = exact
+            ambiguous = []
+
+    if len(found) == 1 and len(ambiguous) == 0:
+        device = found[0]
+        return DeviceQueryResult(query, FOUND, device.uuid, device.name, [], device.account)
+    elif len(found) + len(ambiguous) > 0:
+        return DeviceQueryResult(query, AMBIGUOUS, None, None, found + ambiguous)
+    else:
+        return DeviceQueryResult(query, NOT_FOUND, None, None, suggestions[:MAX_SUGGESTIONS])
+
+
+def _has_match(index, name_or_uuid, is_name=None):
+    # Check if any device in an index matches a query, exactly or partially.
+    device, devices_by_name, devices_by_uuid = index.find(name_or_uuid, is_name=is_name)
+    return device is not None or len(devices_by_name) + len(devices_by_uuid) > 0
+
+
+def resolve(identifiers, accounts=None, is_name=None, check_exact_match=False, use_cache=True, cache_ttl_sec=None):
+    # Resolve one or more device queries across all accounts. Returns a list of DeviceQueryResult, with `account` set to
+    # the name of the account containing each device found. Candidates are AccountDevice records.
+    identifiers = list(identifiers)
+    if accounts is None:
+        accounts = load_accounts()
+    if len(accounts) == 0:
+        raise RuntimeError("No Balena accounts available.")
+
+    owners = _load_owners()
+    accounts_by_name = {account.name: account for account in accounts}
+
+    def _get_owner(name_or_uuid):
+        owner = owners.get(name_or_uuid, None)
+        return owner if owner in accounts_by_name else None
+
+    # First, try to resolve each query from the device caches, without any network requests. Any device matching the
+    # query in an account's cache (exact, prefix, or substring) counts as a match in that account, so a query that
+    # matches devices in more than one account is never resolved to just one of them.
+    #
+    # A query is resolved from the caches without listing anything if:
+    # - It is an exact UUID or name of a single device in exactly one account, and nothing in any other account's cache
+    #   matches it, as long as every account has a cache or the device is known to belong to that account
+    # - Every account has an up-to-date cache, and combining the matches in each account (see _merge_results()) finds a
+    #   single device. As with a single account, partial matches are not accepted from an expired cache.
+    cached_indexes = {}
+    stale_accounts = []
+    if use_cache:
+        with profiling.span('load_cache'):
+            for account in accounts:
+                devices, is_stale = cache.load_devices_stale_ok(account.api_endpoint, account.auth_token,
+                                                                ttl_sec=cache_ttl_sec)
+                if devices is not None:
+                    cached_indexes[account.name] = DeviceIndex(devices)
+                    if is_stale:
+                        stale_accounts.append(account)
+
+    all_cached = len(cached_indexes) == len(accounts)
+    all_fresh = all_cached and len(stale_accounts) == 0
+    results = [None] * len(identifiers)
+    cached_matches = []
+    for i, name_or_uuid in enumerate(identifiers):
+        matches = [name for name, index in cached_indexes.items() if _has_match(index, name_or_uuid, is_name=is_name)]
+        cached_matches.append(matches)
+
+        if len(matches) == 1 and (all_cached or matches[0] == _get_owner(name_or_uuid)):
+            device = cached_indexes[matches[0]].resolve_exact(name_or_uuid, is_name=is_name)
+            if device is not None:
+                results[i] = DeviceQueryResult(name_or_uuid, FOUND, device.uuid, device.name, [], matches[0])
+                continue
+
+        if all_fresh and len(matches) > 0:
+            account_results = [(account, cached_indexes[account.name].match(name_or_uuid, is_name=is_name,
+                                                                            check_exact_match=check_exact_match))
+                               for account in accounts]
+            result = _merge_results(name_or_uuid, account_results, check_exact_match=check_exact_match)
+            if result.status == FOUND:
+                results[i] = result
+    __logger.debug("Resolved %d/%d queries from device caches." %
+                   (len(identifiers) - results.count(None), len(identifiers)))
+
+    # If everything was resolved from expired caches, update them in the background. Otherwise, they are updated by
+    # the live listings below.
+    if None not in results:
+        for account in stale_accounts:
+            with profiling.span('start_refresh'):
+                cache.refresh_in_background(account.api_endpoint, account.auth_token, account=account.name)
+
+    # For anything left, list devices in the account each device was last found in first. If the query is an exact
+    # UUID or name of a single device there, and no other account's cache matched the query, it is accepted without
+    # listing the other accounts. Anything else (e.g., a partial name, which may also match devices in an account we
+    # have not listed) is resolved by listing every account below.
+    live_indexes = {}
+    pending = [i for i in range(len(identifiers)) if results[i] is None]
+    owner_names = set(_get_owner(identifiers[i]) for i in pending) - {None}
+    if len(owner_names) > 0:
+        live_indexes.update(_list_accounts([a for a in accounts if a.name in owner_names], use_cache=use_cache))
+        for i in pending:
+            owner = _get_owner(identifiers[i])
+            if owner in live_indexes and all(name == owner for name in cached_matches[i]):
+                device = live_indexes[owner].resolve_exact(identifiers[i], is_name=is_name)
+                if device is not None:
+                    results[i] = DeviceQueryResult(identifiers[i], FOUND, device.uuid, device.name, [], owner)
+
+    # Then, list all remaining accounts at the same time, and combine the results.
+    pending = [i for i in range(len(identifiers)) if results[i] is None]
+    if len(pending) > 0:
+        remaining = [account for account in accounts if account.name not in live_indexes]
+        live_indexes.update(_list_accounts(remaining, use_cache=use_cache))
+        if len(live_indexes) == 0:
+            raise RuntimeError("Unable to list devices in any account.")
+
+        for i in pending:
+            # Put the account the device was last found in first, so it is preferred for duplicates.
+            owner = _get_owner(identifiers[i])
+            ordered = sorted([a for a in accounts if a.name in live_indexes], key=lambda a: a.name != owner)
+            account_results = [(account, live_indexes[account.name].match(identifiers[i], is_name=is_name,
+                                                                          check_exact_match=check_exact_match))
+                               for account in ordered]
+            results[i] = _merge_results(identifiers[i], account_results, check_exact_match=check_exact_match)
+
+    # Remember which account each device was found in, by query and by UUID.
+    changed = False
+    for result in results:
+        if result.status == FOUND:
+            changed |= _remember_owner(owners, result.query, result.account)
+            changed |= _remember_owner(owners, result.uuid, result.account)
+    if changed:
+        _save_owners(owners)
+
+    return results
+
+
+def get_device_indexes(accounts=None, use_cache=True):
+    # Get a DeviceIndex for each account, from its device cache if possible. Any accounts without a cached device list
+    # are listed at the same time. Returns a dict of account name -> DeviceIndex.
+    if accounts is None:
+        accounts = load_accounts()
+
+    indexes = {}
+    missing = []
+    for account in accounts:
+        devices = cache.load_devices(account.api_endpoint, account.auth_token) if use_cache else None
+        if devices is not None:
+            indexes[account.name] = DeviceIndex(devices)
+        else:
+            missing.append(account)
+    indexes.update(_list_accounts(missing, use_cache=use_cache))
+    return indexes
+
+
+def find_devices(pattern, accounts=None, device_indexes=None, use_cache=True):
+    # Find all devices in any account whose names match a case-insensitive shell-style wildcard pattern. Returns a list
+    # of AccountDevice records, sorted by name. As with device.find_devices(), a cached device list is considered
+    # authoritative.
+    if accounts is None:
+        accounts = load_accounts()
+    if device_indexes is None:
+        device_indexes = get_device_indexes(accounts, use_cache=use_cache)
+
+    matches = []
+    for account in accounts:
+        if account.name in device_indexes:
+            matches.extend(AccountDevice(d.uuid, d.name, account.name)
+                           for d in device_indexes[account.name].search(pattern))
+    return sorted(matches, key=lambda d: (d.name, d.account))
+
+
+def refresh_accounts(accounts=None, full=False):
+    # Update the device cache for each account at the same time (see device.refresh_device_cache()). Returns a dict of
+    # account name -> number of devices, leaving out any accounts that could not be refreshed.
+    from concurrent.futures import ThreadPoolExecutor
+
+    if accounts is None:
+        accounts = load_accounts()
+
+    def _refresh(account):
+        def _sync_devices():
+            balena = authenticate(account.auth_token, balena_host=account.balena_host)
+            return sync.sync_devices(balena, account.api_endpoint, account.auth_token, full=full).devices
+        return len(cache.fetch_devices(account.api_endpoint, account.auth_token, _sync_devices, max_age_sec=0.0))
+
+    with ThreadPoolExecutor(max_workers=max(len(accounts), 1)) as executor:
+        futures = [(account, executor.submit(_refresh, account)) for account in accounts]
+
+    counts = {}
+    for account, future in futures:
+        try:
+            counts[account.name] = future.result()
+        except Exception as e:
+            __logger.warning("Warning: Unable to refresh devices for account '%s': %s" % (account.name, str(e)))
+    return counts
@@ -1,49 +1,224 @@
+import base64
+import json
 import logging
 import os
 import re
+import threading
+import time
 
-from balena import Balena
+from . import cache, profiling
 
 __logger = logging.getLogger("point_one.balena.auth")
 
+DEFAULT_BALENA_HOST = "balena-cloud.com"
 
-def get_auth_token():
-    auth_token = os.environ.get("BALENA_AUTH_TOKEN", None)
+# How long a validated session identity is trusted before we check it with the API again, even if the token itself has
+# not changed or expired (e.g., in case the token was revoked).
+DEFAULT_SESSION_MAX_AGE_SEC = 24 * 3600.0
+
+# Token values read from the token/config files, keyed by file path and modification time, so each file is parsed at
+# most once per process.
+_token_file_cache = {}
+
+# Authenticated SDK sessions, keyed by API endpoint and token fingerprint.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_balena_host():
+    # We honor the same BALENARC_BALENA_URL variable used by the Balena CLI to select a non-default server (e.g.,
+    # openBalena).
+    balena_host = os.environ.get("BALENARC_BALENA_URL", None)
+    if not balena_host:
+        balena_host = DEFAULT_BALENA_HOST
+    return balena_host
 
+
+def get_api_endpoint(balena_host=None):
+    # Note: This intentionally does not construct a Balena SDK object so it can be used for cache lookups without
+    # importing the SDK.
+    if not balena_host:
+        balena_host = get_balena_host()
+    return "https://api.%s/" % balena_host
+
+
+def _read_token_file(path, parse_function):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    auth_token = _token_file_cache.get(key, None)
     if auth_token is None:
-        token_file = os.path.expanduser("~/.balena/token")
-        config_file = os.path.expanduser("~/.balena/balena.cfg")
+        __logger.debug("Reading auth token from '%s'." % path)
+        with open(path, "r") as f:
+            auth_token = parse_function(f)
+        _token_file_cache[key] = auth_token
+    return auth_token
+
 
-        if os.path.exists(token_file):
-            __logger.debug("Reading auth token from '%s'." % token_file)
-            with open(token_file, "r") as f:
-                auth_token = f.read().strip()
+def _parse_token_file(f):
+    return f.read().strip()
+
+
+def _parse_config_file(f):
+    for line in f:
+        m = re.match(r"token\s*=\s*(.*)", line.strip())
+        if m:
+            return m.group(1).strip()
+    return None
+
+
+def get_auth_token():
+    with profiling.span('get_auth_token'):
+        auth_token = os.environ.get("BALENA_AUTH_TOKEN", None)
+
+        if auth_token is None:
+            token_file = os.path.expanduser("~/.balena/token")
+            config_file = os.path.expanduser("~/.balena/balena.cfg")
+
+            if os.path.exists(token_file):
+                auth_token = _read_token_file(token_file, _parse_token_file)
                 if auth_token == "":
                     raise ValueError("Auth token file empty (%s)." % token_file)
-        elif os.path.exists(config_file):
-            __logger.debug("Reading auth token from '%s'." % config_file)
-            with open(config_file, "r") as f:
-                for line in f.readline():
-                    m = re.match(r"token = (.*)", line)
-                    if m:
-                        auth_token = m.group(1)
-                        break
-
+            elif os.path.exists(config_file):
+                auth_token = _read_token_file(config_file, _parse_config_file)
                 if auth_token is None:
                     raise ValueError("Auth token not found in config file (%s)." % config_file)
+            else:
+                raise RuntimeError("Unable to determine Balena authentication token: could not find token file or "
+                                   "config file.")
+        else:
+            __logger.debug("Using auth token from BALENA_AUTH_TOKEN environment variable.")
+
+        return auth_token
+
+
+def get_token_expiration(auth_token):
+    # Session tokens are JWTs containing an expiration time. API keys are opaque strings and do not expire on their own.
+    # The signature is not checked here: this is only used to decide when a cached session identity is no longer
+    # trustworthy, not to authenticate anything.
+    parts = auth_token.split('.')
+    if len(parts) != 3:
+        return None
+
+    try:
+        payload = parts[1] + '=' * (-len(parts[1]) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))
+        expiration = claims.get('exp', None)
+        return float(expiration) if expiration is not None else None
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _get_session_identity_path(api_endpoint, auth_token):
+    return os.path.join(cache.get_cache_dir(), "session-%s.json" % cache.get_cache_key(api_endpoint, auth_token))
+
+
+def get_session_identity(balena=None, auth_token=None, max_age_sec=DEFAULT_SESSION_MAX_AGE_SEC, balena_host=None):
+    # Get the identity (user/org, API endpoint, token fingerprint, and expiration time) of the account associated with
+    # an auth token.
+    #
+    # The identity is validated with the API (whoami) the first time, and then saved to disk. Later calls, including
+    # from other processes, use the saved identity without any network requests until the token changes, the token
+    # expires, or `max_age_sec` elapses.
+    if auth_token is None:
+        auth_token = get_auth_token()
+
+    api_endpoint = get_api_endpoint(balena_host)
+    fingerprint = cache.get_token_fingerprint(auth_token)
+    path = _get_session_identity_path(api_endpoint, auth_token)
+
+    now = time.time()
+    identity = cache.read_json(path)
+    if identity is not None:
+        expiration = identity.get('expiration', None)
+        if identity.get('token') != fingerprint or identity.get('endpoint') != api_endpoint:
+            identity = None
+        elif expiration is not None and expiration <= now:
+            __logger.debug("Cached session identity expired.")
+            identity = None
+        elif now - identity.get('validated', 0.0) > max_age_sec:
+            __logger.debug("Cached session identity is too old. Revalidating.")
+            identity = None
+
+    if identity is None:
+        expiration = get_token_expiration(auth_token)
+        if expiration is not None and expiration <= now:
+            raise RuntimeError("Balena auth token expired. Please log in again.")
+
+        if balena is None:
+            balena = authenticate(auth_token, balena_host=balena_host)
+
+        __logger.debug("Validating auth token with the Balena API.")
+        whoami = balena.auth.whoami()
+        if whoami is None:
+            raise RuntimeError("Balena auth token is not valid. Please log in again.")
+        elif isinstance(whoami, dict):
+            # SDK 13+ returns actor details. Depending on the type of token, the actor may be a user, an application,
+            # or a device.
+            actor = whoami.get('username', None) or whoami.get('slug', None) or whoami.get('uuid', None)
+            actor_type = whoami.get('actorType', 'user')
         else:
-            raise RuntimeError("Unable to determine Balena authentication token: could not find token file or config "
-                               "file.")
+            # Older SDKs return the username.
+            actor = str(whoami)
+            actor_type = 'user'
+
+        identity = {
+            'endpoint': api_endpoint,
+            'token': fingerprint,
+            'actor': actor,
+            'actor_type': actor_type,
+            'expiration': expiration,
+            'validated': now,
+        }
+        try:
+            cache.atomic_write_json(path, identity)
+        except OSError as e:
+            __logger.debug("Unable to save session identity: %s" % str(e))
     else:
-        __logger.debug("Using auth token from BALENA_AUTH_TOKEN environment variable.")
+        __logger.debug("Using cached session identity for %s." % identity['actor'])
+
+    return identity
 
-    return auth_token
 
+def authenticate(auth_token=None, reuse_session=True, validate=False, balena_host=None):
+    # If `balena_host` is specified, connect to that server instead of the one selected by BALENARC_BALENA_URL (see
+    # accounts.py).
+    #
+    # Note: The SDK is imported here, rather than at the top of the file, so the rest of this module (get_auth_token(),
+    # etc.) can be used without paying the cost of importing the SDK.
+    with profiling.span('import_sdk'):
+        from balena import Balena
+    profiling.instrument_requests()
 
-def authenticate(auth_token=None):
     if auth_token is None:
         auth_token = get_auth_token()
 
-    balena = Balena()
-    balena.auth.login_with_token(auth_token)
+    # Reuse the existing SDK session for this account if there is one, so library callers that do not pass around their
+    # own SDK object (e.g., repeated get_device_uuid() calls) do not log in again every time.
+    api_endpoint = get_api_endpoint(balena_host)
+    key = (api_endpoint, cache.get_token_fingerprint(auth_token))
+    with _sessions_lock:
+        balena = _sessions.get(key, None) if reuse_session else None
+        if balena is None:
+            if balena_host:
+                # By default, the SDK saves its settings, including the token, to ~/.balena/balena.cfg, and reads them
+                # back on every request. Keep them in memory instead, so sessions for several accounts can be used at
+                # the same time without overwriting each other's token.
+                balena = Balena({"balena_host": balena_host, "data_directory": False})
+            elif os.environ.get("BALENARC_BALENA_URL", None):
+                balena = Balena({"balena_host": os.environ["BALENARC_BALENA_URL"]})
+            else:
+                balena = Balena()
+            with profiling.span('login_with_token'):
+                balena.auth.login_with_token(auth_token)
+            if reuse_session:
+                _sessions[key] = balena
+        else:
+            __logger.debug("Reusing existing Balena session.")
+
+    # If requested, make sure the token is actually valid. This only makes an API request if the token has not been
+    # validated recently (see get_session_identity()).
+    if validate:
+        with profiling.span('validate_token'):
+            get_session_identity(balena=balena, auth_token=auth_token, balena_host=balena_host)
+
     return balena
@@ -0,0 +1,363 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+
+from . import completion, refresh
+
+__logger = logging.getLogger("point_one.balena.cache")
+
+# Default device cache lifetime (in seconds). This can be overridden with the BALENA_WRAPPER_CACHE_TTL environment
+# variable. Setting the TTL to 0 disables the cache entirely.
+DEFAULT_CACHE_TTL_SEC = 3600.0
+
+# After the cache expires, it may still be used for this long (in seconds) while it is refreshed in the background.
+# Only exact UUID or name matches are accepted from expired data, and the window is kept short to limit the chance of
+# resolving a device that has since been renamed or re-provisioned. This can be overridden with the
+# BALENA_WRAPPER_CACHE_GRACE environment variable. Setting it to 0 means expired data is never used.
+DEFAULT_CACHE_GRACE_SEC = 15 * 60.0
+
+CACHE_FORMAT_VERSION = 1
+
+# When several wrapper processes miss the cache at the same time (e.g., parallel CI jobs), only one of them lists the
+# fleet, while the others wait for it to save the result to the cache. A waiting process gives up and lists the fleet
+# itself after DEFAULT_FETCH_TIMEOUT_SEC. A lock held longer than STALE_FETCH_LOCK_SEC, or by a process that no longer
+# exists, is assumed to have been abandoned (e.g., the process was killed) and is removed.
+DEFAULT_FETCH_TIMEOUT_SEC = 120.0
+STALE_FETCH_LOCK_SEC = 600.0
+FETCH_POLL_INTERVAL_SEC = 0.05
+
+
+def get_cache_dir():
+    cache_dir = os.environ.get("BALENA_WRAPPER_CACHE_DIR", None)
+    if cache_dir is None:
+        xdg_cache_dir = os.environ.get("XDG_CACHE_HOME", None)
+        if not xdg_cache_dir:
+            xdg_cache_dir = os.path.expanduser("~/.cache")
+        cache_dir = os.path.join(xdg_cache_dir, "point_one", "balena")
+    return cache_dir
+
+
+def get_cache_ttl(ttl_sec=None):
+    if ttl_sec is None:
+        value = os.environ.get("BALENA_WRAPPER_CACHE_TTL", None)
+        if value is None or value == "":
+            ttl_sec = DEFAULT_CACHE_TTL_SEC
+        else:
+            try:
+                ttl_sec = float(value)
+            except ValueError:
+                __logger.warning("Ignoring invalid BALENA_WRAPPER_CACHE_TTL value '%s'." % value)
+                ttl_sec = DEFAULT_CACHE_TTL_SEC
+    return max(ttl_sec, 0.0)
+
+
+def get_cache_grace(grace_sec=None):
+    if grace_sec is None:
+        value = os.environ.get("BALENA_WRAPPER_CACHE_GRACE", None)
+        if value is None or value == "":
+            grace_sec = DEFAULT_CACHE_GRACE_SEC
+        else:
+            try:
+                grace_sec = float(value)
+            except ValueError:
+                __logger.warning("Ignoring invalid BALENA_WRAPPER_CACHE_GRACE value '%s'." % value)
+                grace_sec = DEFAULT_CACHE_GRACE_SEC
+    return max(grace_sec, 0.0)
+
+
+def get_token_fingerprint(auth_token):
+    # Never store the token itself on disk. A truncated hash is enough to tell tokens (i.e., accounts) apart.
+    return hashlib.sha256(auth_token.encode('utf-8')).hexdigest()[:16]
+
+
+def get_cache_key(api_endpoint, auth_token):
+    key = "%s\n%s" % (api_endpoint.rstrip('/'), get_token_fingerprint(auth_token))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+
+
+def get_device_cache_path(api_endpoint, auth_token):
+    return os.path.join(get_cache_dir(), "devices-%s.json" % get_cache_key(api_endpoint, auth_token))
+
+
+def get_fetch_lock_path(api_endpoint, auth_token):
+    return os.path.join(get_cache_dir(), "devices-%s.lock" % get_cache_key(api_endpoint, auth_token))
+
+
+def get_sync_state_path(api_endpoint, auth_token):
+    # Incremental sync state (see sync.py).
+    return os.path.join(get_cache_dir(), "devices-%s.sync.json" % get_cache_key(api_endpoint, auth_token))
+
+
+def atomic_write_json(path, data):
+    # Write to a temporary file in the same directory and then rename it over the destination. Readers (including other
+    # wrapper processes running concurrently) will see either the old file or the new one, never a partial write.
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        __logger.debug("Ignoring unreadable cache file '%s': %s" % (path, str(e)))
+        return None
+
+
+def load_devices(api_endpoint, auth_token, ttl_sec=None):
+    devices, _ = load_devices_stale_ok(api_endpoint, auth_token, ttl_sec=ttl_sec, grace_sec=0.0)
+    return devices
+
+
+def load_devices_stale_ok(api_endpoint, auth_token, ttl_sec=None, grace_sec=None):
+    # Load the cached device list, including a list that has expired less than `grace_sec` ago. Returns a tuple of the
+    # list of (uuid, name) tuples and a flag indicating if the list is expired, or (None, False) if there is no usable
+    # cache.
+    #
+    # Callers using expired data should treat it as a hint only (i.e., not trust a device to be missing or ambiguous),
+    # and should call refresh_in_background() to update it.
+    ttl_sec = get_cache_ttl(ttl_sec)
+    if ttl_sec == 0.0:
+        return None, False
+
+    path = get_device_cache_path(api_endpoint, auth_token)
+    data = read_json(path)
+    if data is None:
+        __logger.debug("No device cache found for %s." % api_endpoint)
+        return None, False
+    elif data.get("version", None) != CACHE_FORMAT_VERSION:
+        __logger.debug("Ignoring device cache with unsupported version.")
+        return None, False
+
+    age_sec = time.time() - data.get("timestamp", 0.0)
+    if age_sec < 0.0 or age_sec > ttl_sec + get_cache_grace(grace_sec):
+        __logger.debug("Device cache expired (age=%.1f sec, TTL=%.1f sec)." % (age_sec, ttl_sec))
+        return None, False
+
+    is_stale = age_sec > ttl_sec
+    __logger.debug("Loaded %d devices from %scache '%s' (age=%.1f sec)." %
+                   (len(data["devices"]), "expired " if is_stale else "", path, age_sec))
+    return [(entry[0], entry[1]) for entry in data["devices"]], is_stale
+
+
+def _load_devices_since(api_endpoint, auth_token, min_timestamp):
+    # Load the cached device list if it was saved at or after `min_timestamp`, regardless of the cache TTL.
+    data = read_json(get_device_cache_path(api_endpoint, auth_token))
+    if (data is None or data.get("version", None) != CACHE_FORMAT_VERSION or
+            data.get("timestamp", 0.0) < min_timestamp):
+        return None
+    else:
+        return [(entry[0], entry[1]) for entry in data["devices"]]
+
+
+def _try_acquire_fetch_lock(lock_path):
+    # Create the lock file atomically, recording its owner so other processes can tell if it has been abandoned.
+    # Returns False if another process already holds the lock.
+    os.makedirs(os.path.dirname(lock_path), mode=0o700, exist_ok=True)
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, "w") as f:
+        json.dump({"pid": os.getpid(), "host": socket.gethostname(), "timestamp": time.time()}, f)
+    return True
+
+
+def _is_fetch_lock_stale(lock_path):
+    try:
+        mtime = os.path.getmtime(lock_path)
+    except OSError:
+        return False
+
+    if time.time() - mtime > STALE_FETCH_LOCK_SEC:
+        return True
+
+    # The owner writes its PID immediately after creating the file, so the file may briefly be empty.
+    owner = read_json(lock_path)
+    if not isinstance(owner, dict) or owner.get("host", None) != socket.gethostname():
+        return False
+
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, KeyError, TypeError):
+        pass
+    return False
+
+
+def _wait_for_fetch_lock(lock_path, deadline):
+    # Wait for another process to release the fetch lock. Returns False if it is still held at `deadline` (a
+    # time.monotonic() value).
+    while os.path.exists(lock_path):
+        if _is_fetch_lock_stale(lock_path):
+            __logger.warning("Removing abandoned device fetch lock '%s'." % lock_path)
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            return True
+        elif time.monotonic() >= deadline:
+            return False
+        time.sleep(FETCH_POLL_INTERVAL_SEC)
+    return True
+
+
+def wait_for_fetch(api_endpoint, auth_token, timeout_sec=None):
+    # If another process is currently listing the fleet for this account, wait for it to finish and return the device
+    # list it saved to the cache. Returns None immediately if no fetch is in progress, or None if the fetch failed or
+    # did not finish in time.
+    lock_path = get_fetch_lock_path(api_endpoint, auth_token)
+    try:
+        lock_timestamp = os.path.getmtime(lock_path)
+    except OSError:
+        return None
+
+    __logger.debug("Waiting for another process to list devices.")
+    timeout_sec = DEFAULT_FETCH_TIMEOUT_SEC if timeout_sec is None else timeout_sec
+    if not _wait_for_fetch_lock(lock_path, time.monotonic() + timeout_sec):
+        __logger.debug("Timed out waiting for another process to list devices.")
+        return None
+
+    # Accept anything saved after the other process started listing, even if the cache TTL is 0.
+    return _load_devices_since(api_endpoint, auth_token, lock_timestamp)
+
+
+def fetch_devices(api_endpoint, auth_token, list_fn, max_age_sec=None, timeout_sec=None):
+    # List all devices by calling `list_fn()` and save them to the cache, coalescing concurrent calls across processes:
+    # if another process is already listing the fleet for the same account, wait for it and use its result instead of
+    # making the same requests again.
+    #
+    # A device list saved less than `max_age_sec` ago (default: the cache TTL) is used without calling `list_fn()`. Set
+    # `max_age_sec` to 0 to only accept a list saved after this call started (e.g., to force a refresh).
+    #
+    # Returns a list of devices in the form returned by `list_fn()`, or of (uuid, name) tuples if the list came from
+    # another process.
+    start_time = time.time()
+    min_timestamp = start_time - (get_cache_ttl() if max_age_sec is None else max_age_sec)
+    timeout_sec = DEFAULT_FETCH_TIMEOUT_SEC if timeout_sec is None else timeout_sec
+    deadline = time.monotonic() + timeout_sec
+    lock_path = get_fetch_lock_path(api_endpoint, auth_token)
+
+    while True:
+        try:
+            acquired = _try_acquire_fetch_lock(lock_path)
+        except OSError as e:
+            __logger.debug("Unable to create device fetch lock '%s': %s" % (lock_path, str(e)))
+            break
+
+        if acquired:
+            try:
+                # Another process may have finished listing devices just before we took the lock.
+                devices = _load_devices_since(api_endpoint, auth_token, min_timestamp)
+                if devices is None:
+                    devices = list_fn()
+                    save_devices(api_endpoint, auth_token, devices)
+                return devices
+            finally:
+                try:
+                    os.unlink(lock_path)
+                except OSError:
+                    pass
+
+        __logger.debug("Another process is listing devices. Waiting for its result.")
+        if not _wait_for_fetch_lock(lock_path, deadline):
+            __logger.warning("Timed out after %.1f sec waiting for another process to list devices." % timeout_sec)
+            break
+
+        devices = _load_devices_since(api_endpoint, auth_token, min_timestamp)
+        if devices is not None:
+            __logger.debug("Using device list saved by another process.")
+            return devices
+
+        # The other process did not save anything (e.g., its request failed). Try to take over.
+        if time.monotonic() >= deadline:
+            break
+
+    devices = list_fn()
+    save_devices(api_endpoint, auth_token, devices)
+    return devices
+
+
+def refresh_in_background(api_endpoint, auth_token, account=None):
+    # Start a detached process to list all devices and update the cache, without waiting for it to finish. For an
+    # account from the accounts file, specify its name (see accounts.py).
+    if refresh.start_background_refresh(get_cache_dir(), get_cache_key(api_endpoint, auth_token),
+                                        auth_token=auth_token if account is None else None, account=account):
+        __logger.debug("Started background device cache refresh.")
+
+
+def save_devices(api_endpoint, auth_token, devices):
+    # Only the fields used for name/UUID resolution are stored.
+    entries = []
+    for device in devices:
+        if isinstance(device, dict):
+            entries.append((device['uuid'], device['device_name']))
+        else:
+            entries.append((device[0], device[1]))
+
+    path = get_device_cache_path(api_endpoint, auth_token)
+    data = {
+        "version": CACHE_FORMAT_VERSION,
+        "endpoint": api_endpoint,
+        "timestamp": time.time(),
+        "devices": entries,
+    }
+
+    try:
+        atomic_write_json(path, data)
+        __logger.debug("Saved %d devices to cache '%s'." % (len(entries), path))
+    except OSError as e:
+        __logger.warning("Unable to write device cache '%s': %s" % (path, str(e)))
+        return False
+
+    # Update the shell completion snapshot to match. See completion.py.
+    cache_key = get_cache_key(api_endpoint, auth_token)
+    try:
+        completion.write_snapshot(cache_key, entries)
+    except OSError as e:
+        __logger.debug("Unable to write completion snapshot: %s" % str(e))
+
+    # Allow another background refresh to start as soon as the data expires again.
+    refresh.clear_marker(get_cache_dir(), cache_key)
+    return True
+
+
+def clear_devices(api_endpoint=None, auth_token=None):
+    if api_endpoint is not None and auth_token is not None:
+        paths = [get_device_cache_path(api_endpoint, auth_token), get_sync_state_path(api_endpoint, auth_token)]
+        completion.clear_snapshots(get_cache_key(api_endpoint, auth_token))
+    else:
+        paths = glob.glob(os.path.join(get_cache_dir(), "devices-*.json"))
+        completion.clear_snapshots()
+
+    num_removed = 0
+    for path in paths:
+        try:
+            os.unlink(path)
+            num_removed += 1
+            __logger.debug("Removed device cache '%s'." % path)
+        except FileNotFoundError:
+            pass
+    return num_removed
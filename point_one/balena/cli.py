@@ -2,10 +2,12 @@
 
 import argparse
 import ipaddress
+import json
 import logging
 import os
 import subprocess
 import sys
+import time
 
 # Relative imports don't usually work when running a Python file as a script since the file is not considered to be part
 # of a package. To get around this, we add the repo root directory to the import search path and set __package__ so the
@@ -16,8 +18,12 @@ if __name__ == "__main__" and (__package__ is None or __package__ == ''):
     import point_one.balena
     __package__ = "point_one.balena"
 
-from .device import get_device_uuid
+# Note: .device is imported only when we actually need to resolve a device, so pass-through commands (balena push, etc.)
+# do not pay for it. The Balena SDK itself, which is much slower to import, is only loaded if a lookup needs the API
+# (see device.py).
 from ..utils.argument_parser import ArgumentParser
+from . import profiling
+from .commands import find_device_name
 
 __logger = logging.getLogger("point_one.balena.cli")
 
@@ -26,17 +32,10 @@ def find_balena_cli():
     # Get the root directory of this repo.
     repo_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..'))
 
-    # Find the default CLI path. If that path is not in this repo, assume it's the actual Balena CLI.
-    try:
-        cli_path = str(subprocess.check_output(["which", "balena"]).decode('utf-8').strip())
-        if not cli_path.startswith(repo_dir):
-            return cli_path
-    except subprocess.CalledProcessError:
-        raise RuntimeError('Unable to find Balena CLI on the system path.')
-
-    # Otherwise, search through PATH to find the CLI.
-    paths = os.environ["PATH"].split(":")
-    for path in paths:
+    # Search through PATH to find the first CLI executable that is not in this repo, same as `which balena` but without
+    # forking a separate process. If this wrapper is installed as `balena` on the PATH, this skips over it and finds the
+    # actual Balena CLI.
+    for path in os.environ.get("PATH", "").split(os.pathsep):
         cli_path = os.path.join(path, 'balena')
         if (os.path.exists(cli_path) and os.path.isfile(cli_path) and os.access(cli_path, os.X_OK) and
                 not cli_path.startswith(repo_dir)):
@@ -45,54 +44,390 @@ def find_balena_cli():
     raise RuntimeError('Unable to find Balena CLI on the system path.')
 
 
+def _load_accounts(account_names=None):
+    # Get the accounts to search if an accounts file is present (see accounts.py), or None to use the default account.
+    from . import accounts
+    if not account_names and not accounts.is_configured():
+        return None
+
+    loaded_accounts = accounts.load_accounts(names=account_names)
+    if len(loaded_accounts) == 0:
+        raise RuntimeError("No usable accounts found in '%s'." % accounts.get_accounts_path())
+    return loaded_accounts
+
+
+def _run_cache_command(args, account_names=None):
+    action = args[0] if len(args) > 0 else None
+    if action == 'refresh':
+        accounts = _load_accounts(account_names)
+        if accounts is not None:
+            # Note: Importing .accounts does not import the Balena SDK, but refreshing an account does.
+            from .accounts import refresh_accounts
+            counts = refresh_accounts(accounts, full='--full' in args[1:])
+            for account in accounts:
+                if account.name in counts:
+                    print("Cached %d devices for account '%s'." % (counts[account.name], account.name))
+            return 0 if len(counts) == len(accounts) else 1
+
+        from .device import refresh_device_cache
+        num_devices = refresh_device_cache(full='--full' in args[1:])
+        print('Cached %d devices.' % num_devices)
+    elif action == 'clear':
+        from . import cache
+        num_removed = cache.clear_devices()
+        print('Removed %d device cache file(s).' % num_removed)
+    else:
+        __logger.error("Error: Unrecognized cache command. Expected 'balena cache refresh' or 'balena cache clear'.")
+        return 1
+    return 0
+
+
+def _run_daemon_command(args, verbose=0):
+    from . import cache, daemon
+
+    action = args[0] if len(args) > 0 else None
+    if action == 'start':
+        status = daemon.get_status()
+        if status is not None:
+            print('Resolver daemon already running (pid %d).' % status['pid'])
+            return 0
+
+        # Start the daemon in a new session so it keeps running after this process (and the terminal) exits.
+        log_path = os.path.join(cache.get_cache_dir(), 'resolver.log')
+        os.makedirs(os.path.dirname(log_path), mode=0o700, exist_ok=True)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daemon.py')]
+        if verbose > 0:
+            command.append('-' + 'v' * verbose)
+        with open(log_path, 'a') as log_file:
+            proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log_file, stderr=log_file,
+                                    start_new_session=True)
+
+        # Wait for the daemon to list the devices and start listening.
+        start_time = time.time()
+        while time.time() - start_time < 60.0:
+            if proc.poll() is not None:
+                __logger.error("Error: Resolver daemon exited unexpectedly. See '%s' for details." % log_path)
+                return 1
+
+            status = daemon.get_status()
+            if status is not None:
+                print('Resolver daemon started (pid %d, %d devices).' % (status['pid'], status['num_devices']))
+                return 0
+            time.sleep(0.1)
+
+        __logger.error("Error: Timed out waiting for resolver daemon to start. See '%s' for details." % log_path)
+        return 1
+    elif action == 'stop':
+        if daemon.stop():
+            print('Resolver daemon stopped.')
+        else:
+            print('Resolver daemon not running.')
+        return 0
+    elif action == 'status':
+        status = daemon.get_status()
+        if status is None:
+            print('Resolver daemon not running.')
+            return 1
+        else:
+            print('Resolver daemon running (pid %d): %d devices, updated %.0f seconds ago, %d requests served.' %
+                  (status['pid'], status['num_devices'], status['index_age_sec'], status['request_count']))
+            return 0
+    else:
+        __logger.error("Error: Unrecognized daemon command. Expected 'balena daemon start', 'balena daemon stop', or "
+                       "'balena daemon status'.")
+        return 1
+
+
+def _run_pool_command(args):
+    from . import pool
+
+    action = args[0] if len(args) > 0 else None
+    if action == 'status':
+        sessions = pool.list_sessions()
+        if len(sessions) == 0:
+            print('No pooled connections.')
+        for session in sessions:
+            print('%s  %s  port %d, opened %.0f seconds ago (pid %d)' %
+                  (session['uuid'], 'running' if session['running'] else 'stale  ', session['port'],
+                   time.time() - session['start_time'], session['pid']))
+        return 0
+    elif action == 'stop':
+        uuids = args[1:] if len(args) > 1 else [session['uuid'] for session in pool.list_sessions()]
+        for uuid in uuids:
+            if pool.stop_session(uuid):
+                print('Closed pooled connection to %s.' % uuid)
+            else:
+                print('No pooled connection to %s.' % uuid)
+        return 0
+    else:
+        __logger.error("Error: Unrecognized pool command. Expected 'balena pool status' or 'balena pool stop [UUID]'.")
+        return 1
+
+
+def _get_pooled_ssh_command(args, id_index, cli_path, idle_timeout_sec=None):
+    # Get an `ssh` command to run a `balena device ssh` command through a pooled connection to the device, starting a
+    # new connection if needed (see pool.py). Returns None if the command should be run with the Balena CLI instead.
+    from . import pool
+
+    ssh_command = pool.get_ssh_command(args, id_index)
+    if ssh_command is None:
+        __logger.debug("Command not supported by pooled connections. Using Balena CLI.")
+        return None
+
+    uuid = args[id_index]
+    remote_args, ssh_options = ssh_command
+    with profiling.span('pool_session'):
+        session = pool.get_session(uuid)
+        if session is None:
+            session = pool.start_session(uuid, cli_path, idle_timeout_sec=idle_timeout_sec)
+        else:
+            __logger.debug("Using existing pooled connection to %s." % uuid)
+
+    if session is None:
+        __logger.warning("Warning: Unable to open pooled connection to device. Using Balena CLI. See '%s' for "
+                         "details." % pool.get_log_path(uuid))
+        return None
+    else:
+        return pool.get_client_command(session, remote_args, ssh_options)
+
+
+def _format_suggestions(devices):
+    if len(devices) > 0:
+        return " Did you mean: %s?" % ", ".join([d['device_name'] for d in devices])
+    else:
+        return ""
+
+
+def _format_ambiguous(result):
+    from .accounts import describe_device, get_candidate_accounts
+    message = "\n    ".join([describe_device(device) for device in result.candidates])
+    account_names = get_candidate_accounts(result)
+    if len(account_names) > 1:
+        message += "\nMatching devices were found in multiple accounts (%s)." % ", ".join(account_names)
+    return message
+
+
+def _resolve_device(name_or_uuid, is_name=None, use_cache=True, use_daemon=True, parallel=False, accounts=None):
+    # Returns the device UUID, and the account it belongs to if `accounts` is specified.
+    #
+    # If there are multiple accounts, search them all. The resolver daemon only knows about the default account.
+    if accounts is not None:
+        from .accounts import resolve
+        from .index import AMBIGUOUS, FOUND
+
+        result = resolve([name_or_uuid], accounts=accounts, is_name=is_name, check_exact_match=True,
+                         use_cache=use_cache)[0]
+        if result.status == FOUND:
+            return result.uuid, next(account for account in accounts if account.name == result.account)
+        elif result.status == AMBIGUOUS:
+            __logger.warning("Found multiple devices matching query string:\n    %s" % _format_ambiguous(result))
+            raise ValueError("Found multiple devices matching query string.")
+        else:
+            raise ValueError("No device found matching query string.%s" % _format_suggestions(result.candidates))
+
+    # Try the resolver daemon first, if it is running. That avoids importing the SDK entirely.
+    if use_daemon:
+        from . import daemon
+        from .index import AMBIGUOUS, FOUND
+
+        with profiling.span('daemon_query'):
+            results = daemon.resolve([name_or_uuid], is_name=is_name, check_exact_match=True)
+        if results is not None:
+            result = results[0]
+            if result.status == FOUND:
+                return result.uuid, None
+            elif result.status == AMBIGUOUS:
+                __logger.warning("Found multiple devices matching query string:\n    %s" %
+                                 "\n    ".join(["%(device_name)s (%(uuid)s)" % device
+                                                for device in result.candidates]))
+                raise ValueError("Found multiple devices matching query string.")
+            else:
+                raise ValueError("No device found matching query string.%s" % _format_suggestions(result.candidates))
+
+    with profiling.span('import_device'):
+        from .device import get_device_uuid
+    return get_device_uuid(name_or_uuid, is_name=is_name, check_exact_match=True, use_cache=use_cache,
+                           use_daemon=False, parallel=parallel), None
+
+
+def _resolve_devices(identifiers, is_name=None, use_cache=True, use_daemon=True, accounts=None):
+    if accounts is not None:
+        from .accounts import resolve
+        return resolve(identifiers, accounts=accounts, is_name=is_name, check_exact_match=True, use_cache=use_cache)
+
+    if use_daemon:
+        from . import daemon
+        with profiling.span('daemon_query'):
+            results = daemon.resolve(identifiers, is_name=is_name, check_exact_match=True)
+        if results is not None:
+            return results
+
+    with profiling.span('import_device'):
+        from .device import get_device_uuids
+    return get_device_uuids(identifiers, is_name=is_name, check_exact_match=True, use_cache=use_cache,
+                            use_daemon=False)
+
+
+def _run_uuid_command(args, is_name=None, use_cache=True, use_daemon=True, accounts=None):
+    parser = ArgumentParser(prog='balena uuid', description="""\
+Print the UUIDs of one or more devices and exit. If no devices are specified, or
+if the device is -, read newline-delimited device names/UUIDs from stdin.""")
+    parser.add_argument('identifiers', nargs='*', metavar='NAME_OR_UUID',
+                        help="The (partial or complete) device names or UUIDs to query.")
+    parser.add_argument('-f', '--format', choices=('auto', 'uuid', 'tsv', 'json', 'jsonl'), default='auto',
+                        help="The output format. 'uuid' prints one UUID per line, 'tsv' prints the query, status, "
+                             "UUID, and name for each device. 'json' prints a list of results, including the "
+                             "candidate devices for ambiguous queries and suggestions for devices that were not "
+                             "found, and 'jsonl' prints the same results one per line. If there are multiple "
+                             "accounts, JSON results also include the account of each device. 'auto' uses 'uuid' for "
+                             "a single device and 'tsv' otherwise.")
+    options = parser.parse_args(args)
+
+    identifiers = options.identifiers
+    if len(identifiers) == 0 or identifiers == ['-']:
+        if len(identifiers) == 0 and sys.stdin.isatty():
+            __logger.error("Error: Device name/UUID not specified.")
+            return 1
+
+        identifiers = [line.strip() for line in sys.stdin]
+        identifiers = [identifier for identifier in identifiers if identifier != '']
+
+    from .index import AMBIGUOUS, FOUND, query_result_to_json
+    with profiling.span('resolve_devices'):
+        results = _resolve_devices(identifiers, is_name=is_name, use_cache=use_cache, use_daemon=use_daemon,
+                                   accounts=accounts)
+
+    output_format = options.format
+    if output_format == 'auto':
+        output_format = 'uuid' if len(results) == 1 else 'tsv'
+
+    # Note: Print results directly to stdout, not using the logger, so the output is easy to parse.
+    if output_format == 'json':
+        print(json.dumps([query_result_to_json(result) for result in results], indent=2))
+    elif output_format == 'jsonl':
+        for result in results:
+            print(json.dumps(query_result_to_json(result)))
+    elif output_format == 'tsv':
+        for result in results:
+            print('\t'.join((result.query, result.status, result.uuid or '', result.name or '')))
+    else:
+        for result in results:
+            if result.status == FOUND:
+                print(result.uuid)
+            elif result.status == AMBIGUOUS:
+                __logger.error("Error: Found multiple devices matching '%s':\n    %s" %
+                               (result.query, _format_ambiguous(result)))
+            else:
+                __logger.error("Error: No device found matching '%s'.%s" %
+                               (result.query, _format_suggestions(result.candidates)))
+
+    return 0 if all(result.status == FOUND for result in results) else 1
+
+
+def _run_fan_out(args, patterns=(), list_file=None, is_name=None, use_cache=True, use_daemon=True, max_jobs=None,
+                 timeout_sec=None, accounts=None):
+    from . import accounts as accounts_module, fanout
+    with profiling.span('import_device'):
+        from .device import FOUND, Device, find_devices, get_device_index, get_device_uuids
+
+    if not fanout.has_placeholder(args):
+        __logger.error("Error: Command must include a {} placeholder for the device UUID.")
+        return 1
+
+    # Split the requested devices into wildcard patterns (rover-*) and individual device names/UUIDs.
+    identifiers = []
+    wildcard_patterns = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            wildcard_patterns.append(pattern)
+        else:
+            identifiers.append(pattern)
+
+    if list_file is not None:
+        if list_file == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(list_file, 'r') as f:
+                lines = f.readlines()
+        identifiers.extend([line.strip() for line in lines if line.strip() != ''])
+
+    # Resolve everything using a single device listing (per account, if there are several).
+    devices = []
+    device_index = None
+    device_indexes = None
+    if len(wildcard_patterns) > 0:
+        with profiling.span('get_device_index'):
+            if accounts is not None:
+                device_indexes = accounts_module.get_device_indexes(accounts, use_cache=use_cache)
+            else:
+                device_index = get_device_index(use_cache=use_cache)
+        for pattern in wildcard_patterns:
+            if accounts is not None:
+                matches = accounts_module.find_devices(pattern, accounts=accounts, device_indexes=device_indexes)
+            else:
+                matches = find_devices(pattern, device_index=device_index)
+            if len(matches) == 0:
+                __logger.warning("Warning: No devices found matching '%s'." % pattern)
+            devices.extend(matches)
+
+    if len(identifiers) > 0:
+        with profiling.span('resolve_devices'):
+            if accounts is not None:
+                results = accounts_module.resolve(identifiers, accounts=accounts, is_name=is_name,
+                                                  check_exact_match=True, use_cache=use_cache)
+            else:
+                results = get_device_uuids(identifiers, is_name=is_name, check_exact_match=True, use_cache=use_cache,
+                                           use_daemon=use_daemon, device_index=device_index)
+        failed = [result for result in results if result.status != FOUND]
+        if len(failed) > 0:
+            for result in failed:
+                __logger.error("Error: Unable to resolve '%s' (%s)." % (result.query, result.status))
+            return 1
+        if accounts is not None:
+            devices.extend([accounts_module.AccountDevice(result.uuid, result.name, result.account)
+                            for result in results])
+        else:
+            devices.extend([Device(result.uuid, result.name) for result in results])
+
+    # Remove duplicates (e.g., a device matching more than one pattern).
+    unique_devices = []
+    seen_uuids = set()
+    for device in devices:
+        if device['uuid'] not in seen_uuids:
+            seen_uuids.add(device['uuid'])
+            unique_devices.append(device)
+
+    if len(unique_devices) == 0:
+        __logger.error("Error: No devices found.")
+        return 1
+
+    # Run the command for each device with the credentials of the account it belongs to.
+    env_fn = None
+    if accounts is not None:
+        account_envs = {account.name: dict(os.environ, **accounts_module.get_cli_environment(account))
+                        for account in accounts if any(d.account == account.name for d in unique_devices)}
+        env_fn = lambda device: account_envs[device.account]
+
+    with profiling.span('find_balena_cli'):
+        cli_path = find_balena_cli()
+    with profiling.span('run_on_devices'):
+        results = fanout.run_on_devices(cli_path, args, unique_devices,
+                                        max_jobs=fanout.DEFAULT_MAX_JOBS if max_jobs is None else max_jobs,
+                                        timeout_sec=timeout_sec, env_fn=env_fn)
+    profiling.count('devices_run', len(unique_devices))
+    fanout.print_summary(results)
+    return 0 if all(result.status == fanout.SUCCESS for result in results) else 1
+
+
 def _convert_legacy_commands(args):
     if args[0] in ('ssh', 'tunnel', 'logs'):
         args.insert(0, 'device')
 
 
 def _find_device_name(args, return_command=False):
-    # Function to find the first argument that does not start with - or --.
-    def find_first_non_dash(arg_list):
-        for i, arg in enumerate(arg_list):
-            if not arg.startswith('-'):
-                return i
-        raise ValueError('Device name/UUID not specified.')
-
-    # Get the name of the CLI command.
-    command = args[0]
-    args = args[1:]
-
-    # If this is a device-targeting command, try to find the name/UUID argument.
-    id_index = None
-    if command == 'device':
-        __logger.debug("Locating name/UUID for '%s' command." % command)
-
-        # For `balena device`, the first argument can be either a device name or a sub-command.
-        first_arg_index = find_first_non_dash(args)
-        sub_commands = ['deactivate', 'identify', 'local-mode', 'logs', 'move', 'os-update', 'pin', 'public-url',
-                        'purge', 'reboot', 'rename', 'restart', 'rm', 'shutdown', 'ssh', 'start-service',
-                        'stop-service', 'track-fleet', 'tunnel']
-        if args[first_arg_index] in sub_commands:
-            id_index = find_first_non_dash(args[first_arg_index + 1:]) + (first_arg_index + 1)
-        else:
-            id_index = first_arg_index
-    # balena ssh/tunnel/logs are all legacy commands, and have been removed from recent versions of the Balena CLI in
-    # favor of balena device ssh, etc. We still support them for convenience.
-    #
-    # balena uuid is a custom command for this script, used to print out the device UUID and exit.
-    elif command in ('uuid', 'ssh', 'tunnel', 'logs'):
-        __logger.debug("Locating name/UUID for '%s' command." % command)
-        id_index = find_first_non_dash(args)
-    else:
-        # Search for --device VALUE
-        for i, arg in enumerate(args):
-            if arg == '--device':
-                if i < len(args) - 1:
-                    id_index = i + 1
-                    break
-
+    id_index, command = find_device_name(args, return_command=True)
     if id_index is not None:
-        id_index += 1
+        __logger.debug("Found name/UUID argument for '%s' command: %s" % (command, args[id_index]))
 
     if return_command:
         return id_index, command
@@ -116,6 +451,41 @@ This tool also adds the following non-standard commands for convenience:
   balena which      # Print the location of the Balena CLI used by this
                     # application
   balena uuid NAME  # Print the UUID for the specified device name and exit
+  balena uuid NAME... [--format tsv|json|jsonl]
+                    # Print the UUIDs for multiple devices (or names read
+                    # from stdin) using a single device query
+  balena cache refresh [--full]
+                    # Update the local name/UUID cache, downloading only
+                    # the devices that changed since the last refresh
+                    # (or the entire device list with --full)
+  balena cache clear    # Delete the local name/UUID cache
+  balena daemon start|stop|status
+                    # Start/stop a background resolver process that keeps
+                    # the device list in memory for fast lookups
+  balena completion bash|zsh
+                    # Print a shell script enabling tab completion of device
+                    # names, e.g.: eval "$(balena completion bash)"
+
+To see where the time goes, use --profile to print a breakdown of each phase
+(SDK import, authentication, device queries, etc.) and the number of API
+requests and bytes received. Use --profile-file to append the same data to a
+JSON lines file instead, or set the BALENA_WRAPPER_PROFILE=1 or
+BALENA_WRAPPER_PROFILE_FILE=<path> environment variables.
+
+Device lookups are answered from the local cache when possible. The cache
+lifetime can be set (in seconds) with the BALENA_WRAPPER_CACHE_TTL environment
+variable (0 disables the cache).
+
+If your devices are spread across several accounts or servers, list them in
+~/.config/point_one/balena/accounts.json (or $BALENA_WRAPPER_ACCOUNTS). Devices
+are then looked up in all accounts at once, and the Balena CLI is run with the
+credentials of the account the device belongs to. Use --account to select
+specific accounts.
+
+To run a command on many devices in parallel, use --each or --each-file, and
+use {} in place of the device UUID ({name} is replaced with the device name):
+  balena --each 'rover-*' device restart {}
+  balena --each-file devices.txt -j 16 --timeout 60 ssh {} "uptime"
 
 To pass arguments directly to the Balena CLI that overlap with arguments to this
 program, you can use the -- separator:
@@ -135,14 +505,70 @@ program, you can use the -- separator:
     group.add_argument('--quiet', action='store_true',
                        help="Do not print the UUID of the specified device on success.")
 
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Do not use the local device cache, always query the Balena API.")
+    parser.add_argument('--no-daemon', action='store_true',
+                        help="Do not use the resolver daemon, even if it is running.")
+    parser.add_argument('--parallel', action='store_true',
+                        help="If the device cannot be resolved locally, run the Balena API queries at the same time "
+                             "instead of one after another. This reduces latency at the cost of additional requests.")
+    parser.add_argument('--account', metavar='NAME', action='append', default=[],
+                        help="Only search this account from the accounts file (see README.md). May be specified "
+                             "multiple times. If a single account is specified, commands that do not target a device "
+                             "are also run with that account's credentials.")
+
+    pool_group = parser.add_argument_group('Connection pooling options')
+    pool_group.add_argument(
+        '--pool', action='store_true', default=None,
+        help="Run `balena device ssh` commands through a persistent connection to the device, which is reused by "
+             "later commands for the same device. Enabled by default if BALENA_WRAPPER_POOL=1 is set.")
+    pool_group.add_argument(
+        '--no-pool', action='store_false', dest='pool',
+        help="Do not use a pooled connection, even if BALENA_WRAPPER_POOL is set.")
+    pool_group.add_argument(
+        '--pool-idle-timeout', type=float, metavar='SEC', default=None,
+        help="Close a pooled connection after it has been unused for this many seconds (default: 600, or "
+             "BALENA_WRAPPER_POOL_IDLE_TIMEOUT).")
+
+    fan_out_group = parser.add_argument_group('Multi-device options')
+    fan_out_group.add_argument(
+        '--each', metavar='PATTERN', action='append', default=[],
+        help="Run the command on each device matching a device name, UUID, or wildcard pattern (e.g., 'rover-*'). "
+             "May be specified multiple times.")
+    fan_out_group.add_argument(
+        '--each-file', metavar='FILE',
+        help="Run the command on each device listed in a file (one name/UUID per line). Use - to read from stdin.")
+    fan_out_group.add_argument(
+        '-j', '--jobs', type=int, default=8,
+        help="The maximum number of devices to run on concurrently when using --each or --each-file.")
+    fan_out_group.add_argument(
+        '--timeout', type=float, default=None,
+        help="The maximum time (in seconds) to allow the command to run on each device when using --each or "
+             "--each-file.")
+
+    parser.add_argument('--profile', action='store_true',
+                        help="Print a timing breakdown of each phase of the command to stderr on exit.")
+    parser.add_argument('--profile-file', metavar='FILE',
+                        help="Append timing data for the command to a JSON lines file on exit.")
+
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Print verbose/trace debugging messages.")
 
     parser.add_argument('args', nargs=argparse.REMAINDER)
 
-    options = parser.parse_args()
+    # Enable profiling as early as possible if requested by environment variables. The --profile arguments are handled
+    # below, after parsing.
+    profiling.enable_from_env()
+
+    with profiling.span('parse_args'):
+        options = parser.parse_args()
 
-    # Strip out the -- if present.
+    if options.profile or options.profile_file is not None:
+        profiling.enable(print_report=options.profile, output_path=options.profile_file)
+
+    # Strip out the -- if present. Pooled `device ssh` commands use a `--` after the device to separate the command to
+    # run on the host OS (see pool.get_ssh_command()), so keep a copy with only a leading `--` removed for them.
+    pool_args = options.args[1:] if options.args[:1] == ['--'] else list(options.args)
     options.args = [arg for arg in options.args if arg != '--']
 
     # Enable verbose logging if requested.
@@ -160,18 +586,90 @@ program, you can use the -- separator:
         parser.print_help()
         sys.exit(0)
 
+    # Note: Only the command name is recorded, not the device name or other arguments.
+    profiling.set_info('command', options.args[0])
+
+    if options.name:
+        is_name = True
+    elif options.uuid:
+        is_name = False
+    else:
+        is_name = None
+
+    # balena uuid is a custom command for this script, used to print out one or more device UUIDs and exit.
+    if options.args[0] == 'uuid':
+        try:
+            sys.exit(_run_uuid_command(options.args[1:], is_name=is_name, use_cache=not options.no_cache,
+                                       use_daemon=not options.no_daemon, accounts=_load_accounts(options.account)))
+        except Exception as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
+
     # For convenience, convert legacy Balena CLI commands that are no longer supported:
     #   balena logs  -->  balena device logs
     #   balena ssh  -->  balena device ssh
     #   balena tunnel  -->  balena device tunnel
     _convert_legacy_commands(options.args)
+    _convert_legacy_commands(pool_args)
+
+    # If requested, run the command on multiple devices in parallel.
+    if len(options.each) > 0 or options.each_file is not None:
+        try:
+            sys.exit(_run_fan_out(options.args, patterns=options.each, list_file=options.each_file, is_name=is_name,
+                                  use_cache=not options.no_cache, use_daemon=not options.no_daemon,
+                                  max_jobs=options.jobs, timeout_sec=options.timeout,
+                                  accounts=_load_accounts(options.account)))
+        except KeyboardInterrupt:
+            sys.exit(130)
+        except Exception as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
 
     # If this is a device-targeting command, try to find the name/UUID argument. If an ID was found, try to convert it
     # to UUID (if necessary).
     id_index, command = _find_device_name(options.args, return_command=True)
 
-    if command in ('uuid', 'which'):
+    if command == 'which':
         options.quiet = True
+    elif command == 'cache':
+        try:
+            sys.exit(_run_cache_command(options.args[1:], account_names=options.account))
+        except Exception as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
+    elif command == 'daemon':
+        try:
+            sys.exit(_run_daemon_command(options.args[1:], verbose=options.verbose))
+        except Exception as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
+    elif command == 'pool':
+        try:
+            sys.exit(_run_pool_command(options.args[1:]))
+        except Exception as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
+    elif command == 'completion':
+        from . import completion
+        try:
+            # Print the script directly to stdout so it can be passed to eval.
+            sys.stdout.write(completion.get_shell_script(options.args[1] if len(options.args) > 1 else 'bash'))
+            sys.exit(0)
+        except ValueError as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
+
+    # If an accounts file is present, devices are resolved across all of the accounts listed in it, and the Balena CLI
+    # is run with the credentials of the account the device belongs to. If a single account was specified with
+    # --account, all commands are run with its credentials.
+    resolved_uuid = None
+    account = None
+    if len(options.account) == 1:
+        try:
+            account = _load_accounts(options.account)[0]
+        except Exception as e:
+            __logger.error("Error: %s" % str(e))
+            sys.exit(1)
 
     if id_index is not None and not options.no_query:
         # If this is an ssh command, check if the user specified a local IP or a .local domain name. If so, pass it
@@ -184,37 +682,76 @@ program, you can use the -- separator:
         # Otherwise, perform a device name/UUID lookup.
         except Exception:
             __logger.debug("Converting '%s' to device UUID." % options.args[id_index])
-            if options.name:
-                is_name = True
-            elif options.uuid:
-                is_name = False
-            else:
-                is_name = None
-
             try:
-                uuid = get_device_uuid(options.args[id_index], is_name=is_name, check_exact_match=True)
+                with profiling.span('resolve_device'):
+                    uuid, account = _resolve_device(options.args[id_index], is_name=is_name,
+                                                    use_cache=not options.no_cache, use_daemon=not options.no_daemon,
+                                                    parallel=options.parallel,
+                                                    accounts=_load_accounts(options.account))
+                if account is not None:
+                    __logger.debug("Using account '%s'." % account.name)
                 if not options.quiet:
                     # Note: Explicitly calling print(), not __logger.info(), so there's no logger format string stuff.
                     # That way the console output is always consistent and easy to parse programmatically if needed.
                     print('Found device: %s' % uuid)
                 options.args[id_index] = uuid
+                resolved_uuid = uuid
             except Exception as e:
                 __logger.error("Error: %s" % str(e))
                 sys.exit(1)
 
+    # Run the Balena CLI (and the pooled connection's tunnel, if any) with the credentials of the device's account.
+    if account is not None:
+        from .accounts import get_cli_environment
+        try:
+            os.environ.update(get_cli_environment(account))
+        except OSError as e:
+            __logger.error("Error: Unable to set up credentials for account '%s': %s" % (account.name, str(e)))
+            sys.exit(1)
+
     # Finally, find the path to the actual CLI and execute the command. Using find_balena_cli() allows us to install
     # this wrapper as either cli.py to be called directly on the PATH, a `balena` wrapper script before the actual CLI
     # on the PATH, or a Bash alias for `balena`.
-    cli_path = find_balena_cli()
+    with profiling.span('find_balena_cli'):
+        cli_path = find_balena_cli()
     if command == 'which':
         # Print the result directly to stdout, do not use logger and append a logging prefix and formatting.
         print(cli_path)
-    elif command == 'uuid':
-        # Print the result directly to stdout, do not use logger and append a logging prefix and formatting.
-        print(uuid)
     else:
-        options.args.insert(0, cli_path)
-        __logger.debug("Executing command: %s" % ' '.join(options.args))
-        cli = subprocess.Popen(options.args, stdin=sys.stdin.fileno(), stdout=sys.stdout.fileno(),
-                               stderr=sys.stderr.fileno())
-        sys.exit(cli.wait())
+        # If requested, run `balena device ssh` through a pooled connection to the device (see pool.py). Connections
+        # are only pooled for devices resolved through the Balena API, not local IP addresses/hostnames.
+        exec_args = None
+        if resolved_uuid is not None and os.name == 'posix':
+            from . import pool
+            if options.pool or (options.pool is None and pool.is_enabled()):
+                pool_id_index = find_device_name(pool_args)
+                pool_args[pool_id_index] = resolved_uuid
+                exec_args = _get_pooled_ssh_command(pool_args, pool_id_index, cli_path,
+                                                    idle_timeout_sec=options.pool_idle_timeout)
+
+        if exec_args is None:
+            exec_args = [cli_path] + options.args
+        __logger.debug("Executing command: %s" % ' '.join(exec_args))
+
+        # Replace this process with the Balena CLI, rather than running it as a child process and waiting for it to
+        # finish. That way the Python interpreter and the SDK are not kept in memory for the duration of long-running
+        # commands (balena device ssh, logs, etc.), and the CLI receives signals and owns the terminal directly. The
+        # argument list is passed through as is, without going through a shell.
+        #
+        # Exit handlers do not run after exec, so anything buffered must be flushed first.
+        if os.name == 'posix':
+            profiling.report()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                os.execvp(exec_args[0], exec_args)
+            except OSError as e:
+                __logger.error("Error: Unable to execute '%s': %s" % (exec_args[0], str(e)))
+                sys.exit(1)
+        else:
+            # os.exec*() is emulated on Windows by starting a new process and exiting immediately, which would return
+            # control to the user's shell while the CLI is still running. Wait for the CLI instead.
+            with profiling.span('child_process'):
+                exit_code = subprocess.call(exec_args)
+            profiling.set_info('exit_code', exit_code)
+            sys.exit(exit_code)
@@ -0,0 +1,57 @@
+# The layout of Balena CLI commands that target a device, shared by the wrapper (to find the device name/UUID argument
+# to convert) and the shell completion backend (to decide when to complete device names).
+#
+# Note: This module must not import anything. The completion backend imports it on every key press.
+
+# `balena device` sub-commands that take a device name/UUID as their first positional argument. If the first argument
+# to `balena device` is not one of these, it is the device itself (`balena device NAME`).
+DEVICE_SUB_COMMANDS = ['deactivate', 'identify', 'local-mode', 'logs', 'move', 'os-update', 'pin', 'public-url',
+                       'purge', 'reboot', 'rename', 'restart', 'rm', 'shutdown', 'ssh', 'start-service', 'stop-service',
+                       'track-fleet', 'tunnel']
+
+# Top-level commands that take a device name/UUID as their first positional argument.
+#
+# balena ssh/tunnel/logs are all legacy commands, and have been removed from recent versions of the Balena CLI in favor
+# of balena device ssh, etc. We still support them for convenience. balena uuid is a custom command for this wrapper,
+# used to print out the device UUID and exit.
+DEVICE_COMMANDS = ('uuid', 'ssh', 'tunnel', 'logs')
+
+
+def find_device_name(args, return_command=False):
+    # Function to find the first argument that does not start with - or --.
+    def find_first_non_dash(arg_list):
+        for i, arg in enumerate(arg_list):
+            if not arg.startswith('-'):
+                return i
+        raise ValueError('Device name/UUID not specified.')
+
+    # Get the name of the CLI command.
+    command = args[0]
+    args = args[1:]
+
+    # If this is a device-targeting command, try to find the name/UUID argument.
+    id_index = None
+    if command == 'device':
+        # For `balena device`, the first argument can be either a device name or a sub-command.
+        first_arg_index = find_first_non_dash(args)
+        if args[first_arg_index] in DEVICE_SUB_COMMANDS:
+            id_index = find_first_non_dash(args[first_arg_index + 1:]) + (first_arg_index + 1)
+        else:
+            id_index = first_arg_index
+    elif command in DEVICE_COMMANDS:
+        id_index = find_first_non_dash(args)
+    else:
+        # Search for --device VALUE
+        for i, arg in enumerate(args):
+            if arg == '--device':
+                if i < len(args) - 1:
+                    id_index = i + 1
+                    break
+
+    if id_index is not None:
+        id_index += 1
+
+    if return_command:
+        return id_index, command
+    else:
+        return id_index
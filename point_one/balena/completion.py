@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+# Relative imports don't usually work when running a Python file as a script since the file is not considered to be part
+# of a package. To get around this, we add the repo root directory to the import search path and set __package__ so the
+# interpreter tries the relative imports based on `<__package__>.__main__` instead of just `__main__`.
+if __name__ == "__main__" and (__package__ is None or __package__ == ''):
+    repo_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    sys.path.append(repo_dir)
+    import point_one.balena
+    __package__ = "point_one.balena"
+
+from . import refresh
+from .commands import DEVICE_SUB_COMMANDS, find_device_name
+
+# Shell completion for device names and UUIDs.
+#
+# The shell calls this script (`completion.py complete CWORD WORDS...`) every time the user presses TAB, so it must
+# answer in a few milliseconds, without network access. Whenever the device list is saved to the device cache, we also
+# write a completion snapshot: sorted text files of device names and UUIDs, which can be searched with a binary search
+# directly on disk instead of loading the whole fleet.
+#
+# To keep startup time down, the shell runs this script with `python -S` (no site packages), and this module only
+# imports os, sys, time, and SHA-256 (and refresh.py and commands.py, which import nothing else). In particular, it does
+# not import cache.py or auth.py (which import logging, json, re, etc., more than doubling the startup time), so a few
+# small pieces of them are duplicated below.
+
+# The maximum number of completions to print.
+MAX_COMPLETIONS = 1000
+
+# Wrapper options (see cli.py) that take a value. Used to skip over the wrapper's options to find the Balena command.
+_OPTIONS_WITH_VALUES = ('--each', '--each-file', '-j', '--jobs', '--timeout', '--profile-file', '--pool-idle-timeout',
+                        '--account')
+
+# Options whose value is a device name/UUID.
+_DEVICE_OPTIONS = ('--each', '--device')
+
+DEFAULT_BALENA_HOST = "balena-cloud.com"
+DEFAULT_CACHE_TTL_SEC = 3600.0
+
+
+def _get_cache_dir():
+    # Same as cache.get_cache_dir().
+    cache_dir = os.environ.get("BALENA_WRAPPER_CACHE_DIR", None)
+    if cache_dir is None:
+        xdg_cache_dir = os.environ.get("XDG_CACHE_HOME", None)
+        if not xdg_cache_dir:
+            xdg_cache_dir = os.path.expanduser("~/.cache")
+        cache_dir = os.path.join(xdg_cache_dir, "point_one", "balena")
+    return cache_dir
+
+
+def _get_cache_ttl():
+    # Same as cache.get_cache_ttl().
+    try:
+        return max(float(os.environ.get("BALENA_WRAPPER_CACHE_TTL", "") or DEFAULT_CACHE_TTL_SEC), 0.0)
+    except ValueError:
+        return DEFAULT_CACHE_TTL_SEC
+
+
+# hashlib loads OpenSSL, which takes longer than everything else this script does combined. CPython's built-in SHA-256
+# implementation is much faster to load, and is more than fast enough for hashing a token. It is a private module
+# (`_sha256`, or `_sha2` in Python >= 3.12), so it is only used if it exists and produces the same digests as hashlib.
+# Otherwise, we fall back to hashlib.
+_SHA256_ABC = 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+
+
+def _import_sha256():
+    for module_name in ('_sha2', '_sha256'):
+        try:
+            sha256 = getattr(__import__(module_name), 'sha256')
+            if sha256(b'abc').hexdigest() == _SHA256_ABC:
+                return sha256
+        except Exception:
+            pass
+
+    from hashlib import sha256
+    return sha256
+
+
+_sha256 = _import_sha256()
+
+
+def _get_cache_key():
+    # Same as cache.get_cache_key(auth.get_api_endpoint(), auth.get_auth_token()). Returns None if there is no auth
+    # token.
+    balena_host = os.environ.get("BALENARC_BALENA_URL", None) or DEFAULT_BALENA_HOST
+    api_endpoint = "https://api.%s/" % balena_host
+
+    auth_token = os.environ.get("BALENA_AUTH_TOKEN", None)
+    if auth_token is None:
+        try:
+            with open(os.path.expanduser("~/.balena/token"), "r") as f:
+                auth_token = f.read().strip()
+        except OSError:
+            try:
+                with open(os.path.expanduser("~/.balena/balena.cfg"), "r") as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith("token") and line[5:].lstrip().startswith("="):
+                            auth_token = line[5:].lstrip()[1:].strip()
+                            break
+            except OSError:
+                pass
+
+    if not auth_token:
+        return None
+
+    fingerprint = _sha256(auth_token.encode('utf-8')).hexdigest()[:16]
+    key = "%s\n%s" % (api_endpoint.rstrip('/'), fingerprint)
+    return _sha256(key.encode('utf-8')).hexdigest()[:24]
+
+
+def get_snapshot_paths(cache_key, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = _get_cache_dir()
+    prefix = os.path.join(cache_dir, "completion-%s" % cache_key)
+    return prefix + ".names", prefix + ".uuids"
+
+
+def _write_lines(path, lines):
+    import tempfile
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(line + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_snapshot(cache_key, devices, cache_dir=None):
+    # Write the completion snapshot for a list of (uuid, device_name) tuples. Called by cache.save_devices().
+    #
+    # Names are sorted by their UTF-8 encoding, since that is the order in which they are compared on disk.
+    names_path, uuids_path = get_snapshot_paths(cache_key, cache_dir=cache_dir)
+    names = sorted(set(name for _, name in devices if '\n' not in name), key=lambda n: n.encode('utf-8'))
+    uuids = sorted(uuid for uuid, _ in devices)
+    _write_lines(names_path, names)
+    _write_lines(uuids_path, uuids)
+
+
+def clear_snapshots(cache_key=None, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = _get_cache_dir()
+
+    num_removed = 0
+    try:
+        filenames = os.listdir(cache_dir)
+    except OSError:
+        return num_removed
+
+    prefix = "completion-" if cache_key is None else "completion-%s." % cache_key
+    for filename in filenames:
+        if filename.startswith(prefix):
+            try:
+                os.unlink(os.path.join(cache_dir, filename))
+                num_removed += 1
+            except OSError:
+                pass
+    return num_removed
+
+
+def find_prefix(path, prefix, limit=MAX_COMPLETIONS):
+    # Find all lines in a sorted file starting with `prefix`, using a binary search on the file contents so only a few
+    # blocks of the file are read, regardless of its size (similar to the `look` command).
+    prefix = prefix.encode('utf-8')
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return []
+
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        # Find the smallest offset whose next line is >= prefix. For an offset in the middle of a line, the "next line"
+        # is the one that starts after it.
+        def _line_at(offset):
+            if offset == 0:
+                f.seek(0)
+            else:
+                f.seek(offset - 1)
+                f.readline()
+            return f.readline()
+
+        lo = 0
+        hi = size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line = _line_at(mid)
+            if line != b'' and line.rstrip(b'\n') < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        results = []
+        line = _line_at(lo)
+        while line != b'' and line.startswith(prefix) and len(results) < limit:
+            results.append(line.rstrip(b'\n').decode('utf-8'))
+            line = f.readline()
+        return results
+
+
+def get_device_completions(prefix, cache_key=None, start_refresh=True):
+    # Complete a device name or UUID from the snapshot. If the snapshot is missing or stale, use whatever we have and
+    # start a refresh in the background, so up to date results are available next time.
+    if cache_key is None:
+        cache_key = _get_cache_key()
+        if cache_key is None:
+            return []
+
+    cache_dir = _get_cache_dir()
+    names_path, uuids_path = get_snapshot_paths(cache_key, cache_dir=cache_dir)
+    if start_refresh:
+        try:
+            is_stale = time.time() - os.path.getmtime(names_path) > _get_cache_ttl()
+        except OSError:
+            is_stale = True
+        if is_stale:
+            refresh.start_background_refresh(cache_dir, cache_key)
+
+    completions = find_prefix(names_path, prefix)
+
+    # Only complete UUIDs once the user has started typing one. Otherwise, completing an empty string would list every
+    # UUID in the fleet alongside the names.
+    if prefix != '' and len(completions) < MAX_COMPLETIONS and all(c in '0123456789abcdef' for c in prefix):
+        completions.extend(find_prefix(uuids_path, prefix, limit=MAX_COMPLETIONS - len(completions)))
+
+    return completions
+
+
+def get_completions(words, cword, cache_key=None):
+    # Get completions for word `cword` of a `balena` command line, where `words[0]` is the command itself (`balena`).
+    # Returns an empty list if the word is not a device name/UUID, in which case the shell falls back to its default
+    # completion.
+    if cword < 1 or cword >= len(words):
+        return []
+
+    current = words[cword]
+    if current.startswith('-'):
+        return []
+    elif words[cword - 1] in _DEVICE_OPTIONS:
+        return get_device_completions(current, cache_key=cache_key)
+
+    # Skip over the wrapper's own options (--name, -j 8, etc.) to find the Balena command.
+    start = 1
+    while start < cword and words[start].startswith('-'):
+        if words[start] == '--':
+            start += 1
+            break
+        start += 2 if words[start] in _OPTIONS_WITH_VALUES else 1
+
+    if start >= cword:
+        return []
+
+    # Use the same rules the wrapper uses to find the device argument. Note that `balena uuid` accepts any number of
+    # devices.
+    args = words[start:cword + 1]
+    try:
+        id_index, command = find_device_name(args, return_command=True)
+    except (ValueError, IndexError):
+        return []
+
+    if command == 'uuid':
+        return get_device_completions(current, cache_key=cache_key)
+    elif id_index != len(args) - 1:
+        return []
+
+    completions = get_device_completions(current, cache_key=cache_key)
+
+    # The first argument to `balena device` may also be a sub-command.
+    if command == 'device' and all(arg.startswith('-') for arg in args[1:-1]):
+        completions = [c for c in DEVICE_SUB_COMMANDS if c.startswith(current)] + completions
+
+    return completions
+
+
+_BASH_SCRIPT = """\
+# Balena CLI wrapper device name completion. To enable, add the following to ~/.bashrc:
+#   eval "$(balena completion bash)"
+_balena_wrapper_complete() {
+    local IFS=$'\\n'
+    COMPREPLY=($("%(python)s" -S "%(script)s" complete "$COMP_CWORD" "${COMP_WORDS[@]}" 2>/dev/null))
+}
+complete -o default -F _balena_wrapper_complete balena
+"""
+
+_ZSH_SCRIPT = """\
+# Balena CLI wrapper device name completion. To enable, add the following to ~/.zshrc (after compinit):
+#   eval "$(balena completion zsh)"
+_balena_wrapper_complete() {
+    local -a completions
+    completions=("${(@f)$("%(python)s" -S "%(script)s" complete $((CURRENT - 1)) "${words[@]}" 2>/dev/null)}")
+    if [[ -n "${completions[1]}" ]]; then
+        compadd -Q -- "${completions[@]}"
+    else
+        _files
+    fi
+}
+compdef _balena_wrapper_complete balena
+"""
+
+
+def get_shell_script(shell):
+    if shell == 'bash':
+        template = _BASH_SCRIPT
+    elif shell == 'zsh':
+        template = _ZSH_SCRIPT
+    else:
+        raise ValueError("Unsupported shell '%s'. Expected bash or zsh." % shell)
+
+    return template % {'python': sys.executable, 'script': os.path.abspath(__file__)}
+
+
+if __name__ == "__main__":
+    # Note: Intentionally not using argparse, which is slow to import. Usage:
+    #   completion.py complete CWORD WORDS...
+    #   completion.py bash|zsh
+    if len(sys.argv) >= 3 and sys.argv[1] == 'complete':
+        try:
+            completions = get_completions(sys.argv[3:], int(sys.argv[2]))
+        except Exception:
+            # Never print errors into the user's command line.
+            completions = []
+        if len(completions) > 0:
+            sys.stdout.write('\n'.join(completions) + '\n')
+    elif len(sys.argv) == 2 and sys.argv[1] in ('bash', 'zsh'):
+        sys.stdout.write(get_shell_script(sys.argv[1]))
+    else:
+        sys.stderr.write("Usage: %s complete CWORD WORDS... | bash | zsh\n" % sys.argv[0])
+        sys.exit(1)
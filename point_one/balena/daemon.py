@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+# Relative imports don't usually work when running a Python file as a script since the file is not considered to be part
+# of a package. To get around this, we add the repo root directory to the import search path and set __package__ so the
+# interpreter tries the relative imports based on `<__package__>.__main__` instead of just `__main__`.
+if __name__ == "__main__" and (__package__ is None or __package__ == ''):
+    repo_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    sys.path.append(repo_dir)
+    import point_one.balena
+    __package__ = "point_one.balena"
+
+from . import cache
+from .auth import authenticate, get_api_endpoint, get_auth_token
+from .index import FOUND, Device, DeviceIndex, DeviceQueryResult
+from .sync import DeviceSync
+
+# Note: This module intentionally does not import the Balena SDK (or .device, which does) at the top level. The client
+# functions below are used by cli.py before deciding whether the SDK needs to be loaded at all.
+
+__logger = logging.getLogger("point_one.balena.daemon")
+
+# How long to wait for a response from the daemon before giving up and falling back to an in-process query. This is
+# generous since a query may trigger a live device listing if the daemon cannot resolve it from its current data.
+DEFAULT_REQUEST_TIMEOUT_SEC = 10.0
+
+# If a query cannot be resolved from the daemon's device index, the daemon will list all devices again before giving up,
+# as long as the index is older than this. That way new or renamed devices are found without waiting for the next
+# periodic refresh.
+MIN_LIVE_REFRESH_INTERVAL_SEC = 30.0
+
+# Minimum interval between periodic device index refreshes, regardless of the configured cache TTL.
+MIN_REFRESH_INTERVAL_SEC = 60.0
+
+
+def get_socket_path():
+    socket_path = os.environ.get("BALENA_WRAPPER_SOCKET", None)
+    if socket_path:
+        return socket_path
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", None)
+    if not runtime_dir:
+        runtime_dir = os.path.join(tempfile.gettempdir(), "point_one-balena-%d" % os.getuid())
+    return os.path.join(runtime_dir, "point_one-balena-resolver.sock")
+
+
+def _send_request(request, socket_path=None, timeout_sec=DEFAULT_REQUEST_TIMEOUT_SEC):
+    if socket_path is None:
+        socket_path = get_socket_path()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout_sec)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if len(chunk) == 0:
+                break
+            data += chunk
+    finally:
+        sock.close()
+
+    return json.loads(data.decode('utf-8'))
+
+
+def _query_daemon(request, socket_path=None, timeout_sec=DEFAULT_REQUEST_TIMEOUT_SEC):
+    # Send a request to the daemon. Returns None if the daemon is not running or did not respond, so the caller can
+    # fall back to an in-process query.
+    if socket_path is None:
+        socket_path = get_socket_path()
+
+    # Fast path: don't bother trying to connect if the daemon was never started.
+    if not os.path.exists(socket_path):
+        return None
+
+    try:
+        response = _send_request(request, socket_path=socket_path, timeout_sec=timeout_sec)
+    except (OSError, ValueError) as e:
+        __logger.debug("Resolver daemon unavailable: %s" % str(e))
+        return None
+
+    if 'error' in response:
+        __logger.debug("Resolver daemon returned an error: %s" % response['error'])
+        return None
+    else:
+        return response
+
+
+def resolve(identifiers, is_name=None, check_exact_match=False, auth_token=None, socket_path=None,
+            timeout_sec=DEFAULT_REQUEST_TIMEOUT_SEC):
+    if socket_path is None:
+        socket_path = get_socket_path()
+
+    # Don't bother looking up the auth token (which may mean reading the Balena CLI's config files) if the daemon was
+    # never started.
+    if not os.path.exists(socket_path):
+        return None
+
+    # The daemon is logged in with a specific account. Include the account identity in the request so we do not get
+    # answers for the wrong account if the token changed since the daemon was started.
+    if auth_token is None:
+        try:
+            auth_token = get_auth_token()
+        except Exception:
+            return None
+
+    request = {
+        'op': 'resolve',
+        'endpoint': get_api_endpoint(),
+        'token': cache.get_token_fingerprint(auth_token),
+        'queries': list(identifiers),
+        'is_name': is_name,
+        'check_exact_match': check_exact_match,
+    }
+    response = _query_daemon(request, socket_path=socket_path, timeout_sec=timeout_sec)
+    if response is None:
+        return None
+
+    __logger.debug("Resolved %d queries using resolver daemon." % len(request['queries']))
+    return [DeviceQueryResult(r['query'], r['status'], r['uuid'], r['name'],
+                              [Device(c[0], c[1]) for c in r['candidates']])
+            for r in response['results']]
+
+
+def get_status(socket_path=None):
+    return _query_daemon({'op': 'status'}, socket_path=socket_path, timeout_sec=2.0)
+
+
+def stop(socket_path=None):
+    return _query_daemon({'op': 'shutdown'}, socket_path=socket_path, timeout_sec=2.0) is not None
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # Each line is a JSON request. A client may send any number of requests on a single connection.
+        for line in self.rfile:
+            try:
+                response = self.server.resolver.handle_request(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+            # Note: shutdown() blocks until serve_forever() returns, so it cannot be called from a request thread. We
+            # wait until the response has been sent so the client knows the request succeeded.
+            if self.server.resolver.shutdown_requested:
+                threading.Thread(target=self.server.resolver.shutdown).start()
+                break
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+# A long-running resolver process holding a single authenticated SDK session and a device index, listening for name/UUID
+# queries on a Unix socket.
+#
+# The SDK object may be any object implementing `models.device.get_all()`, e.g., a FakeBalena for testing.
+class ResolverDaemon(object):
+    def __init__(self, balena=None, auth_token=None, socket_path=None, refresh_interval_sec=None, use_cache=True):
+        self.logger = logging.getLogger("point_one.balena.daemon")
+
+        if auth_token is None:
+            auth_token = get_auth_token()
+        if balena is None:
+            # The daemon may run for a long time, so make sure the token is valid before we start serving requests.
+            balena = authenticate(auth_token, validate=True)
+
+        self.balena = balena
+        self.auth_token = auth_token
+        self.endpoint = get_api_endpoint()
+        self.token_fingerprint = cache.get_token_fingerprint(auth_token)
+        self.socket_path = socket_path if socket_path is not None else get_socket_path()
+        self.use_cache = use_cache
+
+        if refresh_interval_sec is None:
+            refresh_interval_sec = cache.get_cache_ttl()
+        self.refresh_interval_sec = max(refresh_interval_sec, MIN_REFRESH_INTERVAL_SEC)
+
+        # After the initial listing, only changes to the fleet are listed on each refresh. If the cache is enabled, the
+        # sync state is shared with `balena cache refresh`.
+        self.device_sync = DeviceSync(
+            state_path=cache.get_sync_state_path(self.endpoint, auth_token) if use_cache else None,
+            api_endpoint=self.endpoint)
+
+        self.index = DeviceIndex()
+        self.index_time = 0.0
+        self.request_count = 0
+        self.shutdown_requested = False
+
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._server = None
+
+    def refresh(self, max_age_sec=None):
+        with self._refresh_lock:
+            # If several requests asked for a refresh at the same time, only the first one needs to do it.
+            if max_age_sec is not None and time.time() - self.index_time <= max_age_sec:
+                return
+
+            self.logger.debug("Refreshing device index.")
+            if self.use_cache:
+                # Share the listing with any wrapper processes that missed the cache at the same time.
+                devices = cache.fetch_devices(self.endpoint, self.auth_token,
+                                              lambda: self.device_sync.sync(self.balena).devices, max_age_sec=0.0)
+            else:
+                devices = self.device_sync.sync(self.balena).devices
+            self.index = DeviceIndex(devices)
+            self.index_time = time.time()
+            self.logger.debug("Loaded %d devices." % len(self.index))
+
+    def resolve(self, identifiers, is_name=None, check_exact_match=False):
+        index = self.index
+        results = [index.match(q, is_name=is_name, check_exact_match=check_exact_match) for q in identifiers]
+
+        # If anything could not be resolved, list the devices again in case the index is out of date.
+        unresolved = [i for i, result in enumerate(results) if result.status != FOUND]
+        if len(unresolved) > 0 and time.time() - self.index_time > MIN_LIVE_REFRESH_INTERVAL_SEC:
+            self.refresh(max_age_sec=MIN_LIVE_REFRESH_INTERVAL_SEC)
+            index = self.index
+            for i in unresolved:
+                results[i] = index.match(identifiers[i], is_name=is_name, check_exact_match=check_exact_match)
+
+        return results
+
+    def handle_request(self, request):
+        self.request_count += 1
+
+        op = request.get('op', None)
+        if op == 'resolve':
+            if request.get('endpoint', None) != self.endpoint or request.get('token', None) != self.token_fingerprint:
+                return {'error': 'Account mismatch.'}
+
+            results = self.resolve(request['queries'], is_name=request.get('is_name', None),
+                                   check_exact_match=request.get('check_exact_match', False))
+            return {'results': [{'query': r.query, 'status': r.status, 'uuid': r.uuid, 'name': r.name,
+                                 'candidates': [(c.uuid, c.name) for c in r.candidates]}
+                                for r in results]}
+        elif op == 'status':
+            return {'pid': os.getpid(), 'endpoint': self.endpoint, 'num_devices': len(self.index),
+                    'index_age_sec': time.time() - self.index_time, 'request_count': self.request_count}
+        elif op == 'shutdown':
+            self.shutdown_requested = True
+            return {'pid': os.getpid()}
+        else:
+            return {'error': "Unrecognized request '%s'." % op}
+
+    def _refresh_periodically(self):
+        while not self._stop_event.wait(self.refresh_interval_sec):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.warning("Unable to refresh device index: %s" % str(e))
+
+    def _bind(self):
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir != '':
+            os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+
+        # Remove the socket left behind by a previous daemon that did not exit cleanly, but do not steal the socket
+        # from a daemon that is still running.
+        if os.path.exists(self.socket_path):
+            try:
+                _send_request({'op': 'status'}, socket_path=self.socket_path, timeout_sec=1.0)
+                raise RuntimeError("Resolver daemon already running on '%s'." % self.socket_path)
+            except (OSError, ValueError):
+                os.unlink(self.socket_path)
+
+        # Restrict access to the current user: the socket answers queries using this user's credentials.
+        old_umask = os.umask(0o077)
+        try:
+            server = _UnixServer(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+        server.resolver = self
+        return server
+
+    def serve_forever(self):
+        self.refresh()
+
+        self._server = self._bind()
+        refresh_thread = threading.Thread(target=self._refresh_periodically, daemon=True)
+        refresh_thread.start()
+
+        self.logger.info("Resolver daemon listening on '%s' (%d devices)." % (self.socket_path, len(self.index)))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop_event.set()
+            self._server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""\
+Run a resolver daemon that keeps an authenticated Balena session and an index of
+all devices in memory, and answers device name/UUID queries over a Unix socket.
+When the daemon is running, the Balena CLI wrapper and get_device_uuid() will
+use it automatically.""")
+    parser.add_argument('--socket', type=str, default=None,
+                        help="The path to the Unix socket to listen on. Defaults to $BALENA_WRAPPER_SOCKET, or a "
+                             "per-user path in $XDG_RUNTIME_DIR or the system temp directory.")
+    parser.add_argument('--refresh-interval', type=float, default=None,
+                        help="The interval (in seconds) at which to refresh the device list. Defaults to the device "
+                             "cache TTL.")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Print verbose/trace debugging messages.")
+
+    options = parser.parse_args()
+
+    if options.verbose == 1:
+        logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+        logging.getLogger("point_one.balena").setLevel(logging.DEBUG)
+    elif options.verbose > 1:
+        # Enable debug messages all libraries including the Balena SDK.
+        logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+    try:
+        resolver = ResolverDaemon(socket_path=options.socket, refresh_interval_sec=options.refresh_interval)
+        resolver.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        __logger.error("Error: %s" % str(e))
+        sys.exit(1)
@@ -1,16 +1,11 @@
 from argparse import ArgumentParser
+from concurrent.futures import Future
+import json
 import logging
 import os
 import re
 import sys
-
-import balena
-try:
-    from balena.base_request import BaseRequest
-    have_base_request = True
-except:
-    have_base_request = False
-from balena.exceptions import DeviceNotFound
+import threading
 
 # Relative imports don't usually work when running a Python file as a script since the file is not considered to be part
 # of a package. To get around this, we add the repo root directory to the import search path and set __package__ so the
@@ -21,50 +16,400 @@ if __name__ == "__main__" and (__package__ is None or __package__ == ''):
     import point_one.balena
     __package__ = "point_one.balena"
 
-from .auth import authenticate
+from . import accounts, cache, daemon, profiling, sync
+from .auth import authenticate, get_api_endpoint, get_auth_token
+from .fleet import iter_devices, list_devices
+from .index import AMBIGUOUS, FOUND, Device, DeviceIndex, DeviceQueryResult, get_case_insensitive_match
+from .search import compile_name_matcher
 
 __logger = logging.getLogger("point_one.balena.device")
 
+# Note: The Balena SDK is slow to import (several hundred milliseconds), so it is only imported when a query actually
+# needs the API (see _import_sdk()). Queries answered from the device cache or a DeviceIndex never load it.
 
-def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None, auth_token=None,
-                    check_exact_match=False):
-    if balena is None:
-        balena = authenticate(auth_token)
+# Whether the SDK still provides balena.base_request (SDK < 13.0.0). Set by _import_sdk().
+have_base_request = None
 
-    # If this might be a 128 - bit UUID, first see if we can find a device with it.
-    name = None
-    uuid = None
+# When listing devices for a partial match without saving the result to the cache, stop once this many candidates have
+# been found and the result is known to be ambiguous.
+MAX_AMBIGUOUS_CANDIDATES = 10
+
+
+def _fetch_devices(balena, auth_token, max_age_sec=0.0, stop_event=None, list_fn=None):
+    # List all devices and save them to the cache. If another wrapper process is already listing devices for the same
+    # account, wait for its result instead of repeating the same requests (see cache.fetch_devices()). We only log in if
+    # we end up listing the devices ourselves.
+    #
+    # `list_fn(balena)` may be specified to list the devices some other way (e.g., an incremental sync).
+    def _list_devices():
+        sdk = balena
+        if sdk is None:
+            with profiling.span('authenticate'):
+                sdk = authenticate(auth_token)
+        if list_fn is not None:
+            return list_fn(sdk)
+        with profiling.span('list_devices'):
+            return list_devices(sdk, stop_event=stop_event)
+
+    with profiling.span('fetch_devices'):
+        return cache.fetch_devices(get_api_endpoint(), auth_token, _list_devices, max_age_sec=max_age_sec)
+
+
+def refresh_device_cache(balena=None, auth_token=None, full=False):
+    # Update the device cache. By default, only devices created, renamed, or deleted since the last refresh are listed
+    # (see sync.py). If `full` is set, list the entire fleet.
+    if auth_token is None:
+        auth_token = get_auth_token()
+
+    def _sync_devices(sdk):
+        with profiling.span('sync_devices'):
+            return sync.sync_devices(sdk, get_api_endpoint(), auth_token, full=full).devices
+
+    __logger.debug("Refreshing device cache.")
+    devices = _fetch_devices(balena, auth_token, list_fn=_sync_devices)
+    return len(devices)
+
+
+def _import_sdk():
+    global have_base_request
+    with profiling.span('import_sdk'):
+        import balena.exceptions
+        if have_base_request is None:
+            try:
+                import balena.base_request
+                have_base_request = True
+            except ImportError:
+                have_base_request = False
+    return balena
+
+
+def _get_not_found_error(suggestions):
+    # Note: DeviceNotFound is raised for compatibility with callers that catch the SDK exception.
+    from balena.exceptions import DeviceNotFound
+    message = "No device found matching query string."
+    if len(suggestions) > 0:
+        message += " Did you mean: %s?" % ", ".join([d['device_name'] for d in suggestions])
+    return DeviceNotFound(message)
+
+
+def _scan_devices(balena, name_or_uuid, search_names=True, search_uuids=True, max_candidates=None, stop_event=None):
+    # Stream the device list, keeping only devices that match the query string. Only one page of devices is held in
+    # memory at a time.
+    #
+    # Devices whose names merely contain the query string (or match it as a wildcard pattern) are kept too, for the
+    # substring search below, but only prefix matches count toward `max_candidates`.
+    name_matcher = compile_name_matcher(name_or_uuid) if search_names else None
+    candidates = []
+    num_prefix_matches = 0
+    for entry in iter_devices(balena, stop_event=stop_event):
+        is_prefix_match = ((search_names and entry[1].startswith(name_or_uuid)) or
+                           (search_uuids and entry[0].startswith(name_or_uuid)))
+        if is_prefix_match or (name_matcher is not None and name_matcher(entry[1])):
+            candidates.append(entry)
+            if is_prefix_match:
+                num_prefix_matches += 1
+                if max_candidates is not None and num_prefix_matches >= max_candidates:
+                    __logger.debug("Found %d candidates for '%s'. Stopping device listing early." %
+                                   (num_prefix_matches, name_or_uuid))
+                    break
+    return candidates
+
+
+class _LiveQueries(object):
+    # The live API queries made by _run_live_queries(). Normally, each query is run when its result is needed. In
+    # parallel mode, queries are started ahead of time with submit(), each on its own thread, and get() waits for the
+    # result.
+    #
+    # Query threads are daemon threads, so a query that is still running (e.g., after an error in another query) never
+    # prevents the process from exiting.
+    def __init__(self, parallel=False):
+        self.parallel = parallel
+        self.stop_event = threading.Event()
+        self._futures = {}
+
+    def submit(self, key, func, *args, **kwargs):
+        if not self.parallel:
+            return
+
+        future = Future()
+
+        def _run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=_run, name='query_%s' % key, daemon=True).start()
+        self._futures[key] = future
+
+    def get(self, key, func, *args, **kwargs):
+        future = self._futures.pop(key, None)
+        if future is None:
+            return func(*args, **kwargs)
+        else:
+            return future.result()
+
+    def cancel(self):
+        # Discard the results of any queries still in progress. Device listings stop before requesting their next page.
+        self.stop_event.set()
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+
+def _run_live_queries(balena, name_or_uuid, is_name=None, auth_token=None, use_cache=True, parallel=False):
+    # Query the Balena API for the device, in order of precedence: an exact UUID match, an exact name match, and finally
+    # a listing of the fleet for the partial name/UUID searches in get_device_uuid(). Each step is only needed if the
+    # previous ones did not find a unique device. Returns (uuid, name, device_index), where uuid and name are None if
+    # there was no exact match, and device_index is None if the fleet was not listed.
+    #
+    # In parallel mode, all of the queries that might be needed are started at once, so a lookup that misses the exact
+    # queries (e.g., a partial name like `cafe01`, which also looks like a partial UUID) takes about one round trip
+    # instead of three. The results are still used in the same order of precedence, so the outcome is the same as
+    # running the queries one at a time. As soon as the result is certain, any queries still in progress are cancelled.
+    # This trades extra requests (a fleet listing that may not be needed) for lower latency.
     uuid_like = re.match(r"^[a-fA-F0-9]+$", name_or_uuid)
     full_uuid_length = len(name_or_uuid) == 32
-    if uuid_like and not is_name and full_uuid_length:
-        __logger.debug("Trying absolute UUID query for '%s'." % name_or_uuid)
+    query_uuid = uuid_like and not is_name and full_uuid_length
+    query_name = is_name is not False
+    search_uuids = not is_name and uuid_like and not full_uuid_length
 
-        try:
-            name = balena.models.device.get_name(name_or_uuid)
-            uuid = name_or_uuid
-            __logger.debug("Found device %s (%s) by absolute UUID." % (name, uuid))
-        except DeviceNotFound:
-            pass
+    DeviceNotFound = _import_sdk().exceptions.DeviceNotFound
+    queries = _LiveQueries(parallel=parallel)
 
-    # See if this is an exact match for a device name.
-    if uuid is None and is_name is not False:
-        __logger.debug("Trying device name query for '%s'." % name_or_uuid)
+    def _list_devices_for_query(max_candidates):
+        if use_cache:
+            # We are paying for a full device listing anyway: save it so subsequent queries can be answered locally.
+            return _fetch_devices(balena, auth_token, stop_event=queries.stop_event)
+        else:
+            # Otherwise, we only need to keep devices that match the query. If there is no exact name match, the result
+            # is certain to be ambiguous once we find 2 or more candidates, so we can stop listing devices early.
+            with profiling.span('scan_devices'):
+                return _scan_devices(balena, name_or_uuid, search_names=query_name, search_uuids=search_uuids,
+                                     max_candidates=max_candidates, stop_event=queries.stop_event)
 
-        try:
-            devices = balena.models.device.get_by_name(name_or_uuid)
-            if len(devices) == 1:
-                device = devices[0]
-                uuid = device['uuid']
-                name = device['device_name']
+    if parallel:
+        __logger.debug("Starting parallel queries for '%s'." % name_or_uuid)
+        if query_uuid:
+            queries.submit('uuid', balena.models.device.get_name, name_or_uuid)
+        if query_name:
+            queries.submit('name', balena.models.device.get_by_name, name_or_uuid)
+        if not have_base_request:
+            # The number of exact name matches is not known yet, so the listing cannot stop early.
+            queries.submit('list', _list_devices_for_query, None)
+
+    name = None
+    uuid = None
+    device_index = None
+    try:
+        # If this might be a 128 - bit UUID, first see if we can find a device with it.
+        if query_uuid:
+            __logger.debug("Trying absolute UUID query for '%s'." % name_or_uuid)
+
+            try:
+                with profiling.span('query_uuid'):
+                    name = queries.get('uuid', balena.models.device.get_name, name_or_uuid)
+                uuid = name_or_uuid
                 __logger.debug("Found device %s (%s) by absolute UUID." % (name, uuid))
-        except DeviceNotFound:
-            pass
+            except DeviceNotFound:
+                pass
+
+        # See if this is an exact match for a device name.
+        num_exact_names = 0
+        if uuid is None and query_name:
+            __logger.debug("Trying device name query for '%s'." % name_or_uuid)
+
+            try:
+                with profiling.span('query_name'):
+                    devices = queries.get('name', balena.models.device.get_by_name, name_or_uuid)
+                num_exact_names = len(devices)
+                if len(devices) == 1:
+                    device = devices[0]
+                    uuid = device['uuid']
+                    name = device['device_name']
+                    __logger.debug("Found device %s (%s) by absolute UUID." % (name, uuid))
+            except DeviceNotFound:
+                pass
+
+        # If we haven't found the device yet, list all devices, needed for partial name/UUID searches. This is
+        # inefficient if there are a lot of devices, but is needed in more recent versions of the Balena SDK. See
+        # get_device_uuid() for the explanation.
+        #
+        # Only the device UUID and name are requested, and devices are listed one page at a time.
+        if uuid is None and not have_base_request:
+            all_devices = queries.get('list', _list_devices_for_query,
+                                      MAX_AMBIGUOUS_CANDIDATES if num_exact_names == 0 else None)
+            with profiling.span('build_index'):
+                device_index = DeviceIndex(all_devices)
+    finally:
+        queries.cancel()
+
+    return uuid, name, device_index
+
+
+def get_device_index(balena=None, auth_token=None, use_cache=True, cache_ttl_sec=None):
+    # Load the device list from the cache if possible. Otherwise, list all devices and update the cache.
+    if use_cache and (balena is None or auth_token is not None):
+        if auth_token is None:
+            auth_token = get_auth_token()
+
+        cached_devices = cache.load_devices(get_api_endpoint(), auth_token, ttl_sec=cache_ttl_sec)
+        if cached_devices is not None:
+            return DeviceIndex(cached_devices)
+    else:
+        use_cache = False
+
+    __logger.debug("Listing all devices.")
+    if use_cache:
+        all_devices = _fetch_devices(balena, auth_token)
+    else:
+        if balena is None:
+            balena = authenticate(auth_token)
+        all_devices = list_devices(balena)
+    return DeviceIndex(all_devices)
+
 
-    # If we haven't found the device yet, list all devices, needed for partial name/UUID searches below. This is
-    # inefficient if there are a lot of devices, but is needed in more recent versions of the Balena SDK. See below for
-    # the explanation.
-    if uuid is None and not have_base_request:
-        all_devices = balena.models.device.get_all()
+def get_devices(**kwargs):
+    # List all devices as Device records, sorted by name. Takes the same arguments as get_device_index().
+    return list(get_device_index(**kwargs))
+
+
+def find_devices(pattern, device_index=None, **kwargs):
+    # Find all devices whose names match a case-insensitive shell-style wildcard pattern (e.g., rover-*).
+    #
+    # Note that, unlike get_device_uuid(), a cached device list is considered authoritative here: there is no way to
+    # know if a device matching the pattern is missing from the cache. Use `use_cache=False` to force a live query.
+    if device_index is None:
+        device_index = get_device_index(**kwargs)
+
+    # The index narrows the search using the literal parts of the pattern, so only a handful of names are compared
+    # against the full pattern.
+    return sorted(device_index.search(pattern), key=lambda d: d.name)
+
+
+def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None, auth_token=None,
+                    check_exact_match=False, use_cache=True, cache_ttl_sec=None, device_index=None, use_daemon=True,
+                    parallel=False):
+    # If an accounts file is present, and the caller did not specify an account, search all accounts (see accounts.py).
+    if balena is None and auth_token is None and device_index is None and accounts.is_configured():
+        result = accounts.resolve([name_or_uuid], is_name=is_name, check_exact_match=check_exact_match,
+                                  use_cache=use_cache, cache_ttl_sec=cache_ttl_sec)[0]
+        if result.status == FOUND:
+            __logger.debug("Found device %s (%s) in account '%s'." % (result.name, result.uuid, result.account))
+            if return_name:
+                return result.uuid, result.name
+            else:
+                return result.uuid
+        elif result.status == AMBIGUOUS:
+            __logger.warning("Found multiple devices matching query string:\n    %s" %
+                             "\n    ".join([accounts.describe_device(device) for device in result.candidates]))
+            account_names = accounts.get_candidate_accounts(result)
+            if len(account_names) > 1:
+                raise ValueError("Found devices matching query string in multiple accounts (%s)." %
+                                 ", ".join(account_names))
+            raise ValueError("Found multiple devices matching query string.")
+        else:
+            raise _get_not_found_error(result.candidates)
+
+    # If the resolver daemon is running, let it answer the query. It keeps an up-to-date device index in memory, so its
+    # answer is final. If it is not running, or was started for a different account, continue below.
+    if use_daemon and balena is None and device_index is None:
+        with profiling.span('daemon_query'):
+            results = daemon.resolve([name_or_uuid], is_name=is_name, check_exact_match=check_exact_match,
+                                     auth_token=auth_token)
+        if results is not None:
+            result = results[0]
+            if result.status == FOUND:
+                __logger.debug("Found device %s (%s) using resolver daemon." % (result.name, result.uuid))
+                if return_name:
+                    return result.uuid, result.name
+                else:
+                    return result.uuid
+            elif result.status == AMBIGUOUS:
+                __logger.warning("Found multiple devices matching query string:\n    %s" %
+                                 "\n    ".join(["%(device_name)s (%(uuid)s)" % device
+                                                for device in result.candidates]))
+                raise ValueError("Found multiple devices matching query string.")
+            else:
+                raise _get_not_found_error(result.candidates)
+
+    # First, try to resolve the device from the local device cache, which does not require any network requests. If the
+    # device is not in the cache, or if the result is ambiguous, fall back to a live query below.
+    #
+    # Note that the cache is keyed by account. If the caller provided their own SDK object without a token, we don't
+    # know which account it belongs to, so we skip the cache.
+    #
+    # Alternatively, the caller may provide a device index built from a fleet listing (e.g., for batch queries). In
+    # that case, the index is considered to be up to date and is used in place of the live queries below.
+    if device_index is not None:
+        use_cache = False
+        local_index = device_index
+        cache_is_stale = False
+    elif use_cache and (balena is None or auth_token is not None):
+        if auth_token is None:
+            auth_token = get_auth_token()
+
+        # If the cache has expired recently, we still use it to answer the query immediately, and update it in the
+        # background for next time (stale-while-revalidate). A device may have been renamed, added, or re-provisioned
+        # since then, so only an exact UUID or exact name match is trusted from expired data: partial and substring
+        # matches, like anything else that does not resolve, fall through to the live queries below.
+        with profiling.span('load_cache'):
+            cached_devices, cache_is_stale = cache.load_devices_stale_ok(get_api_endpoint(), auth_token,
+                                                                         ttl_sec=cache_ttl_sec)
+
+        # If there is no cache, but another process is listing the fleet right now (e.g., parallel CI jobs that all
+        # missed the cache), wait for its result instead of listing the fleet again. That listing is up to date, so
+        # if it does not resolve the query, it is used in place of the live queries below.
+        if cached_devices is None:
+            with profiling.span('wait_for_fetch'):
+                fetched_devices = cache.wait_for_fetch(get_api_endpoint(), auth_token)
+            if fetched_devices is not None:
+                device_index = DeviceIndex(fetched_devices)
+                use_cache = False
+
+        if device_index is not None:
+            local_index = device_index
+        else:
+            local_index = DeviceIndex(cached_devices) if cached_devices is not None else None
+    else:
+        use_cache = False
+        local_index = None
+        cache_is_stale = False
+
+    if local_index is not None:
+        with profiling.span('resolve_local'):
+            if cache_is_stale:
+                device = local_index.resolve_exact(name_or_uuid, is_name=is_name)
+            else:
+                device = local_index.resolve(name_or_uuid, is_name=is_name)
+        if device is not None:
+            uuid = device['uuid']
+            name = device['device_name']
+            __logger.debug("Found device %s (%s) in local device index." % (name, uuid))
+            if cache_is_stale:
+                with profiling.span('start_refresh'):
+                    cache.refresh_in_background(get_api_endpoint(), auth_token)
+            if return_name:
+                return uuid, name
+            else:
+                return uuid
+        else:
+            __logger.debug("Local device index did not resolve '%s'." % name_or_uuid)
+
+    if balena is None and device_index is None:
+        with profiling.span('authenticate'):
+            balena = authenticate(auth_token)
+
+    # If we couldn't resolve the device locally, query the Balena API.
+    name = None
+    uuid = None
+    uuid_like = re.match(r"^[a-fA-F0-9]+$", name_or_uuid)
+    full_uuid_length = len(name_or_uuid) == 32
+    if device_index is None:
+        uuid, name, device_index = _run_live_queries(balena, name_or_uuid, is_name=is_name, auth_token=auth_token,
+                                                     use_cache=use_cache, parallel=parallel)
 
     # If this might be a device name, look now.
     devices_by_name = []
@@ -86,13 +431,15 @@ def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None,
         #   devices_by_name = balena.models.device.get_all({"$filter": f"startswith(device_name, '{name_or_uuid}')"})
         # however, that just results in a 500 error from the server as of SDK 15.1.4.
         #
-        # For now, the best we can do is query all devices with get_all() (called above), and then filter the result in
-        # Python. Calling get_all() can be a lot less efficient if the organization has a lot of devices, but there's
-        # not much we can do currently.
-        if not have_base_request:
-            devices_by_name = [d for d in all_devices if d['device_name'].startswith(name_or_uuid)]
+        # For now, the best we can do is list all devices (above), and then filter the result in Python. Listing all
+        # devices can be a lot less efficient if the organization has a lot of devices, but there's not much we can do
+        # currently. The listing is loaded into a DeviceIndex, so the filtering itself is a binary search rather than a
+        # scan of every device.
+        if device_index is not None:
+            with profiling.span('filter_by_name'):
+                devices_by_name = device_index.find_by_name_prefix(name_or_uuid)
         else:
-            request = BaseRequest()
+            request = _import_sdk().base_request.BaseRequest()
             devices_by_name = request.request('device', 'GET',
                                               raw_query="$filter=startswith(device_name, '%s')" % name_or_uuid,
                                               endpoint=balena.settings.get('pine_endpoint'))['d']
@@ -125,10 +472,11 @@ def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None,
 
         # Similar to the partial-name search, the SDK does not have a way to do a partial UUID search. See above for
         # details.
-        if not have_base_request:
-            devices_by_uuid = [d for d in all_devices if d['uuid'].startswith(name_or_uuid)]
+        if device_index is not None:
+            with profiling.span('filter_by_uuid'):
+                devices_by_uuid = device_index.find_by_uuid_prefix(name_or_uuid)
         else:
-            request = BaseRequest()
+            request = _import_sdk().base_request.BaseRequest()
             devices_by_name = request.request('device', 'GET',
                                               raw_query="$filter=startswith(uuid, '%s')" % name_or_uuid,
                                               endpoint=balena.settings.get('pine_endpoint'))['d']
@@ -145,6 +493,24 @@ def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None,
             __logger.warning("Found multiple devices matching partial UUID string:\n    %s" %
                              "\n    ".join(["%(device_name)s (%(uuid)s)" % device for device in devices_by_uuid]))
 
+    # If nothing starts with the query string, look for device names containing it anywhere (e.g., "0142-lidar"), or
+    # matching it if it is a wildcard pattern (e.g., "rover-*-0142-lidar"). This is case-insensitive, and an exact match
+    # other than case is accepted if it is unique.
+    if (uuid is None and is_name is not False and device_index is not None and
+            len(devices_by_name) + len(devices_by_uuid) == 0):
+        __logger.debug("Trying substring device name query for '%s'." % name_or_uuid)
+        with profiling.span('search_names'):
+            devices_by_name = device_index.search(name_or_uuid)
+
+        device = get_case_insensitive_match(name_or_uuid, devices_by_name)
+        if device is not None:
+            uuid = device['uuid']
+            name = device['device_name']
+            __logger.debug("Found device %s (%s) by case-insensitive name." % (name, uuid))
+        elif len(devices_by_name) > 1:
+            __logger.warning("Found multiple devices matching name string:\n    %s" %
+                             "\n    ".join(["%(device_name)s (%(uuid)s)" % device for device in devices_by_name]))
+
     if uuid is None:
         num_devices = len(devices_by_name) + len(devices_by_uuid)
         if num_devices > 1:
@@ -156,7 +522,7 @@ def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None,
             uuid = devices_by_uuid[0]['uuid']
             name = devices_by_uuid[0]['device_name']
         else:
-            raise DeviceNotFound("No device found matching query string.")
+            raise _get_not_found_error(device_index.suggest(name_or_uuid) if device_index is not None else [])
 
     __logger.debug("Returning %s (%s)." % (name, uuid))
     if return_name:
@@ -165,6 +531,78 @@ def get_device_uuid(name_or_uuid, is_name=None, return_name=False, balena=None,
         return uuid
 
 
+def get_device(name_or_uuid, **kwargs):
+    # Same as get_device_uuid(), but returns a Device record.
+    kwargs['return_name'] = True
+    uuid, name = get_device_uuid(name_or_uuid, **kwargs)
+    return Device(uuid, name)
+
+
+def get_device_uuids(identifiers, is_name=None, balena=None, auth_token=None, check_exact_match=False, use_cache=True,
+                     cache_ttl_sec=None, device_index=None, use_daemon=True):
+    identifiers = list(identifiers)
+
+    if balena is None and auth_token is None and device_index is None and accounts.is_configured():
+        return accounts.resolve(identifiers, is_name=is_name, check_exact_match=check_exact_match, use_cache=use_cache,
+                                cache_ttl_sec=cache_ttl_sec)
+
+    if use_daemon and balena is None and device_index is None:
+        results = daemon.resolve(identifiers, is_name=is_name, check_exact_match=check_exact_match,
+                                 auth_token=auth_token)
+        if results is not None:
+            return results
+
+    results = [None] * len(identifiers)
+
+    # Resolve as many queries as possible from the local device cache. As with get_device_uuid(), only unambiguous
+    # results are accepted from the cache, and only exact UUID or name matches from an expired cache. Everything else is
+    # resolved against a live listing below.
+    if device_index is None and use_cache and (balena is None or auth_token is not None):
+        if auth_token is None:
+            auth_token = get_auth_token()
+
+        with profiling.span('load_cache'):
+            cached_devices, cache_is_stale = cache.load_devices_stale_ok(get_api_endpoint(), auth_token,
+                                                                         ttl_sec=cache_ttl_sec)
+        if cached_devices is not None:
+            cached_index = DeviceIndex(cached_devices)
+            resolve = cached_index.resolve_exact if cache_is_stale else cached_index.resolve
+            for i, name_or_uuid in enumerate(identifiers):
+                device = resolve(name_or_uuid, is_name=is_name)
+                if device is not None:
+                    results[i] = DeviceQueryResult(name_or_uuid, FOUND, device.uuid, device.name, [])
+            __logger.debug("Resolved %d/%d queries from device cache." %
+                           (len(identifiers) - results.count(None), len(identifiers)))
+
+            # If everything was resolved from an expired cache, update it in the background. Otherwise, it is updated
+            # by the live listing below.
+            if cache_is_stale and None not in results:
+                with profiling.span('start_refresh'):
+                    cache.refresh_in_background(get_api_endpoint(), auth_token)
+    else:
+        use_cache = False
+
+    # For anything left, authenticate and list the fleet once, regardless of how many queries remain. If another process
+    # is already listing the fleet, use its result instead.
+    if None in results and device_index is None:
+        __logger.debug("Listing all devices to resolve %d queries." % results.count(None))
+        if use_cache:
+            all_devices = _fetch_devices(balena, auth_token)
+        else:
+            if balena is None:
+                with profiling.span('authenticate'):
+                    balena = authenticate(auth_token)
+            with profiling.span('list_devices'):
+                all_devices = list_devices(balena)
+        device_index = DeviceIndex(all_devices)
+
+    for i, name_or_uuid in enumerate(identifiers):
+        if results[i] is None:
+            results[i] = device_index.match(name_or_uuid, is_name=is_name, check_exact_match=check_exact_match)
+
+    return results
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument('name_or_uuid', type=str,
@@ -172,6 +610,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--get-name', action='store_true',
                         help="Return the name of the located device instead of its UUID.")
+    parser.add_argument('--json', action='store_true',
+                        help="Print the UUID and name of the located device as JSON.")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('--name', action='store_true',
@@ -179,6 +619,12 @@ if __name__ == "__main__":
     group.add_argument('--uuid', action='store_true',
                        help="If specified, treat the string as a UUID and do not attempt a name lookup.")
 
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Do not use the local device cache, always query the Balena API.")
+    parser.add_argument('--parallel', action='store_true',
+                        help="Run the live API queries at the same time instead of one after another. This reduces "
+                             "latency at the cost of additional requests.")
+
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Print verbose/trace debugging messages.")
 
@@ -201,11 +647,14 @@ if __name__ == "__main__":
         is_name = None
 
     try:
-        uuid, name = get_device_uuid(options.name_or_uuid, is_name=is_name, return_name=True)
-        if options.get_name:
-            print(name)
+        device = get_device(options.name_or_uuid, is_name=is_name, use_cache=not options.no_cache,
+                            parallel=options.parallel)
+        if options.json:
+            print(json.dumps(device.to_json()))
+        elif options.get_name:
+            print(device.name)
         else:
-            print(uuid)
+            print(device.uuid)
     except Exception as e:
         __logger.error("Error: %s" % str(e))
         sys.exit(1)
@@ -0,0 +1,144 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+__logger = logging.getLogger("point_one.balena.fanout")
+
+DEFAULT_MAX_JOBS = 8
+
+# Status values for FanOutResult.
+SUCCESS = 'ok'
+FAILED = 'failed'
+TIMED_OUT = 'timeout'
+ERROR = 'error'
+
+FanOutResult = namedtuple('FanOutResult', ['uuid', 'name', 'status', 'exit_code', 'elapsed_sec'])
+
+
+def expand_command(args, uuid, name):
+    # Replace {} (or {uuid}) with the device UUID and {name} with the device name in each argument.
+    return [arg.replace('{}', uuid).replace('{uuid}', uuid).replace('{name}', name) for arg in args]
+
+
+def has_placeholder(args):
+    return any('{}' in arg or '{uuid}' in arg for arg in args)
+
+
+def _kill_process_group(proc):
+    # Each command runs in its own process group so we can kill the CLI along with anything it started (e.g., ssh).
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def _run_one(cli_path, args, device, timeout_sec, output, output_lock, prefix_width, active_processes, env=None):
+    uuid = device['uuid']
+    name = device['device_name']
+    command = [cli_path] + expand_command(args, uuid, name)
+    prefix = ('[%s]' % name).ljust(prefix_width + 2) + ' '
+
+    __logger.debug("Executing command: %s" % ' '.join(command))
+    start_time = time.time()
+    try:
+        proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                start_new_session=True, env=env)
+    except OSError as e:
+        with output_lock:
+            output.write('%sError: %s\n' % (prefix, str(e)))
+            output.flush()
+        return FanOutResult(uuid, name, ERROR, None, time.time() - start_time)
+
+    # Kill the process if it runs past the timeout. The output loop below ends once the process's stdout closes.
+    timed_out = threading.Event()
+    timer = None
+    if timeout_sec is not None:
+        def _kill():
+            timed_out.set()
+            _kill_process_group(proc)
+        timer = threading.Timer(timeout_sec, _kill)
+        timer.daemon = True
+        timer.start()
+
+    active_processes.add(proc)
+    try:
+        # Stream output one line at a time, prefixed with the device name, so output from concurrent devices is
+        # interleaved by line rather than garbled.
+        for line in proc.stdout:
+            line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+            with output_lock:
+                output.write(prefix + line + '\n')
+                output.flush()
+        exit_code = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        active_processes.discard(proc)
+        proc.stdout.close()
+
+    elapsed_sec = time.time() - start_time
+    if timed_out.is_set():
+        status = TIMED_OUT
+    elif exit_code == 0:
+        status = SUCCESS
+    else:
+        status = FAILED
+    return FanOutResult(uuid, name, status, exit_code, elapsed_sec)
+
+
+def run_on_devices(cli_path, args, devices, max_jobs=DEFAULT_MAX_JOBS, timeout_sec=None, output=None, env_fn=None):
+    # If specified, `env_fn(device)` returns the environment to run the command for each device with (e.g., the
+    # credentials for the device's account). Otherwise, commands inherit this process's environment.
+    if output is None:
+        output = sys.stdout
+
+    devices = list(devices)
+    if len(devices) == 0:
+        return []
+
+    output_lock = threading.Lock()
+    prefix_width = max(len(d['device_name']) for d in devices)
+    max_jobs = max(1, min(max_jobs, len(devices)))
+
+    active_processes = set()
+
+    __logger.debug("Running command on %d devices (%d concurrent)." % (len(devices), max_jobs))
+    executor = ThreadPoolExecutor(max_workers=max_jobs)
+    futures = []
+    try:
+        for device in devices:
+            futures.append(executor.submit(_run_one, cli_path, args, device, timeout_sec, output, output_lock,
+                                           prefix_width, active_processes,
+                                           env_fn(device) if env_fn is not None else None))
+        return [future.result() for future in futures]
+    except KeyboardInterrupt:
+        # The child processes are in their own sessions and will not see the Ctrl-C, so stop them explicitly.
+        for future in futures:
+            future.cancel()
+        for proc in list(active_processes):
+            _kill_process_group(proc)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+
+def print_summary(results, output=None):
+    if output is None:
+        output = sys.stdout
+
+    name_width = max([len('Device')] + [len(r.name) for r in results])
+    output.write('\n%s  %-32s  %-7s  %4s  %8s\n' % ('Device'.ljust(name_width), 'UUID', 'Status', 'Exit', 'Time'))
+    for result in results:
+        exit_code = '-' if result.exit_code is None else str(result.exit_code)
+        output.write('%s  %-32s  %-7s  %4s  %7.1fs\n' % (result.name.ljust(name_width), result.uuid, result.status,
+                                                          exit_code, result.elapsed_sec))
+
+    num_success = len([r for r in results if r.status == SUCCESS])
+    output.write('\n%d/%d devices succeeded.\n' % (num_success, len(results)))
+    output.flush()
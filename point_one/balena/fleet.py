@@ -0,0 +1,93 @@
+import logging
+
+from . import profiling
+
+__logger = logging.getLogger("point_one.balena.fleet")
+
+# The number of devices requested per page when listing the fleet.
+DEFAULT_PAGE_SIZE = 1000
+
+# The only device fields needed for name/UUID resolution. Requesting just these fields (instead of the ~50 fields
+# returned by default) reduces the size of each device record in the API response by more than an order of magnitude.
+DEVICE_FIELDS = ('uuid', 'device_name')
+
+
+class ListingCancelled(Exception):
+    pass
+
+
+def iter_devices(balena, page_size=DEFAULT_PAGE_SIZE, fields=DEVICE_FIELDS, stop_event=None):
+    # List all devices accessible to the current user one page at a time, yielding a compact (uuid, device_name) tuple
+    # for each device. Pages are requested lazily as the caller consumes results, so only one page of devices is held in
+    # memory at a time, and the caller may stop early without fetching the rest of the fleet.
+    #
+    # Pages are selected by ID (`id > last ID seen`, see iter_device_pages()) rather than by offset. IDs are unique and
+    # do not change, so a device added or deleted during the listing cannot shift the remaining devices to a different
+    # page, where they would be missed or listed twice.
+    #
+    # If `stop_event` (a threading.Event) is set by another thread, ListingCancelled is raised before the next page is
+    # requested. This is an exception rather than the end of the listing, so a partial fleet is never mistaken for the
+    # complete one (e.g., and saved to the cache).
+    pages = iter_device_pages(balena, fields=fields, page_size=page_size, stop_event=stop_event)
+
+    # Older SDK versions do not accept query options. That can only be detected by the first request: a TypeError from
+    # a later page is a real error, and falling back then would list the devices already yielded a second time.
+    try:
+        first_page = next(pages, None)
+    except TypeError:
+        __logger.debug("SDK does not support device query options. Listing all devices.")
+        for device in balena.models.device.get_all():
+            yield device['uuid'], device['device_name']
+        return
+
+    if first_page is None:
+        return
+
+    for device in first_page:
+        yield device['uuid'], device['device_name']
+    for page in pages:
+        for device in page:
+            yield device['uuid'], device['device_name']
+
+
+def list_devices(balena, page_size=DEFAULT_PAGE_SIZE, stop_event=None):
+    return list(iter_devices(balena, page_size=page_size, stop_event=stop_event))
+
+
+def iter_device_pages(balena, fields, filters=None, page_size=DEFAULT_PAGE_SIZE, stop_event=None):
+    # List the devices matching `filters` (a pine $filter dict, e.g., `{'modified_at': {'$ge': timestamp}}`), yielding
+    # one page of device dicts with the requested fields at a time. Used for incremental sync (see sync.py).
+    #
+    # Pages are selected by ID (`id > last ID seen`) rather than by offset, so a device deleted during the listing
+    # cannot shift the remaining devices to an earlier page, where they would be missed.
+    fields = list(fields)
+    if 'id' not in fields:
+        fields.append('id')
+
+    last_id = None
+    while True:
+        if stop_event is not None and stop_event.is_set():
+            raise ListingCancelled()
+
+        page_filters = dict(filters) if filters is not None else {}
+        if last_id is not None:
+            page_filters['id'] = {'$gt': last_id}
+
+        options = {
+            '$select': fields,
+            '$orderby': 'id asc',
+            '$top': page_size,
+        }
+        if len(page_filters) > 0:
+            options['$filter'] = page_filters
+
+        with profiling.span('get_all_page'):
+            page = balena.models.device.get_all(options)
+        __logger.debug("Received %d devices (after ID %s)." % (len(page), last_id))
+        profiling.count('devices_listed', len(page))
+        if len(page) > 0:
+            yield page
+
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['id']
@@ -0,0 +1,299 @@
+from bisect import bisect_left
+from collections import namedtuple
+import re
+import sys
+
+from .search import TrigramIndex
+
+_UUID_LIKE_RE = re.compile(r"^[a-fA-F0-9]+$")
+
+# Result status values for DeviceIndex.match() and get_device_uuids().
+FOUND = 'found'
+AMBIGUOUS = 'ambiguous'
+NOT_FOUND = 'not_found'
+
+# The result of a single device query. `uuid` and `name` are set if `status` is FOUND. `candidates` is the list of
+# matching devices (Device records) if `status` is AMBIGUOUS, or a list of similarly named devices if `status` is
+# NOT_FOUND. `account` is the name of the account the device was found in, if resolved across several accounts (see
+# accounts.py).
+DeviceQueryResult = namedtuple('DeviceQueryResult', ['query', 'status', 'uuid', 'name', 'candidates', 'account'],
+                               defaults=(None,))
+
+
+def query_result_to_json(result):
+    # Convert a DeviceQueryResult to a JSON-serializable dict, as printed by `balena uuid --format json`.
+    data = {'query': result.query, 'status': result.status, 'uuid': result.uuid, 'name': result.name,
+            'candidates': [Device.from_any(d).to_json() for d in result.candidates]}
+    if result.account is not None:
+        data['account'] = result.account
+    return data
+
+
+def _pack_uuid(uuid):
+    # Balena UUIDs are lowercase hex strings (32 characters, or 62 for some older devices). These are stored as raw
+    # bytes (16 bytes instead of a 32-character string), which sort in the same order as the hex strings. Anything else
+    # is stored as is.
+    #
+    # Note: bytes.fromhex() also accepts uppercase digits and whitespace, so we check that the UUID survives a round
+    # trip. This is much faster than checking it with a regex first.
+    try:
+        packed = bytes.fromhex(uuid)
+    except ValueError:
+        return uuid
+    return packed if packed.hex() == uuid else uuid
+
+
+# A compact record describing a single device: its UUID and name, the only fields needed to resolve device queries.
+#
+# An index of a large fleet keeps one of these per device for as long as the index exists (e.g., in the resolver
+# daemon), so they are kept as small as possible: the record uses __slots__ instead of a per-instance dict, the UUID is
+# stored as raw bytes, and names are interned, so devices with the same name (and the search index) share one string.
+#
+# For compatibility with code written for SDK device dicts, `device['uuid']` and `device['device_name']` also work.
+class Device(object):
+    __slots__ = ('_uuid', '_name')
+
+    def __init__(self, uuid, name):
+        self._uuid = _pack_uuid(uuid)
+        self._name = sys.intern(name)
+
+    @classmethod
+    def from_any(cls, device):
+        # Accept a Device, an SDK device dict, or a compact (uuid, name) pair, as stored in the device cache.
+        if isinstance(device, Device):
+            return device
+        elif isinstance(device, dict):
+            return cls(device['uuid'], device['device_name'])
+        else:
+            return cls(device[0], device[1])
+
+    @property
+    def uuid(self):
+        return self._uuid.hex() if isinstance(self._uuid, bytes) else self._uuid
+
+    @property
+    def name(self):
+        return self._name
+
+    # Same as `name`, matching the SDK field name.
+    device_name = name
+
+    def __getitem__(self, key):
+        if key == 'uuid':
+            return self.uuid
+        elif key == 'device_name':
+            return self._name
+        else:
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        if isinstance(other, Device):
+            return self._uuid == other._uuid and self._name == other._name
+        else:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash(self._uuid)
+
+    def __repr__(self):
+        return 'Device(uuid=%r, name=%r)' % (self.uuid, self._name)
+
+    def to_json(self):
+        return {'uuid': self.uuid, 'name': self._name}
+
+
+def get_case_insensitive_match(name, ranked_devices):
+    # Given a list of devices ranked by TrigramIndex.search(), return the device whose name matches exactly except for
+    # case, if there is exactly one.
+    name = name.lower()
+    exact_matches = [d for d in ranked_devices[:2] if d['device_name'].lower() == name]
+    return exact_matches[0] if len(exact_matches) == 1 else None
+
+
+# In-memory index of devices supporting exact and prefix lookups by name and UUID.
+#
+# The index is built once from a fleet listing (e.g., `balena.models.device.get_all()` or the device cache), and may
+# then be queried any number of times. Names and UUIDs are stored in sorted arrays, so each prefix lookup costs
+# O(log n + k), where k is the number of matching devices, rather than a scan of the entire fleet.
+#
+# Devices may be given as SDK device dicts, (uuid, name) pairs, or Device records. All lookups return Device records.
+class DeviceIndex(object):
+    def __init__(self, devices=()):
+        # Cache entries and fleet listings are (uuid, name) pairs, so check for those first.
+        devices = [Device(d[0], d[1]) if isinstance(d, (tuple, list)) else Device.from_any(d) for d in devices]
+
+        # Note: The key lists share the name strings and packed UUIDs stored in the records, so they only cost one
+        # pointer per device.
+        by_name = sorted(devices, key=lambda d: d._name)
+        self._name_keys = [d._name for d in by_name]
+        self._name_devices = by_name
+
+        # Packed (hex) UUIDs and any others (see _pack_uuid()) cannot be compared, so they are sorted separately.
+        by_uuid = sorted([d for d in devices if isinstance(d._uuid, bytes)], key=lambda d: d._uuid)
+        self._uuid_keys = [d._uuid for d in by_uuid]
+        self._uuid_devices = by_uuid
+
+        by_other_uuid = sorted([d for d in devices if not isinstance(d._uuid, bytes)], key=lambda d: d._uuid)
+        self._other_uuid_keys = [d._uuid for d in by_other_uuid]
+        self._other_uuid_devices = by_other_uuid
+
+        # Built on first use, since most queries are resolved by exact or prefix matches.
+        self._trigram_index = None
+
+    def __len__(self):
+        return len(self._name_keys)
+
+    def __iter__(self):
+        return iter(self._name_devices)
+
+    @staticmethod
+    def _find_prefix(keys, values, prefix, limit=None):
+        start = bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+            if limit is not None and end - start >= limit:
+                break
+        return values[start:end]
+
+    def _get_uuid_arrays(self, key):
+        if isinstance(key, bytes):
+            return self._uuid_keys, self._uuid_devices
+        else:
+            return self._other_uuid_keys, self._other_uuid_devices
+
+    def get_by_uuid(self, uuid):
+        key = _pack_uuid(uuid)
+        keys, devices = self._get_uuid_arrays(key)
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return devices[i]
+        else:
+            return None
+
+    def get_by_name(self, name):
+        start = bisect_left(self._name_keys, name)
+        end = start
+        while end < len(self._name_keys) and self._name_keys[end] == name:
+            end += 1
+        return self._name_devices[start:end]
+
+    def find_by_name_prefix(self, prefix, limit=None):
+        return self._find_prefix(self._name_keys, self._name_devices, prefix, limit=limit)
+
+    def find_by_uuid_prefix(self, prefix, limit=None):
+        if len(prefix) % 2 == 0 or not isinstance(_pack_uuid(prefix + '0'), bytes):
+            key = _pack_uuid(prefix)
+            keys, devices = self._get_uuid_arrays(key)
+            return self._find_prefix(keys, devices, key, limit=limit)
+
+        # An odd number of hex digits ends in the middle of a byte: match all 16 values of the last byte's low half.
+        low = bytes.fromhex(prefix + '0')
+        high = bytes.fromhex(prefix + 'f')
+        start = bisect_left(self._uuid_keys, low)
+        end = start
+        while end < len(self._uuid_keys) and self._uuid_keys[end][:len(high)] <= high:
+            end += 1
+            if limit is not None and end - start >= limit:
+                break
+        return self._uuid_devices[start:end]
+
+    def _get_trigram_index(self):
+        if self._trigram_index is None:
+            self._trigram_index = TrigramIndex(self._name_devices)
+        return self._trigram_index
+
+    # Find devices whose names contain the query string (case-insensitive), or match it if it is a wildcard pattern
+    # (e.g., rover-*-lidar). Results are ranked by match quality.
+    def search(self, query, limit=None):
+        return self._get_trigram_index().search(query, limit=limit)
+
+    # Find the device names most similar to the query string, for a "did you mean" list.
+    def suggest(self, query, limit=5):
+        return self._get_trigram_index().suggest(query, limit=limit)
+
+    # Find all devices matching a (partial) name or UUID, using the same precedence rules as get_device_uuid(): an
+    # exact full UUID match, then a unique exact name match, then partial name and partial UUID matches, and finally,
+    # if there are no partial matches, a case-insensitive substring or wildcard search on device names.
+    #
+    # Returns a tuple containing the device for an exact match (or None), the list of devices whose names start with the
+    # query string, and the list of devices whose UUIDs start with the query string.
+    def find(self, name_or_uuid, is_name=None):
+        uuid_like = _UUID_LIKE_RE.match(name_or_uuid)
+        full_uuid_length = len(name_or_uuid) == 32
+
+        if uuid_like and not is_name and full_uuid_length:
+            device = self.get_by_uuid(name_or_uuid)
+            if device is not None:
+                return device, [], []
+
+        if is_name is not False:
+            exact_matches = self.get_by_name(name_or_uuid)
+            if len(exact_matches) == 1:
+                return exact_matches[0], [], []
+
+        devices_by_name = []
+        if is_name is not False:
+            devices_by_name = self.find_by_name_prefix(name_or_uuid)
+
+        devices_by_uuid = []
+        if not is_name and uuid_like and not full_uuid_length:
+            devices_by_uuid = self.find_by_uuid_prefix(name_or_uuid)
+
+        if is_name is not False and len(devices_by_name) + len(devices_by_uuid) == 0:
+            devices_by_name = self.search(name_or_uuid)
+            device = get_case_insensitive_match(name_or_uuid, devices_by_name)
+            if device is not None:
+                return device, [], []
+
+        return None, devices_by_name, devices_by_uuid
+
+    # Resolve a (partial) name or UUID to a single device. Returns None if there were no matches, or if the result is
+    # ambiguous.
+    def resolve(self, name_or_uuid, is_name=None):
+        device, devices_by_name, devices_by_uuid = self.find(name_or_uuid, is_name=is_name)
+        if device is not None:
+            return device
+        elif len(devices_by_name) + len(devices_by_uuid) == 1:
+            return (devices_by_name + devices_by_uuid)[0]
+        else:
+            return None
+
+    # Resolve a full UUID or exact device name to a single device. Unlike resolve(), partial, substring, and wildcard
+    # matches are never accepted. Used for data that may be out of date (e.g., an expired cache), where a partial match
+    # could now refer to a different (renamed or re-provisioned) device.
+    def resolve_exact(self, name_or_uuid, is_name=None):
+        if not is_name and len(name_or_uuid) == 32 and _UUID_LIKE_RE.match(name_or_uuid):
+            device = self.get_by_uuid(name_or_uuid)
+            if device is not None:
+                return device
+
+        if is_name is not False:
+            exact_matches = self.get_by_name(name_or_uuid)
+            if len(exact_matches) == 1:
+                return exact_matches[0]
+
+        return None
+
+    # Resolve a (partial) name or UUID and return a DeviceQueryResult, applying the same rules as get_device_uuid() when
+    # the index is known to be up to date: a single partial match is accepted, and if there are multiple partial name
+    # matches, an exact name match takes precedence if `check_exact_match` is set.
+    def match(self, name_or_uuid, is_name=None, check_exact_match=False):
+        device, devices_by_name, devices_by_uuid = self.find(name_or_uuid, is_name=is_name)
+        if device is None:
+            candidates = devices_by_name + devices_by_uuid
+            if len(candidates) == 1:
+                device = candidates[0]
+            elif len(devices_by_name) > 1 and check_exact_match:
+                for candidate in devices_by_name:
+                    if candidate.name == name_or_uuid:
+                        device = candidate
+                        break
+
+        if device is not None:
+            return DeviceQueryResult(name_or_uuid, FOUND, device.uuid, device.name, [])
+        elif len(devices_by_name) + len(devices_by_uuid) > 0:
+            return DeviceQueryResult(name_or_uuid, AMBIGUOUS, None, None, devices_by_name + devices_by_uuid)
+        else:
+            # For devices that were not found, return the most similar device names as a "did you mean" list.
+            return DeviceQueryResult(name_or_uuid, NOT_FOUND, None, None, self.suggest(name_or_uuid))
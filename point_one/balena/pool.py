@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+import glob
+import json
+import logging
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Relative imports don't usually work when running a Python file as a script since the file is not considered to be part
+# of a package. To get around this, we add the repo root directory to the import search path and set __package__ so the
+# interpreter tries the relative imports based on `<__package__>.__main__` instead of just `__main__`.
+if __name__ == "__main__" and (__package__ is None or __package__ == ''):
+    repo_dir = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    sys.path.append(repo_dir)
+    import point_one.balena
+    __package__ = "point_one.balena"
+
+from . import refresh
+
+# Pooled SSH connections to devices.
+#
+# Every `balena device ssh` command normally starts the Balena CLI, connects to the device through the Balena VPN/proxy,
+# and performs a full SSH handshake. When running many commands on the same device in a row, most of that time is spent
+# setting up the connection rather than running the command.
+#
+# In pooled mode, the first `ssh` command for a device starts a background session process (`pool.py run UUID`) that:
+# 1. Runs `balena device tunnel UUID -p 22222:<local port>`, forwarding a local port to the device's host OS SSH server
+# 2. Starts an OpenSSH control master connection to the device through the tunnel
+#
+# That command, and all later `ssh` commands for the same device, run `ssh` as a client of the control master, which
+# reuses the existing connection: no CLI startup, VPN negotiation, or SSH handshake. The control master exits once it
+# has been idle (no clients connected) for the idle timeout, at which point the session process closes the tunnel and
+# exits.
+#
+# Note that pooled sessions log into the device's host OS directly, so your SSH key must be authorized on the device
+# (e.g., in config.json `os.sshKeys`), or the device must be running a development OS image.
+
+__logger = logging.getLogger("point_one.balena.pool")
+
+# The default time (in seconds) to keep an unused connection open. This can be overridden with the
+# BALENA_WRAPPER_POOL_IDLE_TIMEOUT environment variable.
+DEFAULT_IDLE_TIMEOUT_SEC = 600.0
+
+# The maximum time to wait for a new session to connect to the device.
+DEFAULT_START_TIMEOUT_SEC = 60.0
+
+# How often the session process checks if the control master and tunnel are still running.
+CHECK_INTERVAL_SEC = 2.0
+
+# The maximum time to wait for a session process to finish cleaning up after stopping it.
+STOP_TIMEOUT_SEC = 10.0
+
+# The port of the SSH server on the device host OS.
+DEVICE_SSH_PORT = 22222
+
+DEFAULT_SSH_USER = 'root'
+
+# `balena device ssh` options that can be handled by a pooled connection. Anything else (e.g., --noproxy) is passed to
+# the Balena CLI as usual.
+_POOLED_SSH_OPTIONS = ('-t', '--tty')
+
+
+def is_enabled():
+    return os.environ.get("BALENA_WRAPPER_POOL", "") not in ("", "0")
+
+
+def get_pool_dir():
+    pool_dir = os.environ.get("BALENA_WRAPPER_POOL_DIR", None)
+    if pool_dir:
+        return pool_dir
+
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", None)
+    if not runtime_dir:
+        runtime_dir = os.path.join(tempfile.gettempdir(), "point_one-balena-%d" % os.getuid())
+    return os.path.join(runtime_dir, "point_one-balena-pool")
+
+
+def get_idle_timeout(idle_timeout_sec=None):
+    if idle_timeout_sec is None:
+        value = os.environ.get("BALENA_WRAPPER_POOL_IDLE_TIMEOUT", None)
+        if value is None or value == "":
+            idle_timeout_sec = DEFAULT_IDLE_TIMEOUT_SEC
+        else:
+            try:
+                idle_timeout_sec = float(value)
+            except ValueError:
+                __logger.warning("Ignoring invalid BALENA_WRAPPER_POOL_IDLE_TIMEOUT value '%s'." % value)
+                idle_timeout_sec = DEFAULT_IDLE_TIMEOUT_SEC
+    return max(idle_timeout_sec, 1.0)
+
+
+def _get_paths(uuid):
+    prefix = os.path.join(get_pool_dir(), uuid)
+    return {
+        'state': prefix + '.json',
+        'starting': prefix + '.starting',
+        'control': prefix + '.ctl',
+        'known_hosts': prefix + '.known_hosts',
+        'log': prefix + '.log',
+    }
+
+
+def get_log_path(uuid):
+    return _get_paths(uuid)['log']
+
+
+def _get_ssh_base_command(uuid, port):
+    # The SSH client and extra options (e.g., `-i ~/.ssh/balena_key`) can be changed with the BALENA_WRAPPER_SSH and
+    # BALENA_WRAPPER_POOL_SSH_USER environment variables.
+    #
+    # Every device is reached through a local port, so host keys are stored in a separate known hosts file for each
+    # device, rather than under 127.0.0.1:<port> in the user's own known hosts file.
+    paths = _get_paths(uuid)
+    ssh_command = shlex.split(os.environ.get("BALENA_WRAPPER_SSH", "") or "ssh")
+    ssh_command += ['-S', paths['control'], '-p', str(port),
+                    '-o', 'UserKnownHostsFile=%s' % paths['known_hosts'],
+                    '-o', 'StrictHostKeyChecking=accept-new']
+    destination = '%s@127.0.0.1' % (os.environ.get("BALENA_WRAPPER_POOL_SSH_USER", "") or DEFAULT_SSH_USER)
+    return ssh_command, destination
+
+
+def _is_master_running(uuid, port):
+    ssh_command, destination = _get_ssh_base_command(uuid, port)
+    return subprocess.call(ssh_command + ['-O', 'check', destination], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+def _read_state(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_session(uuid):
+    # Return the state of the running session for a device, or None if there isn't one.
+    paths = _get_paths(uuid)
+    state = _read_state(paths['state'])
+    if state is None or not os.path.exists(paths['control']):
+        return None
+    elif not _is_master_running(uuid, state['port']):
+        __logger.debug("Ignoring stale pooled session for %s." % uuid)
+        return None
+    else:
+        return state
+
+
+def list_sessions():
+    sessions = []
+    for path in sorted(glob.glob(os.path.join(get_pool_dir(), '*.json'))):
+        state = _read_state(path)
+        if state is not None:
+            state['running'] = get_session(state['uuid']) is not None
+            sessions.append(state)
+    return sessions
+
+
+def start_session(uuid, cli_path, idle_timeout_sec=None, timeout_sec=DEFAULT_START_TIMEOUT_SEC):
+    # Start a session process for a device and wait for it to connect. Returns the session state, or None if the
+    # connection could not be established (see the session log file for details).
+    #
+    # If another wrapper process is already starting a session for the same device, wait for that one instead.
+    paths = _get_paths(uuid)
+    os.makedirs(get_pool_dir(), mode=0o700, exist_ok=True)
+
+    try:
+        fd = os.open(paths['starting'], os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        os.close(fd)
+        is_owner = True
+    except FileExistsError:
+        is_owner = False
+        try:
+            if time.time() - os.path.getmtime(paths['starting']) > timeout_sec:
+                # The process that was starting the session must have died. Take over.
+                os.utime(paths['starting'])
+                is_owner = True
+        except OSError:
+            pass
+
+    if is_owner:
+        __logger.debug("Starting pooled session for %s." % uuid)
+        args = [sys.executable, os.path.abspath(__file__), 'run', uuid, '--cli', cli_path,
+                '--idle-timeout', str(get_idle_timeout(idle_timeout_sec))]
+        if not refresh.spawn_detached(args, output_path=paths['log']):
+            __logger.warning("Unable to start pooled session process.")
+            _remove(paths['starting'])
+            return None
+    else:
+        __logger.debug("Waiting for another process to start pooled session for %s." % uuid)
+
+    # The session process removes the `starting` file once it is connected, or if it fails.
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        if not os.path.exists(paths['starting']):
+            return get_session(uuid)
+        time.sleep(0.05)
+
+    __logger.warning("Timed out waiting for pooled session for %s to connect." % uuid)
+    return None
+
+
+def stop_session(uuid):
+    # Stop the session for a device. Returns True if a session was running.
+    paths = _get_paths(uuid)
+    state = _read_state(paths['state'])
+    if state is None:
+        return False
+
+    ssh_command, destination = _get_ssh_base_command(uuid, state['port'])
+    subprocess.call(ssh_command + ['-O', 'exit', destination], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+    try:
+        os.kill(state['pid'], signal.SIGTERM)
+    except OSError:
+        # The session process is not running. Clean up after it.
+        _remove(paths['state'])
+        _remove(paths['control'])
+        return True
+
+    # Wait for the session process to finish cleaning up (it removes the state file last), so it does not remove the
+    # files of a new session for the same device started right after this.
+    deadline = time.monotonic() + STOP_TIMEOUT_SEC
+    while time.monotonic() < deadline:
+        current_state = _read_state(paths['state'])
+        if current_state is None or current_state.get('pid', None) != state['pid']:
+            break
+        time.sleep(0.05)
+    return True
+
+
+def get_ssh_command(args, id_index):
+    # If a `balena device ssh` command can be run through a pooled connection, return the remote command and the
+    # `ssh` options to use. Otherwise, return None.
+    #
+    # Arguments after the device and a `--` separator are run as a command on the device host OS (e.g., `balena device
+    # ssh my-device -- uptime`). Without a separator, an argument after the device is a service name for the Balena CLI
+    # (`balena device ssh UUID SERVICE`, which opens a shell in a container), so the command is left to the CLI.
+    if len(args) < 2 or args[0] != 'device' or args[1] != 'ssh' or id_index is None:
+        return None
+
+    ssh_options = []
+    for arg in args[2:id_index]:
+        if arg in _POOLED_SSH_OPTIONS:
+            ssh_options.append('-t')
+        else:
+            return None
+
+    # Anything else after the device (e.g., a service name, or `balena device ssh UUID --port 22`) is meant for the
+    # Balena CLI.
+    remote_args = args[id_index + 1:]
+    if len(remote_args) == 0:
+        return remote_args, ssh_options
+    elif remote_args[0] == '--':
+        return remote_args[1:], ssh_options
+    else:
+        return None
+
+
+def get_client_command(session, remote_args, ssh_options=()):
+    # The `ssh` command to run `remote_args` (or an interactive shell) on the device through its control master.
+    ssh_command, destination = _get_ssh_base_command(session['uuid'], session['port'])
+    return ssh_command + ['-o', 'ControlMaster=no'] + list(ssh_options) + [destination] + list(remote_args)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, process, deadline):
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1.0):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def run_session(uuid, cli_path, idle_timeout_sec=None, timeout_sec=DEFAULT_START_TIMEOUT_SEC):
+    # Run a pooled session in the current process until the control master exits. Called by start_session() in a
+    # detached process.
+    paths = _get_paths(uuid)
+    idle_timeout_sec = get_idle_timeout(idle_timeout_sec)
+    port = _find_free_port()
+    ssh_command, destination = _get_ssh_base_command(uuid, port)
+
+    # Make sure the cleanup below runs if the session is stopped with `balena pool stop`.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    __logger.info("Opening tunnel to %s on port %d." % (uuid, port))
+    is_ready = False
+    tunnel = subprocess.Popen([cli_path, 'device', 'tunnel', uuid, '-p', '%d:%d' % (DEVICE_SSH_PORT, port)],
+                              stdin=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + timeout_sec
+        if not _wait_for_port(port, tunnel, deadline):
+            __logger.error("Tunnel to %s did not open." % uuid)
+            return 1
+
+        # Start the control master in the background. ssh exits once the connection is established, and the master
+        # exits by itself after being idle for the timeout.
+        __logger.info("Connecting to %s." % uuid)
+        _remove(paths['control'])
+        exit_code = subprocess.call(ssh_command + ['-f', '-N', '-M', '-o', 'BatchMode=yes',
+                                                   '-o', 'ControlPersist=%d' % int(idle_timeout_sec),
+                                                   '-o', 'ConnectTimeout=%d' % int(timeout_sec), destination],
+                                    stdin=subprocess.DEVNULL)
+        if exit_code != 0:
+            __logger.error("SSH connection to %s failed (exit code %d)." % (uuid, exit_code))
+            return 1
+
+        state = {
+            'uuid': uuid,
+            'port': port,
+            'pid': os.getpid(),
+            'tunnel_pid': tunnel.pid,
+            'idle_timeout_sec': idle_timeout_sec,
+            'start_time': time.time(),
+        }
+        tmp_path = paths['state'] + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, paths['state'])
+        _remove(paths['starting'])
+        is_ready = True
+        __logger.info("Session for %s ready." % uuid)
+
+        while True:
+            time.sleep(CHECK_INTERVAL_SEC)
+            if tunnel.poll() is not None:
+                __logger.info("Tunnel to %s closed (exit code %d)." % (uuid, tunnel.returncode))
+                break
+            elif not _is_master_running(uuid, port):
+                __logger.info("Session for %s closed." % uuid)
+                break
+        return 0
+    finally:
+        # Once the session was ready, the `starting` file (if any) belongs to a new session for the same device.
+        if not is_ready:
+            _remove(paths['starting'])
+        subprocess.call(ssh_command + ['-O', 'exit', destination], stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _remove(paths['control'])
+        if tunnel.poll() is None:
+            tunnel.terminate()
+            try:
+                tunnel.wait(timeout=5.0)
+            except subprocess.TimeoutExpired:
+                tunnel.kill()
+        # Removed last: stop_session() waits for this to know the session has finished cleaning up.
+        _remove(paths['state'])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""\
+Run a pooled SSH session for a device. This is normally started automatically by
+the wrapper (`balena --pool device ssh ...`), rather than being run directly.""")
+    parser.add_argument('action', choices=('run',),
+                        help="The action to perform.")
+    parser.add_argument('uuid', type=str,
+                        help="The UUID of the device.")
+    parser.add_argument('--cli', type=str, required=True,
+                        help="The path to the Balena CLI.")
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help="Close the session after it has been unused for this many seconds.")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Print verbose/trace debugging messages.")
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        level=logging.DEBUG if options.verbose > 0 else logging.INFO)
+
+    sys.exit(run_session(options.uuid, options.cli, idle_timeout_sec=options.idle_timeout))
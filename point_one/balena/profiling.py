@@ -0,0 +1,214 @@
+import atexit
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+# Lightweight phase timing for the CLI wrapper and library calls. Code is instrumented with named spans:
+#
+#   with profiling.span('list_devices'):
+#       ...
+#
+# Spans may be nested, and are only recorded if profiling has been enabled with enable() (or the BALENA_WRAPPER_PROFILE
+# environment variable). Otherwise span() returns a shared no-op object, so instrumentation costs well under a
+# microsecond per span.
+#
+# This module is imported by cli.py before deciding whether to load the Balena SDK, so it must only use the standard
+# library.
+
+__logger = logging.getLogger("point_one.balena.profiling")
+
+# Increment this if the structure of the JSON records written by write_report() changes.
+REPORT_VERSION = 1
+
+# All times are reported relative to when this module was first imported, which is approximately when the wrapper
+# started running (after Python interpreter startup).
+_origin = time.perf_counter()
+
+_enabled = False
+_print_report = False
+_output_path = None
+_reported = False
+
+_lock = threading.Lock()
+_spans = []
+_counters = {}
+_info = {}
+_local = threading.local()
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.depth = 0
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        _local.stack.pop()
+        with _lock:
+            _spans.append({
+                'name': self.name,
+                'depth': self.depth,
+                'thread': threading.current_thread().name,
+                'start_ms': (self.start - _origin) * 1e3,
+                'duration_ms': (end - self.start) * 1e3,
+                'error': exc_type.__name__ if exc_type is not None else None,
+            })
+        return False
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable(print_report=True, output_path=None):
+    # Start recording spans. At exit (or when report() is called), print a timing breakdown to stderr if `print_report`
+    # is set, and/or append a JSON record to `output_path`.
+    global _enabled, _print_report, _output_path
+    if not _enabled:
+        atexit.register(report)
+    _enabled = True
+    _print_report = _print_report or print_report
+    _output_path = output_path if output_path is not None else _output_path
+
+
+def enable_from_env():
+    # Enable profiling if requested by environment variables:
+    # - BALENA_WRAPPER_PROFILE - Print a timing breakdown on exit (any value other than empty or 0)
+    # - BALENA_WRAPPER_PROFILE_FILE - Append a JSON record to this file on exit, without printing anything
+    print_report = os.environ.get("BALENA_WRAPPER_PROFILE", "") not in ("", "0")
+    output_path = os.environ.get("BALENA_WRAPPER_PROFILE_FILE", "") or None
+    if print_report or output_path is not None:
+        enable(print_report=print_report, output_path=output_path)
+
+
+def span(name):
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def count(name, value=1):
+    # Add to a named counter (e.g., HTTP requests or bytes received).
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def set_info(name, value):
+    # Attach a value (e.g., the command being run or its exit code) to the report.
+    if _enabled:
+        _info[name] = value
+
+
+def instrument_requests():
+    # Count the HTTP requests made by the Balena SDK, and the number of bytes received, and record a span for each
+    # request. The SDK calls requests.request() directly (creating a new session for each call), so the only place to
+    # hook in is Session.send(). This is only done when profiling is enabled.
+    if not _enabled:
+        return
+
+    import requests
+
+    send = requests.Session.send
+    if getattr(send, '_point_one_profiled', False):
+        return
+
+    def _send(session, request, **kwargs):
+        with span('http %s' % request.method):
+            response = send(session, request, **kwargs)
+            count('http_requests')
+            if kwargs.get('stream', False):
+                # Do not consume streaming responses (e.g., logs). Use the declared length if there is one.
+                count('http_bytes', int(response.headers.get('Content-Length', 0)))
+            else:
+                count('http_bytes', len(response.content))
+            return response
+
+    _send._point_one_profiled = True
+    requests.Session.send = _send
+
+
+def get_report():
+    end = time.perf_counter()
+    with _lock:
+        return {
+            'version': REPORT_VERSION,
+            'timestamp': time.time(),
+            'host': platform.node(),
+            'python_version': platform.python_version(),
+            'pid': os.getpid(),
+            'total_ms': (end - _origin) * 1e3,
+            'info': dict(_info),
+            'counters': dict(_counters),
+            'spans': sorted(_spans, key=lambda s: s['start_ms']),
+        }
+
+
+def format_report(report_data):
+    lines = ['Profile: %.1f ms total' % report_data['total_ms']]
+    for name, value in sorted(report_data['info'].items()):
+        lines.append('  %s: %s' % (name, value))
+
+    lines.append('  %10s %10s  %s' % ('start', 'duration', 'phase'))
+    for s in report_data['spans']:
+        name = '  ' * s['depth'] + s['name']
+        if s['thread'] != 'MainThread':
+            name += ' [%s]' % s['thread']
+        if s['error'] is not None:
+            name += ' (%s)' % s['error']
+        lines.append('  %7.1f ms %7.1f ms  %s' % (s['start_ms'], s['duration_ms'], name))
+
+    if len(report_data['counters']) > 0:
+        counters = sorted(report_data['counters'].items())
+        lines.append('  ' + ', '.join('%s=%d' % (name, value) for name, value in counters))
+    return '\n'.join(lines)
+
+
+def write_report(path, report_data):
+    # Append a single JSON line, so records from many runs (or machines) can be concatenated and aggregated.
+    with open(path, 'a') as f:
+        f.write(json.dumps(report_data, sort_keys=True) + '\n')
+
+
+def report():
+    # Print and/or write the report. This is called automatically at exit, but should be called explicitly before
+    # replacing the current process (e.g., with os.exec*()), since exit handlers will not run. Only the first call has
+    # any effect.
+    global _reported
+    if not _enabled or _reported:
+        return
+    _reported = True
+
+    report_data = get_report()
+    if _print_report:
+        sys.stderr.write(format_report(report_data) + '\n')
+        sys.stderr.flush()
+
+    if _output_path is not None:
+        try:
+            write_report(_output_path, report_data)
+        except OSError as e:
+            __logger.warning("Unable to write profile to '%s': %s" % (_output_path, str(e)))
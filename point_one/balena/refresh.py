@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+
+# Background refresh of the device cache, used to update stale data (the device cache or the shell completion snapshot)
+# without making the user wait for a full device listing. spawn_detached() is also used to start other background
+# processes (see pool.py).
+#
+# Note: This module is imported by the shell completion backend, so it must only import os, sys, and time at the top
+# level. See completion.py.
+
+# Do not start another background refresh for the same account if one was started within this interval (e.g., by a
+# previous command or key press), unless the refresh finished and removed its marker file.
+MIN_REFRESH_INTERVAL_SEC = 60.0
+
+
+def get_marker_path(cache_dir, cache_key):
+    return os.path.join(cache_dir, "devices-%s.refresh" % cache_key)
+
+
+def clear_marker(cache_dir, cache_key):
+    try:
+        os.unlink(get_marker_path(cache_dir, cache_key))
+    except OSError:
+        pass
+
+
+def start_background_refresh(cache_dir, cache_key, auth_token=None, account=None):
+    # Run `cli.py cache refresh` in a detached process (see spawn_detached()), for a single account from the accounts
+    # file if `account` is specified, or otherwise for the specified auth token (or the user's normal login) only.
+    # Returns True if a refresh was started.
+    marker_path = get_marker_path(cache_dir, cache_key)
+    try:
+        if time.time() - os.path.getmtime(marker_path) < MIN_REFRESH_INTERVAL_SEC:
+            return False
+    except OSError:
+        pass
+
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        with open(marker_path, 'w'):
+            pass
+    except OSError:
+        return False
+
+    # If the caller specified an auth token explicitly, make sure the refresh uses the same account.
+    env = dict(os.environ)
+    if auth_token is not None:
+        env['BALENA_AUTH_TOKEN'] = auth_token
+
+    # Without an account, ignore the accounts file. Otherwise, `cache refresh` would refresh every account in it rather
+    # than just the cache that is out of date.
+    if account is None:
+        env['BALENA_WRAPPER_ACCOUNTS'] = ''
+
+    cli_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+    args = [sys.executable, cli_path, '--no-daemon']
+    if account is not None:
+        args += ['--account', account]
+    return spawn_detached(args + ['cache', 'refresh'], env=env)
+
+
+def spawn_detached(args, env=None, output_path=None):
+    # Run a command in a fully detached process, without waiting for it. Returns True if the process was started.
+    # Output is discarded, or appended to `output_path` if specified.
+    #
+    # The process is double-forked, so it is not a child of this process. That way it does not get left behind as a
+    # zombie if this process replaces itself with the Balena CLI (see cli.py), and it keeps running if the user's
+    # command finishes (or is interrupted) first.
+    if env is None:
+        env = dict(os.environ)
+
+    if not hasattr(os, 'fork'):
+        import subprocess
+        try:
+            output = open(output_path, 'ab') if output_path is not None else subprocess.DEVNULL
+            subprocess.Popen(args, env=env, stdin=subprocess.DEVNULL, stdout=output, stderr=output, close_fds=True)
+            return True
+        except OSError:
+            return False
+
+    try:
+        pid = os.fork()
+    except OSError:
+        return False
+
+    if pid == 0:
+        # Intermediate child: start a new session, fork the process that does the work, and exit immediately.
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                null_fd = os.open(os.devnull, os.O_RDWR)
+                if output_path is not None:
+                    output_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+                else:
+                    output_fd = null_fd
+                os.dup2(null_fd, 0)
+                os.dup2(output_fd, 1)
+                os.dup2(output_fd, 2)
+                os.execve(args[0], args, env)
+        finally:
+            os._exit(0)
+
+    os.waitpid(pid, 0)
+    return True
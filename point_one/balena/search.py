@@ -0,0 +1,154 @@
+from array import array
+from collections import Counter
+from fnmatch import translate
+import re
+import sys
+
+# Characters that mark a query as a shell-style wildcard pattern (e.g., rover-*-lidar).
+_WILDCARD_RE = re.compile(r"[*?\[]")
+
+# The parts of a wildcard pattern that are not literal text: `*`, `?`, and complete character classes, including negated
+# classes and a `]` listed first (e.g., `[ab]`, `[!c]`, `[]x]`). As in fnmatch, a `[` without a closing `]` is a literal
+# character.
+_WILDCARD_TOKEN_RE = re.compile(r"[*?]|\[[!^]?\]?[^\]]*\]")
+
+# Characters that separate words in device names. A match at the start of a word (e.g., "lidar" in
+# "rover-sf-0142-lidar") ranks higher than a match in the middle of a word.
+_WORD_SEPARATORS = '-_. '
+
+
+def is_wildcard(query):
+    return _WILDCARD_RE.search(query) is not None
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def compile_name_matcher(query):
+    # Return a function that tests whether a device name matches a query string, using the same rules as
+    # TrigramIndex.search(): case-insensitive substring matching, or case-insensitive wildcard matching if the query
+    # contains wildcard characters. This is useful for filtering a stream of devices without building an index.
+    if is_wildcard(query):
+        regex = re.compile(translate(query.lower()))
+        return lambda name: regex.match(name.lower()) is not None
+    else:
+        query = query.lower()
+        return lambda name: query in name.lower()
+
+
+# Inverted index mapping each 3-character sequence (trigram) appearing in a device name to the devices containing it.
+#
+# To find the names containing a query string, we only need to look at the devices containing all of the query's
+# trigrams, typically a handful of devices, rather than checking every name in the fleet. All matching is
+# case-insensitive.
+#
+# Lowercase names are interned, so a name that is already lowercase shares the string stored in its Device record (see
+# index.py), and posting lists are stored as arrays of 32-bit integers rather than lists of int objects.
+class TrigramIndex(object):
+    def __init__(self, devices=()):
+        self._devices = list(devices)
+        self._names = [sys.intern(d['device_name'].lower()) for d in self._devices]
+
+        self._postings = {}
+        for i, name in enumerate(self._names):
+            for trigram in _trigrams(name):
+                posting = self._postings.get(trigram, None)
+                if posting is None:
+                    posting = self._postings[trigram] = array('I')
+                posting.append(i)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _candidates(self, literals):
+        # Find the devices whose names contain every trigram in each of the literal strings. Returns None if none of the
+        # strings are long enough to use the index, in which case the caller must check every device.
+        trigrams = set()
+        for literal in literals:
+            trigrams.update(_trigrams(literal))
+        if len(trigrams) == 0:
+            return None
+
+        postings = sorted((self._postings.get(t, []) for t in trigrams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if len(candidates) == 0:
+                break
+            candidates.intersection_update(posting)
+        return sorted(candidates)
+
+    def _rank(self, query, name):
+        # Lower is better: exact match, then prefix, then start of a word, then anywhere. Ties are broken by preferring
+        # shorter names (i.e., closer matches).
+        if name == query:
+            quality = 0
+        elif name.startswith(query):
+            quality = 1
+        else:
+            position = name.find(query)
+            if position > 0 and name[position - 1] in _WORD_SEPARATORS:
+                quality = 2
+            else:
+                quality = 3
+        return quality, len(name) - len(query), name
+
+    def search(self, query, limit=None):
+        # Find all devices whose names contain the query string, or match it if it is a wildcard pattern. Results are
+        # ranked by match quality.
+        query = query.lower()
+        if is_wildcard(query):
+            literals = [s for s in _WILDCARD_TOKEN_RE.split(query) if s != '']
+            regex = re.compile(translate(query))
+            candidates = self._candidates(literals)
+            if candidates is None:
+                candidates = range(len(self._names))
+            matches = [i for i in candidates if regex.match(self._names[i])]
+            matches.sort(key=lambda i: (len(self._names[i]), self._names[i]))
+        else:
+            candidates = self._candidates([query])
+            if candidates is None:
+                candidates = range(len(self._names))
+            matches = [i for i in candidates if query in self._names[i]]
+            matches.sort(key=lambda i: self._rank(query, self._names[i]))
+
+        if limit is not None:
+            matches = matches[:limit]
+        return [self._devices[i] for i in matches]
+
+    def suggest(self, query, limit=5):
+        # Find the device names most similar to the query string (measured by the fraction of trigrams they have in
+        # common), for a "did you mean" list when a query does not match anything. If several devices have the same
+        # name, only the first is returned.
+        query_trigrams = _trigrams(_WILDCARD_TOKEN_RE.sub('', query.lower()))
+        if len(query_trigrams) == 0:
+            return []
+
+        counts = Counter()
+        for trigram in query_trigrams:
+            counts.update(self._postings.get(trigram, ()))
+
+        # Require at least a third of the query to match so we do not suggest unrelated devices.
+        #
+        # Visit devices in order of decreasing number of common trigrams. A device with `count` common trigrams can have
+        # a similarity of at most `count / len(query_trigrams)`, so we can stop once that bound drops below the worst of
+        # the best `limit` devices found so far, without scoring the rest of the fleet.
+        min_count = max(1, len(query_trigrams) // 3)
+        best = []
+        seen_names = set()
+        for i, count in counts.most_common():
+            if count < min_count:
+                break
+            elif len(best) >= limit and count / float(len(query_trigrams)) < -best[-1][0]:
+                break
+            elif self._names[i] in seen_names:
+                continue
+
+            seen_names.add(self._names[i])
+            num_name_trigrams = max(len(self._names[i]) - 2, 1)
+            similarity = count / float(len(query_trigrams) + num_name_trigrams - count)
+            best.append((-similarity, self._names[i], i))
+            best.sort()
+            del best[limit:]
+
+        return [self._devices[i] for _, _, i in best]
@@ -0,0 +1,211 @@
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import time
+
+from . import cache, profiling
+from .fleet import DEFAULT_PAGE_SIZE, iter_device_pages
+
+__logger = logging.getLogger("point_one.balena.sync")
+
+# Incremental sync of the device list.
+#
+# Listing the entire fleet is the main cost of keeping the device cache up to date. Instead, we keep a local copy of the
+# fleet (ID, UUID, and name of each device) along with a high-water mark: the latest `modified_at` timestamp seen. Each
+# sync then only requests devices created or modified since then, which is typically a handful of devices, no matter
+# how large the fleet is.
+#
+# Deleted devices do not show up in that query, so every DEFAULT_CHECK_INTERVAL_SEC we also list the IDs of all devices
+# (a few bytes per device) and remove any devices that no longer exist. If that listing contains devices we have never
+# seen, the local copy has diverged from the server for some reason, and we start over with a full listing.
+
+# Increment this if the structure of the sync state file changes. Older state files are discarded.
+SYNC_FORMAT_VERSION = 1
+
+# The fields requested for each device.
+SYNC_FIELDS = ('id', 'uuid', 'device_name')
+
+# How often (in seconds) to check for deleted devices. This can be overridden with the
+# BALENA_WRAPPER_SYNC_CHECK_INTERVAL environment variable. Setting it to 0 checks on every sync.
+DEFAULT_CHECK_INTERVAL_SEC = 3600.0
+
+# Request changes starting this long (in seconds) before the high-water mark. A device modified shortly before the
+# latest change we saw may not have been visible yet when we listed changes (e.g., a slow API transaction), and
+# timestamps only have millisecond resolution, so we re-request a small window of recent changes every time.
+MODIFIED_AT_OVERLAP_SEC = 60.0
+
+# The result of a sync. `devices` is the complete list of (uuid, device_name) tuples after the sync, in ID order.
+# `num_changed` is the number of devices that were added, renamed, or re-listed by a full sync, and `num_deleted` is the
+# number of devices removed.
+SyncResult = namedtuple('SyncResult', ['devices', 'full', 'num_changed', 'num_deleted', 'checked_deletions'])
+
+
+def get_check_interval(interval_sec=None):
+    if interval_sec is None:
+        value = os.environ.get("BALENA_WRAPPER_SYNC_CHECK_INTERVAL", None)
+        if value is None or value == "":
+            interval_sec = DEFAULT_CHECK_INTERVAL_SEC
+        else:
+            try:
+                interval_sec = float(value)
+            except ValueError:
+                __logger.warning("Ignoring invalid BALENA_WRAPPER_SYNC_CHECK_INTERVAL value '%s'." % value)
+                interval_sec = DEFAULT_CHECK_INTERVAL_SEC
+    return max(interval_sec, 0.0)
+
+
+def _shift_timestamp(timestamp, offset_sec):
+    # API timestamps are ISO 8601 strings in UTC (e.g., 2024-10-02T09:15:00.123Z), which sort in chronological order.
+    try:
+        value = datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return timestamp
+    return (value + timedelta(seconds=offset_sec)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class DeviceSync(object):
+    # The local copy of the fleet and its high-water mark. If `state_path` is specified, the state is loaded from and
+    # saved to that file on every sync (so it is shared with other processes). Otherwise, it is only kept in memory.
+    def __init__(self, state_path=None, api_endpoint=None, check_interval_sec=None, page_size=DEFAULT_PAGE_SIZE):
+        self.logger = logging.getLogger("point_one.balena.sync")
+        self.state_path = state_path
+        self.api_endpoint = api_endpoint
+        self.check_interval_sec = get_check_interval(check_interval_sec)
+        self.page_size = page_size
+
+        # Device ID -> (uuid, device_name).
+        self.devices = {}
+        self.high_water_mark = None
+        self.last_check_time = 0.0
+
+    def _load(self):
+        data = cache.read_json(self.state_path)
+        if data is None:
+            return False
+        elif data.get('version', None) != SYNC_FORMAT_VERSION or data.get('endpoint', None) != self.api_endpoint:
+            self.logger.debug("Ignoring incompatible sync state '%s'." % self.state_path)
+            return False
+
+        try:
+            self.devices = {entry[0]: (entry[1], entry[2]) for entry in data['devices']}
+            self.high_water_mark = data['high_water_mark']
+            self.last_check_time = float(data['last_check_time'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            self.logger.debug("Ignoring malformed sync state '%s'." % self.state_path)
+            self.devices = {}
+            self.high_water_mark = None
+            return False
+        return True
+
+    def _save(self):
+        data = {
+            "version": SYNC_FORMAT_VERSION,
+            "endpoint": self.api_endpoint,
+            "high_water_mark": self.high_water_mark,
+            "last_check_time": self.last_check_time,
+            "devices": [(device_id, uuid, name) for device_id, (uuid, name) in sorted(self.devices.items())],
+        }
+        try:
+            cache.atomic_write_json(self.state_path, data)
+        except OSError as e:
+            self.logger.warning("Unable to write sync state '%s': %s" % (self.state_path, str(e)))
+
+    def _update_high_water_mark(self, device):
+        modified_at = device.get('modified_at', None)
+        if modified_at is not None and (self.high_water_mark is None or modified_at > self.high_water_mark):
+            self.high_water_mark = modified_at
+
+    def _list_all(self, balena, stop_event=None):
+        # Rather than requesting the timestamp of every device, find the latest one before listing the fleet. Anything
+        # modified during the listing is then listed again by the next sync.
+        latest = balena.models.device.get_all({'$select': ['id', 'modified_at'], '$orderby': 'modified_at desc',
+                                               '$top': 1})
+        self.high_water_mark = None
+        if len(latest) > 0:
+            self._update_high_water_mark(latest[0])
+
+        devices = {}
+        for page in iter_device_pages(balena, SYNC_FIELDS, page_size=self.page_size, stop_event=stop_event):
+            for device in page:
+                devices[device['id']] = (device['uuid'], device['device_name'])
+        self.devices = devices
+        self.last_check_time = time.time()
+        return len(devices)
+
+    def _list_changes(self, balena, stop_event=None):
+        since = _shift_timestamp(self.high_water_mark, -MODIFIED_AT_OVERLAP_SEC)
+        num_changed = 0
+        for page in iter_device_pages(balena, SYNC_FIELDS + ('modified_at',), filters={'modified_at': {'$ge': since}},
+                                      page_size=self.page_size, stop_event=stop_event):
+            for device in page:
+                entry = (device['uuid'], device['device_name'])
+                if self.devices.get(device['id'], None) != entry:
+                    self.devices[device['id']] = entry
+                    num_changed += 1
+                self._update_high_water_mark(device)
+        return num_changed
+
+    def _remove_deleted(self, balena, stop_event=None):
+        # Returns the number of devices removed, or None if the server has devices we do not know about.
+        device_ids = set()
+        for page in iter_device_pages(balena, ('id',), page_size=self.page_size, stop_event=stop_event):
+            device_ids.update(device['id'] for device in page)
+
+        if not device_ids.issubset(self.devices.keys()):
+            return None
+
+        deleted_ids = [device_id for device_id in self.devices if device_id not in device_ids]
+        for device_id in deleted_ids:
+            del self.devices[device_id]
+        self.last_check_time = time.time()
+        return len(deleted_ids)
+
+    def sync(self, balena, full=False, check_deletions=None, stop_event=None):
+        # Bring the local copy of the fleet up to date, using a full listing if there is no previous state or if `full`
+        # is set. `check_deletions` forces (True) or skips (False) the deleted device check, which otherwise runs every
+        # `check_interval_sec`. Returns a SyncResult.
+        if self.state_path is not None and not full and not self._load():
+            # E.g., the first sync, or the cache was cleared.
+            self.high_water_mark = None
+
+        num_deleted = 0
+        checked_deletions = False
+        if full or self.high_water_mark is None:
+            self.logger.debug("Listing all devices for full sync.")
+            with profiling.span('sync_full'):
+                num_changed = self._list_all(balena, stop_event=stop_event)
+            full = True
+        else:
+            self.logger.debug("Listing devices modified since %s." % self.high_water_mark)
+            with profiling.span('sync_changes'):
+                num_changed = self._list_changes(balena, stop_event=stop_event)
+
+            if check_deletions is None:
+                check_deletions = time.time() - self.last_check_time >= self.check_interval_sec
+            if check_deletions:
+                self.logger.debug("Listing device IDs to check for deleted devices.")
+                with profiling.span('sync_check_deletions'):
+                    num_deleted = self._remove_deleted(balena, stop_event=stop_event)
+                checked_deletions = True
+
+                if num_deleted is None:
+                    self.logger.warning("Local device list is out of sync. Listing all devices.")
+                    with profiling.span('sync_full'):
+                        num_changed = self._list_all(balena, stop_event=stop_event)
+                    num_deleted = 0
+                    full = True
+
+        self.logger.debug("Synced %d devices (%d changed, %d deleted%s)." %
+                          (len(self.devices), num_changed, num_deleted, ', full listing' if full else ''))
+        if self.state_path is not None:
+            self._save()
+
+        devices = [entry for _, entry in sorted(self.devices.items())]
+        return SyncResult(devices, full, num_changed, num_deleted, checked_deletions or full)
+
+
+def sync_devices(balena, api_endpoint, auth_token, full=False, check_deletions=None, stop_event=None):
+    # Sync the device list using the state stored alongside the device cache for this account. Returns a SyncResult.
+    device_sync = DeviceSync(state_path=cache.get_sync_state_path(api_endpoint, auth_token), api_endpoint=api_endpoint)
+    return device_sync.sync(balena, full=full, check_deletions=check_deletions, stop_event=stop_event)
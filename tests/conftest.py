@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.normpath(os.path.join(TESTS_DIR, '..'))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+# The auth token used by all tests. Tests never talk to a real Balena account: devices are served by the fakes in
+# tests/fake_*.py.
+TEST_AUTH_TOKEN = 'test-token'
+
+
+@pytest.fixture(autouse=True)
+def isolated_environment(tmp_path, monkeypatch):
+    # Keep every test away from the user's real login, device cache, resolver daemon, and accounts file. Subprocesses
+    # started by a test inherit the same environment.
+    home_dir = tmp_path / 'home'
+    home_dir.mkdir()
+    monkeypatch.setenv('HOME', str(home_dir))
+    monkeypatch.setenv('BALENA_AUTH_TOKEN', TEST_AUTH_TOKEN)
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('BALENA_WRAPPER_SOCKET', str(tmp_path / 'resolver.sock'))
+    monkeypatch.setenv('BALENA_WRAPPER_POOL_DIR', str(tmp_path / 'pool'))
+    monkeypatch.setenv('BALENA_WRAPPER_ACCOUNTS', '')
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([REPO_DIR, TESTS_DIR, os.environ.get('PYTHONPATH', '')]))
+    for name in ('BALENARC_BALENA_URL', 'BALENA_WRAPPER_CACHE_TTL', 'BALENA_WRAPPER_CACHE_GRACE',
+                 'BALENA_WRAPPER_SYNC_CHECK_INTERVAL', 'BALENA_WRAPPER_POOL', 'BALENA_WRAPPER_SSH',
+                 'BALENA_WRAPPER_PROFILE', 'BALENA_WRAPPER_PROFILE_FILE', 'XDG_RUNTIME_DIR'):
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import unquote
+
+from fake_sdk import apply_query_options, generate_devices
+
+# A local stand-in for the Balena API device endpoint (`GET /<version>/device`), serving a synthetic fleet over HTTP.
+# Unlike FakeBalena, this is used with the real Balena SDK, so it exercises the SDK's request handling and JSON
+# decoding, and lets us measure the actual number of bytes transferred.
+
+__logger = logging.getLogger("point_one.balena.fake_api")
+
+_RESOURCE_RE = re.compile(r"^/[^/]+/device(?:\((\w+)='?([^')]*)'?\))?$")
+_FILTER_RE = re.compile(r"^\(?(\w+) (eq|ne|gt|ge|lt|le) (?:'([^']*)'|(-?\d+))\)?$")
+
+
+def _parse_query(query):
+    options = {}
+    for part in query.split('&'):
+        if part == '':
+            continue
+        key, _, value = part.partition('=')
+        options[unquote(key)] = unquote(value)
+
+    # Filters are comparisons of a field against a quoted string or an integer, optionally combined with `and`, e.g.:
+    #   (modified_at ge '2024-10-02T09:15:00.000Z') and (id gt 1000)
+    if '$filter' in options:
+        filters = {}
+        for clause in options['$filter'].split(' and '):
+            m = _FILTER_RE.match(clause)
+            if m is None:
+                raise ValueError("Unsupported filter '%s'." % options['$filter'])
+            field, op, value = m.group(1), m.group(2), m.group(3)
+            if value is None:
+                value = int(m.group(4))
+            filters.setdefault(field, {})['$' + op] = value
+        options['$filter'] = filters
+    return options
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server.fake_api
+        path, _, query = self.path.partition('?')
+        m = _RESOURCE_RE.match(path)
+        if m is None:
+            self.send_error(404)
+            return
+
+        try:
+            options = _parse_query(query)
+        except ValueError as e:
+            self.send_error(500, str(e))
+            return
+
+        if m.group(1) is not None:
+            field = m.group(1)
+            value = int(m.group(2)) if field == 'id' else m.group(2)
+            options.setdefault('$filter', {})[field] = value
+
+        if server.latency_sec > 0.0:
+            time.sleep(server.latency_sec)
+
+        body = json.dumps({'d': apply_query_options(server.devices, options)}).encode('utf-8')
+        with server.lock:
+            server.request_count += 1
+            server.bytes_sent += len(body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger("point_one.balena.fake_api").debug(format % args)
+
+
+class FakeApiServer(object):
+    def __init__(self, devices=None, num_devices=1000, latency_sec=0.0, host='127.0.0.1', port=0):
+        self.devices = devices if devices is not None else generate_devices(num_devices)
+        self.latency_sec = latency_sec
+        self.request_count = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.fake_api = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_count = 0
+            self.bytes_sent = 0
+
+    def connect(self, auth_token='fake-token'):
+        # Create a real SDK instance that sends its requests to this server instead of the Balena API. The SDK only
+        # supports HTTPS endpoints in its settings, so we override the request prefix directly.
+        from balena import Balena
+
+        balena = Balena({'data_directory': False})
+        balena.pine.api_prefix = self.url + str(balena.settings.get('api_version')) + '/'
+        balena.auth.login_with_token(auth_token)
+        return balena
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="""\
+Serve a synthetic fleet of devices over HTTP, emulating the Balena API device
+endpoint, for testing and benchmarking.""")
+    parser.add_argument('--devices', type=int, default=50000,
+                        help="The number of devices to serve.")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Artificial delay (in seconds) to add to each request.")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="The port to listen on.")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Print verbose/trace debugging messages.")
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s',
+                        level=logging.DEBUG if options.verbose > 0 else logging.INFO)
+
+    server = FakeApiServer(num_devices=options.devices, latency_sec=options.latency, port=options.port)
+    __logger.info("Serving %d devices on %s." % (len(server.devices), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
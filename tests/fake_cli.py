@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+# A minimal stand-in for the Balena CLI executable, for testing the wrapper without a Balena account or devices. To use
+# it, link it as `balena` in a directory outside this repository and put that directory at the front of PATH:
+#
+#   ln -s /path/to/tests/fake_cli.py /tmp/fake-bin/balena
+#   PATH=/tmp/fake-bin:$PATH balena --pool device ssh my-device -- uptime
+#
+# - `balena device tunnel UUID -p REMOTE:LOCAL` forwards connections to 127.0.0.1:LOCAL to the address in
+#   $FAKE_BALENA_TUNNEL_TARGET (default: 127.0.0.1:22). Point it at a local sshd to test pooled SSH connections (see
+#   pool.py), e.g., `sshd -D -p 2222 -f <test sshd_config>` and FAKE_BALENA_TUNNEL_TARGET=127.0.0.1:2222.
+# - Any other command prints its arguments and exits.
+#
+# If $FAKE_BALENA_LOG is set, one line is appended to it for each invocation, so tests can count how many times the CLI
+# was run.
+
+__logger = logging.getLogger("point_one.balena.fake_cli")
+
+
+def _forward(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for s in (source, destination):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def run_tunnel(local_port, target_host, target_port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', local_port))
+    server.listen(16)
+    print('Tunneling 127.0.0.1:%d to %s:%d.' % (local_port, target_host, target_port))
+    sys.stdout.flush()
+
+    while True:
+        client, _ = server.accept()
+        try:
+            upstream = socket.create_connection((target_host, target_port))
+        except OSError as e:
+            __logger.error("Unable to connect to %s:%d: %s" % (target_host, target_port, str(e)))
+            client.close()
+            continue
+        threading.Thread(target=_forward, args=(client, upstream), daemon=True).start()
+        threading.Thread(target=_forward, args=(upstream, client), daemon=True).start()
+
+
+if __name__ == "__main__":
+    log_path = os.environ.get("FAKE_BALENA_LOG", None)
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write('%f %d %s\n' % (time.time(), os.getpid(), ' '.join(sys.argv[1:])))
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+    if sys.argv[1:3] == ['device', 'tunnel']:
+        parser = ArgumentParser(prog='balena device tunnel')
+        parser.add_argument('uuid')
+        parser.add_argument('-p', '--port', action='append', required=True,
+                            help="REMOTE_PORT:LOCAL_PORT")
+        options = parser.parse_args(sys.argv[3:])
+
+        target = os.environ.get("FAKE_BALENA_TUNNEL_TARGET", "") or "127.0.0.1:22"
+        target_host, target_port = target.rsplit(':', 1)
+        local_port = int(options.port[0].split(':')[-1])
+        try:
+            run_tunnel(local_port, target_host, int(target_port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(' '.join(sys.argv[1:]))
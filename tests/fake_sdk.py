@@ -0,0 +1,270 @@
+import operator
+import random
+import threading
+import time
+
+# A minimal in-memory stand-in for the Balena SDK, implementing the subset of `balena.Balena` used by this package. This
+# can be passed anywhere a `balena=` SDK object is accepted (get_device_uuid(), the resolver daemon, etc.) to test or
+# benchmark without access to a Balena account.
+
+
+def get_full_device_record(device):
+    # Expand a minimal device dict into something resembling the full record returned by the API when no $select is
+    # specified, so transfer size and memory use are realistic.
+    device_id = device.get('id', 0)
+    record = {
+        'id': device_id,
+        'belongs_to__application': {'__id': 1000 + device_id % 7},
+        'belongs_to__user': None,
+        'actor': {'__id': 500000 + device_id},
+        'is_running__release': {'__id': 2000000 + device_id % 13},
+        'should_be_running__release': None,
+        'is_of__device_type': {'__id': 58},
+        'is_pinned_on__release': None,
+        'should_be_managed_by__supervisor_release': None,
+        'is_web_accessible': False,
+        'created_at': device.get('created_at', '2023-04-12T18:22:%02d.000Z' % (device_id % 60)),
+        'modified_at': device.get('modified_at', '2024-10-02T09:15:%02d.000Z' % (device_id % 60)),
+        'custom_latitude': '',
+        'custom_longitude': '',
+        'device_name': device['device_name'],
+        'note': None,
+        'uuid': device['uuid'],
+        'local_id': None,
+        'status': 'Idle',
+        'is_online': device_id % 3 != 0,
+        'last_connectivity_event': '2024-10-02T09:15:00.000Z',
+        'is_connected_to_vpn': device_id % 3 != 0,
+        'last_vpn_event': '2024-10-02T09:15:00.000Z',
+        'ip_address': '192.168.%d.%d 10.0.%d.%d' % (device_id % 250, device_id % 200, device_id % 100, device_id % 50),
+        'mac_address': '02:42:ac:%02x:%02x:%02x 00:1b:63:%02x:%02x:%02x' % ((device_id,) * 3 + (device_id,) * 3),
+        'public_address': '203.0.113.%d' % (device_id % 255),
+        'vpn_address': '10.240.%d.%d' % (device_id % 250, device_id % 200),
+        'os_version': 'balenaOS 5.3.24',
+        'os_variant': 'prod',
+        'supervisor_version': '16.4.6',
+        'provisioning_progress': None,
+        'provisioning_state': '',
+        'api_port': 48484,
+        'api_secret': '%032x' % (device_id * 2654435761),
+        'download_progress': None,
+        'memory_usage': 1024 + device_id % 512,
+        'memory_total': 3882,
+        'storage_block_device': '/dev/mmcblk0p6',
+        'storage_usage': 2500 + device_id % 1000,
+        'storage_total': 28000,
+        'cpu_usage': device_id % 100,
+        'cpu_temp': 45 + device_id % 20,
+        'is_undervolted': False,
+        'cpu_id': '%016x' % device_id,
+        'is_accessible_by_support_until__date': None,
+        'logs_channel': None,
+        'changed_api_heartbeat_state_on__date': '2024-10-02T09:15:00.000Z',
+        'api_heartbeat_state': 'online',
+        'overall_status': None,
+        'overall_progress': None,
+    }
+    return record
+
+
+# Comparison operators supported in $filter, e.g., `{'modified_at': {'$ge': '2024-10-02T09:15:00.000Z'}}`.
+_FILTER_OPERATORS = {
+    '$eq': operator.eq,
+    '$ne': operator.ne,
+    '$gt': operator.gt,
+    '$ge': operator.ge,
+    '$lt': operator.lt,
+    '$le': operator.le,
+}
+
+
+def _matches_filter(device, field, condition):
+    value = device.get(field, None)
+    if not isinstance(condition, dict):
+        return value == condition
+
+    for op, operand in condition.items():
+        if value is None or not _FILTER_OPERATORS[op](value, operand):
+            return False
+    return True
+
+
+def apply_query_options(devices, options):
+    # Apply the subset of OData query options used by this package ($filter on field values, $orderby, $skip, $top, and
+    # $select) to a list of device dicts. Filters on multiple fields must all match.
+    devices = list(devices)
+
+    filters = options.get('$filter', None)
+    if isinstance(filters, dict):
+        devices = [d for d in devices if all(_matches_filter(d, k, v) for k, v in filters.items())]
+
+    orderby = options.get('$orderby', 'device_name asc')
+    if isinstance(orderby, str):
+        for clause in reversed(orderby.split(',')):
+            parts = clause.strip().split()
+            devices.sort(key=lambda d: d[parts[0]], reverse=len(parts) > 1 and parts[1] == 'desc')
+
+    skip = int(options.get('$skip', 0))
+    top = options.get('$top', None)
+    devices = devices[skip:] if top is None else devices[skip:skip + int(top)]
+
+    select = options.get('$select', None)
+    if select is not None:
+        if isinstance(select, str):
+            select = select.split(',')
+        devices = [{k: d[k] for k in select} if all(k in d for k in select) else
+                   {k: v for k, v in get_full_device_record(d).items() if k in select}
+                   for d in devices]
+    else:
+        devices = [get_full_device_record(d) for d in devices]
+
+    return devices
+
+
+# Synthetic devices are created one minute apart, starting at this time.
+_FLEET_START_TIME = 1672531200  # 2023-01-01T00:00:00Z
+
+
+def format_timestamp(timestamp):
+    # Format a POSIX timestamp the way the Balena API formats device timestamps (e.g., 2024-10-02T09:15:00.000Z).
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def generate_devices(num_devices, seed=0):
+    # Generate a synthetic fleet with names similar to real vehicle names (e.g., rover-sf-0142-lidar). Names are not
+    # unique: some vehicles have multiple devices with the same base name, and a small number of names are duplicated
+    # exactly, so ambiguous queries behave the same way they would against a real fleet.
+    rng = random.Random(seed)
+    sites = ['sf', 'sj', 'la', 'nyc', 'sea', 'atl']
+    roles = ['lidar', 'gnss', 'cam', 'imu']
+
+    devices = []
+    used_uuids = set()
+    for i in range(num_devices):
+        uuid = '%032x' % rng.getrandbits(128)
+        while uuid in used_uuids:
+            uuid = '%032x' % rng.getrandbits(128)
+        used_uuids.add(uuid)
+
+        vehicle = i // 2
+        name = 'rover-%s-%04d-%s' % (sites[vehicle % len(sites)], vehicle % 10000, roles[i % len(roles)])
+        if i > 0 and i % 97 == 0:
+            # Exact duplicate of a previous device name.
+            name = devices[rng.randrange(len(devices))]['device_name']
+
+        timestamp = format_timestamp(_FLEET_START_TIME + i * 60)
+        devices.append({'id': i + 1, 'uuid': uuid, 'device_name': name, 'created_at': timestamp,
+                        'modified_at': timestamp})
+    return devices
+
+
+class FakeFleet(object):
+    # A synthetic fleet that can be modified while it is being served, for testing incremental device sync (see
+    # sync.py). Pass `fleet.devices` to FakeBalena or FakeApiServer: the list is modified in place, so changes are
+    # visible to subsequent requests.
+    #
+    # Each change advances a simulated clock by one second and sets the device's `modified_at` timestamp, like the
+    # Balena API does. Devices are replaced rather than modified in place, so a request in progress on another thread
+    # sees each device either before or after a change.
+    def __init__(self, devices=None, num_devices=100, seed=0):
+        self.devices = devices if devices is not None else generate_devices(num_devices, seed=seed)
+        self._rng = random.Random(seed)
+        self._next_id = max([d['id'] for d in self.devices], default=0) + 1
+        self._time = _FLEET_START_TIME + (self._next_id + 1) * 60
+        self._lock = threading.Lock()
+
+    def _now(self):
+        self._time += 1
+        return format_timestamp(self._time)
+
+    def add(self, count=1):
+        added = []
+        with self._lock:
+            for _ in range(count):
+                uuid = '%032x' % self._rng.getrandbits(128)
+                timestamp = self._now()
+                device = {'id': self._next_id, 'uuid': uuid, 'device_name': 'rover-new-%04d' % self._next_id,
+                          'created_at': timestamp, 'modified_at': timestamp}
+                self._next_id += 1
+                self.devices.append(device)
+                added.append(device)
+        return added
+
+    def rename(self, count=1):
+        renamed = []
+        with self._lock:
+            for i in self._rng.sample(range(len(self.devices)), min(count, len(self.devices))):
+                device = dict(self.devices[i])
+                device['device_name'] = '%s-renamed' % device['device_name']
+                device['modified_at'] = self._now()
+                self.devices[i] = device
+                renamed.append(device)
+        return renamed
+
+    def remove(self, count=1):
+        removed = []
+        with self._lock:
+            for _ in range(min(count, len(self.devices))):
+                removed.append(self.devices.pop(self._rng.randrange(len(self.devices))))
+        return removed
+
+
+class FakeDeviceModel(object):
+    def __init__(self, devices, latency_sec=0.0):
+        self.devices = devices
+        self.latency_sec = latency_sec
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.request_count += 1
+        if self.latency_sec > 0.0:
+            time.sleep(self.latency_sec)
+
+    def get_all(self, options=None):
+        self._request()
+        return apply_query_options(self.devices, options if options is not None else {})
+
+    def get_by_name(self, name, options=None):
+        from balena.exceptions import DeviceNotFound
+
+        self._request()
+        devices = [dict(d) for d in self.devices if d['device_name'] == name]
+        if len(devices) == 0:
+            raise DeviceNotFound(name)
+        return devices
+
+    def get_name(self, uuid_or_id):
+        from balena.exceptions import DeviceNotFound
+
+        self._request()
+        for device in self.devices:
+            if device['uuid'] == uuid_or_id or device['id'] == uuid_or_id:
+                return device['device_name']
+        raise DeviceNotFound(uuid_or_id)
+
+
+class FakeAuth(object):
+    def __init__(self):
+        self.token = None
+
+    def login_with_token(self, token):
+        self.token = token
+
+    def get_token(self):
+        return self.token
+
+
+class FakeModels(object):
+    pass
+
+
+class FakeBalena(object):
+    def __init__(self, devices=None, num_devices=100, latency_sec=0.0):
+        if devices is None:
+            devices = generate_devices(num_devices)
+
+        self.auth = FakeAuth()
+        self.models = FakeModels()
+        self.models.device = FakeDeviceModel(devices, latency_sec=latency_sec)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import socket
+import sys
+
+# A minimal stand-in for the OpenSSH client, implementing the subset used by pooled connections (see pool.py), for
+# testing without an SSH server. Use it with BALENA_WRAPPER_SSH="python3 tests/fake_ssh.py".
+#
+# - `-M` (start a control master) connects to 127.0.0.1:<port> and sends a line, which must be echoed back (e.g., by an
+#   echo server behind the fake Balena CLI's tunnel). On success, it creates the control file (`-S`) and exits.
+# - `-O check` succeeds if the control file exists, and `-O exit` removes it.
+# - Anything else is a client command, which fails if the control file does not exist, and otherwise prints the remote
+#   command. If $FAKE_SSH_LOG is set, one line is appended to it for each client command.
+
+_OPTIONS_WITH_VALUES = ('-S', '-p', '-o', '-O', '-i', '-l')
+
+
+def _parse(args):
+    options = {}
+    flags = set()
+    positional = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if len(positional) > 0:
+            positional.append(arg)
+        elif arg in _OPTIONS_WITH_VALUES:
+            options.setdefault(arg, []).append(args[i + 1])
+            i += 1
+        elif arg.startswith('-'):
+            flags.add(arg)
+        else:
+            positional.append(arg)
+        i += 1
+    return options, flags, positional
+
+
+def _start_master(control_path, port):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=5.0) as sock:
+            sock.sendall(b'ping\n')
+            if sock.makefile('rb').readline() != b'ping\n':
+                return 255
+    except OSError as e:
+        print('ssh: connect to host 127.0.0.1 port %d: %s' % (port, str(e)), file=sys.stderr)
+        return 255
+
+    with open(control_path, 'w') as f:
+        json.dump({'port': port}, f)
+    return 0
+
+
+if __name__ == "__main__":
+    options, flags, positional = _parse(sys.argv[1:])
+    control_path = options['-S'][0]
+    port = int(options.get('-p', ['22'])[0])
+
+    if '-O' in options:
+        command = options['-O'][0]
+        if command == 'check':
+            sys.exit(0 if os.path.exists(control_path) else 255)
+        elif command == 'exit':
+            try:
+                os.unlink(control_path)
+            except OSError:
+                pass
+            sys.exit(0)
+        else:
+            sys.exit(255)
+    elif '-M' in flags:
+        sys.exit(_start_master(control_path, port))
+    elif not os.path.exists(control_path):
+        print('Control socket connect(%s): No such file or directory' % control_path, file=sys.stderr)
+        sys.exit(255)
+    else:
+        remote_args = positional[1:]
+        log_path = os.environ.get("FAKE_SSH_LOG", None)
+        if log_path:
+            with open(log_path, 'a') as f:
+                f.write('%d %s\n' % (port, ' '.join(remote_args)))
+        print('ran: %s' % ' '.join(remote_args))
@@ -0,0 +1,128 @@
+import pytest
+
+from fake_sdk import FakeBalena
+from point_one.balena import accounts, cache
+from point_one.balena.accounts import Account
+from point_one.balena.fleet import list_devices
+from point_one.balena.index import AMBIGUOUS, FOUND, NOT_FOUND, DeviceIndex
+
+PRODUCTION = Account('production', 'balena-cloud.com', 'production-token', None)
+STAGING = Account('staging', 'staging.example.com', 'staging-token', None)
+
+FLEETS = {
+    'production': [
+        {'id': 1, 'uuid': 'a1' * 16, 'device_name': 'rover-sf-0001-lidar'},
+        {'id': 2, 'uuid': 'a2' * 16, 'device_name': 'rover-sf-0001-lidar-old'},
+        {'id': 3, 'uuid': 'a3' * 16, 'device_name': 'rover-sf-0002-cam'},
+        {'id': 4, 'uuid': 'a4' * 16, 'device_name': 'rover-la-0005-imu'},
+    ],
+    'staging': [
+        {'id': 1, 'uuid': 'b1' * 16, 'device_name': 'rover-sf-0001-gnss'},
+        {'id': 2, 'uuid': 'b2' * 16, 'device_name': 'rover-sf-0002-lidar'},
+        {'id': 3, 'uuid': 'b3' * 16, 'device_name': 'bench-unit-07'},
+        {'id': 4, 'uuid': 'b4' * 16, 'device_name': 'rover-la-0005-imu'},
+    ],
+}
+
+
+@pytest.fixture
+def listed(monkeypatch):
+    # Serve each account's devices from a fake SDK instead of the Balena API, and record which accounts were listed.
+    listed = []
+
+    def _list_account_devices(account, use_cache=True):
+        listed.append(account.name)
+        devices = list_devices(FakeBalena(devices=FLEETS[account.name]))
+        if use_cache:
+            cache.save_devices(account.api_endpoint, account.auth_token, devices)
+        return DeviceIndex(devices)
+
+    monkeypatch.setattr(accounts, '_list_account_devices', _list_account_devices)
+    return listed
+
+
+def _save_caches(*names):
+    for account in (PRODUCTION, STAGING):
+        if account.name in names:
+            cache.save_devices(account.api_endpoint, account.auth_token, FLEETS[account.name])
+
+
+def _resolve(query, accounts_list=(PRODUCTION, STAGING), **kwargs):
+    return accounts.resolve([query], accounts=list(accounts_list), **kwargs)[0]
+
+
+def test_exact_match_from_cache(listed):
+    _save_caches('production', 'staging')
+    result = _resolve('rover-sf-0001-gnss')
+    assert (result.status, result.uuid, result.account) == (FOUND, 'b1' * 16, 'staging')
+    assert listed == []
+
+
+def test_unique_partial_match_from_cache(listed):
+    _save_caches('production', 'staging')
+    result = _resolve('bench')
+    assert (result.status, result.uuid, result.account) == (FOUND, 'b3' * 16, 'staging')
+    assert listed == []
+
+
+def test_ambiguous_in_one_account_and_unique_in_another(listed):
+    # Production has two devices starting with rover-sf-0001, so its cache does not resolve the query on its own, but
+    # they still count as matches: the staging device must not be returned as the only result.
+    _save_caches('production', 'staging')
+    result = _resolve('rover-sf-0001')
+    assert result.status == AMBIGUOUS
+    assert sorted((d.account, d.name) for d in result.candidates) == [
+        ('production', 'rover-sf-0001-lidar'), ('production', 'rover-sf-0001-lidar-old'),
+        ('staging', 'rover-sf-0001-gnss')]
+
+
+def test_same_name_in_two_accounts(listed):
+    _save_caches('production', 'staging')
+    result = _resolve('rover-la-0005-imu')
+    assert result.status == AMBIGUOUS
+    assert accounts.get_candidate_accounts(result) == ['production', 'staging']
+
+
+def test_not_found(listed):
+    _save_caches('production', 'staging')
+    result = _resolve('rover-sf-0003-lidr')
+    assert result.status == NOT_FOUND
+    assert sorted(listed) == ['production', 'staging']
+
+
+def test_owner_exact_match_lists_only_owner(listed):
+    # The first lookup lists every account and remembers where the device was found. Without caches, the next lookup
+    # for the same exact name only lists that account.
+    assert _resolve('rover-sf-0002-cam', use_cache=False).account == 'production'
+    del listed[:]
+
+    result = _resolve('rover-sf-0002-cam', use_cache=False)
+    assert (result.status, result.account) == (FOUND, 'production')
+    assert listed == ['production']
+
+
+def test_owner_partial_match_checks_other_accounts(listed):
+    # rover-sf-0002 was last found in production, but it is only a prefix, which also matches a device in staging.
+    assert _resolve('rover-sf-0002', accounts_list=[PRODUCTION], use_cache=False).account == 'production'
+    del listed[:]
+
+    result = _resolve('rover-sf-0002', use_cache=False)
+    assert result.status == AMBIGUOUS
+    assert sorted(listed) == ['production', 'staging']
+
+
+def test_owner_with_other_cache_matching(listed):
+    # The owner's exact match is not trusted if another account's cache also matches the query.
+    accounts._save_owners({'rover-la-0005-imu': 'production'})
+    _save_caches('staging')
+    result = _resolve('rover-la-0005-imu')
+    assert result.status == AMBIGUOUS
+    assert accounts.get_candidate_accounts(result) == ['production', 'staging']
+
+
+def test_owners_remembered(listed):
+    _save_caches('production', 'staging')
+    _resolve('bench-unit-07')
+    owners = accounts._load_owners()
+    assert owners['bench-unit-07'] == 'staging'
+    assert owners['b3' * 16] == 'staging'
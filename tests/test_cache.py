@@ -0,0 +1,214 @@
+from balena.exceptions import DeviceNotFound
+import pytest
+
+from conftest import TEST_AUTH_TOKEN
+from fake_sdk import FakeBalena
+from point_one.balena import cache, device
+from point_one.balena.auth import get_api_endpoint
+
+DEVICES = [
+    {'id': 1, 'uuid': 'a1' * 16, 'device_name': 'rover-sf-0001-lidar'},
+    {'id': 2, 'uuid': 'a2' * 16, 'device_name': 'rover-sf-0002-cam'},
+    {'id': 3, 'uuid': 'a3' * 16, 'device_name': 'bench-unit-07'},
+]
+
+PAIRS = [(d['uuid'], d['device_name']) for d in DEVICES]
+
+
+def _save(devices=DEVICES, age_sec=0.0):
+    # Save the devices to the cache as if they had been listed `age_sec` ago.
+    endpoint = get_api_endpoint()
+    cache.save_devices(endpoint, TEST_AUTH_TOKEN, devices)
+    path = cache.get_device_cache_path(endpoint, TEST_AUTH_TOKEN)
+    data = cache.read_json(path)
+    data['timestamp'] -= age_sec
+    cache.atomic_write_json(path, data)
+
+
+def _load(**kwargs):
+    return cache.load_devices(get_api_endpoint(), TEST_AUTH_TOKEN, **kwargs)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, cache.DEFAULT_CACHE_TTL_SEC),
+    ('', cache.DEFAULT_CACHE_TTL_SEC),
+    ('60', 60.0),
+    ('0', 0.0),
+    ('-5', 0.0),
+    ('soon', cache.DEFAULT_CACHE_TTL_SEC),
+])
+def test_get_cache_ttl(monkeypatch, value, expected):
+    if value is not None:
+        monkeypatch.setenv('BALENA_WRAPPER_CACHE_TTL', value)
+    assert cache.get_cache_ttl() == expected
+    assert cache.get_cache_ttl(10.0) == 10.0
+
+
+def test_save_and_load():
+    assert _load() is None
+    _save()
+    assert _load() == PAIRS
+
+    # Each account has its own cache.
+    assert cache.load_devices(get_api_endpoint(), 'other-token') is None
+    assert cache.load_devices('https://api.example.com/', TEST_AUTH_TOKEN) is None
+
+
+def test_ttl():
+    _save(age_sec=120.0)
+    assert _load(ttl_sec=300.0) == PAIRS
+    assert _load(ttl_sec=60.0) is None
+
+
+def test_ttl_from_environment(monkeypatch):
+    _save(age_sec=120.0)
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_TTL', '60')
+    assert _load() is None
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_TTL', '300')
+    assert _load() == PAIRS
+
+
+def test_ttl_zero_disables_cache(monkeypatch):
+    _save()
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_TTL', '0')
+    assert _load() is None
+
+
+def test_invalid_cache_ignored():
+    _save()
+    path = cache.get_device_cache_path(get_api_endpoint(), TEST_AUTH_TOKEN)
+
+    # A timestamp in the future (e.g., the clock changed) is not trusted.
+    data = cache.read_json(path)
+    data['timestamp'] += 3600.0
+    cache.atomic_write_json(path, data)
+    assert _load() is None
+
+    data = cache.read_json(path)
+    data.update(timestamp=data['timestamp'] - 3600.0, version=cache.CACHE_FORMAT_VERSION + 1)
+    cache.atomic_write_json(path, data)
+    assert _load() is None
+
+    with open(path, 'w') as f:
+        f.write('{"version": 1, "timesta')
+    assert _load() is None
+
+
+def test_clear_devices():
+    _save()
+    cache.save_devices(get_api_endpoint(), 'other-token', DEVICES)
+    assert cache.clear_devices(get_api_endpoint(), TEST_AUTH_TOKEN) == 1
+    assert _load() is None
+    assert cache.load_devices(get_api_endpoint(), 'other-token') == PAIRS
+    assert cache.clear_devices() == 1
+
+
+def test_get_device_uuid_uses_cache():
+    # A fresh cache answers exact and partial queries without any API requests.
+    _save()
+    balena = FakeBalena(devices=DEVICES)
+    for query, uuid in (('rover-sf-0001-lidar', 'a1' * 16), ('bench', 'a3' * 16), ('a2a2', 'a2' * 16)):
+        assert device.get_device_uuid(query, balena=balena, auth_token=TEST_AUTH_TOKEN, use_daemon=False) == uuid
+    assert balena.models.device.request_count == 0
+
+
+def test_get_device_uuid_expired_cache():
+    # An expired cache is replaced by a live listing.
+    _save(devices=DEVICES[:1], age_sec=cache.DEFAULT_CACHE_TTL_SEC + cache.DEFAULT_CACHE_GRACE_SEC + 60.0)
+    balena = FakeBalena(devices=DEVICES)
+    assert device.get_device_uuid('bench', balena=balena, auth_token=TEST_AUTH_TOKEN, use_daemon=False) == 'a3' * 16
+    assert balena.models.device.request_count > 0
+    assert _load() == PAIRS
+
+
+@pytest.fixture
+def refreshes(monkeypatch):
+    # Record background refreshes instead of starting a refresh process.
+    refreshes = []
+    monkeypatch.setattr(cache, 'refresh_in_background', lambda *args, **kwargs: refreshes.append(args))
+    return refreshes
+
+
+def _load_stale_ok(**kwargs):
+    return cache.load_devices_stale_ok(get_api_endpoint(), TEST_AUTH_TOKEN, ttl_sec=60.0, **kwargs)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, cache.DEFAULT_CACHE_GRACE_SEC),
+    ('120', 120.0),
+    ('0', 0.0),
+    ('later', cache.DEFAULT_CACHE_GRACE_SEC),
+])
+def test_get_cache_grace(monkeypatch, value, expected):
+    if value is not None:
+        monkeypatch.setenv('BALENA_WRAPPER_CACHE_GRACE', value)
+    assert cache.get_cache_grace() == expected
+
+
+def test_grace_window():
+    _save(age_sec=30.0)
+    assert _load_stale_ok(grace_sec=120.0) == (PAIRS, False)
+
+    _save(age_sec=90.0)
+    assert _load_stale_ok(grace_sec=120.0) == (PAIRS, True)
+    assert _load_stale_ok(grace_sec=0.0) == (None, False)
+    assert _load(ttl_sec=60.0) is None
+
+    _save(age_sec=200.0)
+    assert _load_stale_ok(grace_sec=120.0) == (None, False)
+
+
+def test_grace_from_environment(monkeypatch):
+    _save(age_sec=90.0)
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_GRACE', '120')
+    assert _load_stale_ok() == (PAIRS, True)
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_GRACE', '0')
+    assert _load_stale_ok() == (None, False)
+
+
+def _stale_lookup(query, balena, **kwargs):
+    return device.get_device_uuid(query, balena=balena, auth_token=TEST_AUTH_TOKEN, use_daemon=False,
+                                  cache_ttl_sec=60.0, **kwargs)
+
+
+def test_stale_cache_exact_match(refreshes):
+    # An exact name or UUID match is answered from an expired cache, which is refreshed in the background.
+    _save(age_sec=90.0)
+    balena = FakeBalena(devices=DEVICES)
+    assert _stale_lookup('rover-sf-0002-cam', balena) == 'a2' * 16
+    assert _stale_lookup('a1' * 16, balena) == 'a1' * 16
+    assert balena.models.device.request_count == 0
+    assert len(refreshes) == 2
+
+
+def test_stale_cache_partial_match(refreshes):
+    # A partial match from an expired cache may refer to a device that has since been renamed, so it is resolved with a
+    # live query instead.
+    _save(age_sec=90.0)
+    renamed = [dict(d, device_name='rover-la-0007-imu') if d['id'] == 3 else d for d in DEVICES]
+    balena = FakeBalena(devices=renamed)
+    with pytest.raises(DeviceNotFound):
+        _stale_lookup('bench', balena, is_name=True)
+    assert balena.models.device.request_count > 0
+    assert _stale_lookup('rover-la', balena) == 'a3' * 16
+    assert refreshes == []
+
+
+def test_stale_cache_batch(refreshes):
+    _save(age_sec=90.0)
+    balena = FakeBalena(devices=DEVICES)
+
+    # Everything resolved from the expired cache: refresh it in the background.
+    results = device.get_device_uuids(['rover-sf-0001-lidar', 'a3' * 16], balena=balena, auth_token=TEST_AUTH_TOKEN,
+                                      use_daemon=False, cache_ttl_sec=60.0)
+    assert [r.uuid for r in results] == ['a1' * 16, 'a3' * 16]
+    assert balena.models.device.request_count == 0
+    assert len(refreshes) == 1
+
+    # A partial match requires a live listing, which also updates the cache.
+    results = device.get_device_uuids(['rover-sf-0001-lidar', 'bench'], balena=balena, auth_token=TEST_AUTH_TOKEN,
+                                      use_daemon=False, cache_ttl_sec=60.0)
+    assert [r.uuid for r in results] == ['a1' * 16, 'a3' * 16]
+    assert balena.models.device.request_count > 0
+    assert len(refreshes) == 1
+    assert _load(ttl_sec=60.0) == PAIRS
@@ -0,0 +1,111 @@
+import hashlib
+import sys
+import types
+
+import pytest
+
+from conftest import TEST_AUTH_TOKEN
+from fake_sdk import generate_devices
+from point_one.balena import cache, completion
+from point_one.balena.auth import get_api_endpoint
+
+# Includes non-ASCII names, which are sorted by their UTF-8 encoding in the snapshot.
+DEVICES = [(d['uuid'], d['device_name']) for d in generate_devices(3000, seed=13)] + [
+    ('c0' * 16, 'rover-zürich-0001-cam'),
+    ('c1' * 16, 'rover-zurich-0002-cam'),
+    ('c2' * 16, 'rover-é-0003-imu'),
+    ('c3' * 16, 'Rover-upper'),
+    ('c4' * 16, 'r'),
+]
+
+
+def test_cache_key_matches_device_cache():
+    # The completion script computes the cache key itself, without importing cache.py, so it must stay in sync.
+    assert completion._get_cache_key() == cache.get_cache_key(get_api_endpoint(), TEST_AUTH_TOKEN)
+
+
+def test_cache_key_without_token(monkeypatch):
+    monkeypatch.delenv('BALENA_AUTH_TOKEN')
+    assert completion._get_cache_key() is None
+
+
+def test_sha256_fallback(monkeypatch):
+    # If the private SHA-256 modules are missing or do not behave like hashlib, hashlib is used instead.
+    broken = types.ModuleType('_sha2')
+    broken.sha256 = lambda data: hashlib.md5(data)
+    monkeypatch.setitem(sys.modules, '_sha2', broken)
+    monkeypatch.setitem(sys.modules, '_sha256', None)
+    assert completion._import_sha256() is hashlib.sha256
+
+
+@pytest.fixture
+def snapshot(monkeypatch):
+    # Write the completion snapshot along with the device cache, and record background refreshes instead of starting
+    # them.
+    refreshes = []
+    monkeypatch.setattr(completion.refresh, 'start_background_refresh', lambda *args, **kwargs: refreshes.append(args))
+    cache.save_devices(get_api_endpoint(), TEST_AUTH_TOKEN, DEVICES)
+    names_path, uuids_path = completion.get_snapshot_paths(completion._get_cache_key())
+    return names_path, uuids_path, refreshes
+
+
+@pytest.mark.parametrize('prefix', [
+    '', 'r', 'ro', 'rover-', 'rover-sf-', 'rover-sf-01', 'rover-sf-0142-lidar', 'rover-z', 'rover-zü', 'rover-é',
+    'R', 'rover-sf-0142-lidar-x', 'a', 'zzz', '\uffff',
+])
+def test_find_prefix(snapshot, prefix):
+    # The binary search must find exactly the names a linear scan would.
+    names_path = snapshot[0]
+    expected = sorted(set(name for _, name in DEVICES if name.startswith(prefix)), key=lambda n: n.encode('utf-8'))
+    assert completion.find_prefix(names_path, prefix, limit=len(DEVICES)) == expected
+
+
+def test_find_prefix_uuids(snapshot):
+    uuids_path = snapshot[1]
+    for uuid, _ in DEVICES[::97]:
+        for length in (1, 2, 5, 32):
+            expected = sorted(u for u, _ in DEVICES if u.startswith(uuid[:length]))
+            assert completion.find_prefix(uuids_path, uuid[:length], limit=len(DEVICES)) == expected
+
+
+def test_find_prefix_limit(snapshot):
+    names_path = snapshot[0]
+    assert len(completion.find_prefix(names_path, 'rover-')) == completion.MAX_COMPLETIONS
+    assert completion.find_prefix(names_path, 'rover-', limit=3) == completion.find_prefix(names_path, 'rover-')[:3]
+
+
+def test_find_prefix_missing_file(tmp_path):
+    assert completion.find_prefix(str(tmp_path / 'missing.names'), 'rover') == []
+
+
+def test_device_completions(snapshot):
+    refreshes = snapshot[2]
+    assert completion.get_device_completions('rover-zu') == ['rover-zurich-0002-cam']
+
+    # UUIDs are only completed for a non-empty hex prefix.
+    assert completion.get_device_completions('c3c3') == ['c3' * 16]
+    assert 'c4' * 16 not in completion.get_device_completions('')
+
+    # The snapshot is up to date, so no refresh is started.
+    assert refreshes == []
+
+
+def test_device_completions_stale_snapshot(snapshot, monkeypatch):
+    refreshes = snapshot[2]
+    monkeypatch.setenv('BALENA_WRAPPER_CACHE_TTL', '0.001')
+    assert completion.get_device_completions('rover-zu') == ['rover-zurich-0002-cam']
+    assert len(refreshes) == 1
+
+
+@pytest.mark.parametrize('words, expected', [
+    (['balena', 'ssh', 'rover-zu'], ['rover-zurich-0002-cam']),
+    (['balena', '--quiet', 'device', 'ssh', 'rover-zu'], ['rover-zurich-0002-cam']),
+    (['balena', '-j', '8', 'uuid', 'r', 'rover-zu'], ['rover-zurich-0002-cam']),
+    (['balena', '--each', 'rover-zu'], ['rover-zurich-0002-cam']),
+    (['balena', 'device', 're'], ['reboot', 'rename', 'restart']),
+    (['balena', 'ssh', '--port'], []),
+    (['balena', 'ssh', 'rover-zurich-0002-cam', 'ma'], []),
+    (['balena', 'fleets', 'rover-zu'], []),
+])
+def test_get_completions(snapshot, words, expected):
+    assert completion.get_completions(words, len(words) - 1) == expected
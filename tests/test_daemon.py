@@ -0,0 +1,133 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import TEST_AUTH_TOKEN
+from fake_sdk import FakeBalena, FakeFleet
+from point_one.balena import cache, daemon, device
+from point_one.balena.auth import get_api_endpoint
+from point_one.balena.index import AMBIGUOUS, FOUND, NOT_FOUND
+
+
+@pytest.fixture
+def fleet():
+    return FakeFleet(num_devices=200, seed=1)
+
+
+@pytest.fixture
+def resolver(fleet, tmp_path):
+    # A resolver daemon serving the fake fleet on a per-test socket, in a background thread.
+    balena = FakeBalena(devices=fleet.devices)
+    resolver = daemon.ResolverDaemon(balena=balena, auth_token=TEST_AUTH_TOKEN, socket_path=str(tmp_path / 'd.sock'),
+                                     use_cache=False)
+    thread = threading.Thread(target=resolver.serve_forever, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10.0
+    while daemon.get_status(socket_path=resolver.socket_path) is None:
+        assert time.monotonic() < deadline, "Resolver daemon did not start."
+        time.sleep(0.01)
+
+    yield resolver
+
+    resolver.shutdown()
+    thread.join(timeout=5.0)
+
+
+def test_resolve(fleet, resolver):
+    target = fleet.devices[10]
+    results = daemon.resolve([target['device_name'], target['uuid'][:10], 'rover-', 'no-such-device'],
+                             auth_token=TEST_AUTH_TOKEN, socket_path=resolver.socket_path)
+    assert [r.status for r in results] == [FOUND, FOUND, AMBIGUOUS, NOT_FOUND]
+    assert results[0].uuid == target['uuid']
+    assert results[1].name == target['device_name']
+    assert len(results[2].candidates) > 1
+
+
+def test_resolve_finds_new_devices(fleet, resolver, monkeypatch):
+    # A device added after the daemon listed the fleet is found by listing again, once the index is old enough.
+    new_device = fleet.add()[0]
+    monkeypatch.setattr(daemon, 'MIN_LIVE_REFRESH_INTERVAL_SEC', 0.0)
+    results = daemon.resolve([new_device['device_name']], auth_token=TEST_AUTH_TOKEN,
+                             socket_path=resolver.socket_path)
+    assert results[0].status == FOUND
+    assert results[0].uuid == new_device['uuid']
+
+
+def test_resolve_other_account(resolver):
+    # The daemon only answers queries for its own account. The client falls back to an in-process lookup.
+    assert daemon.resolve(['rover-'], auth_token='other-token', socket_path=resolver.socket_path) is None
+
+
+def test_resolve_not_running(tmp_path):
+    assert daemon.resolve(['rover-'], auth_token=TEST_AUTH_TOKEN, socket_path=str(tmp_path / 'missing.sock')) is None
+    assert daemon.get_status(socket_path=str(tmp_path / 'missing.sock')) is None
+
+
+def test_resolve_not_running_skips_auth_token(monkeypatch):
+    # Without a daemon, the client must not spend time looking up the auth token.
+    def _get_auth_token():
+        raise AssertionError('get_auth_token() called')
+
+    monkeypatch.setattr(daemon, 'get_auth_token', _get_auth_token)
+    assert daemon.resolve(['rover-']) is None
+
+
+def test_get_device_uuid_uses_daemon(fleet, resolver, monkeypatch):
+    monkeypatch.setenv('BALENA_WRAPPER_SOCKET', resolver.socket_path)
+    target = fleet.devices[20]
+    request_count = resolver.request_count
+    assert device.get_device_uuid(target['device_name'], return_name=True) == (target['uuid'], target['device_name'])
+    assert resolver.request_count == request_count + 1
+
+
+def test_get_device_uuid_falls_back_without_daemon(fleet, monkeypatch, tmp_path):
+    # With no daemon listening, the query is answered from the device cache instead.
+    monkeypatch.setenv('BALENA_WRAPPER_SOCKET', str(tmp_path / 'missing.sock'))
+    cache.save_devices(get_api_endpoint(), TEST_AUTH_TOKEN, fleet.devices)
+    target = fleet.devices[30]
+    assert device.get_device_uuid(target['uuid'][:12]) == target['uuid']
+
+
+def test_refresh_waits_for_other_process(fleet, tmp_path):
+    # If a wrapper process is already listing the fleet when the daemon refreshes, the daemon uses that process's result
+    # instead of listing the fleet again.
+    balena = FakeBalena(devices=fleet.devices)
+    resolver = daemon.ResolverDaemon(balena=balena, auth_token=TEST_AUTH_TOKEN,
+                                     socket_path=str(tmp_path / 'd.sock'), use_cache=True)
+    lock_path = cache.get_fetch_lock_path(resolver.endpoint, TEST_AUTH_TOKEN)
+    assert cache._try_acquire_fetch_lock(lock_path)
+
+    thread = threading.Thread(target=resolver.refresh)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    cache.save_devices(resolver.endpoint, TEST_AUTH_TOKEN, fleet.devices[:50])
+    os.unlink(lock_path)
+    thread.join(timeout=5.0)
+
+    assert not thread.is_alive()
+    assert len(resolver.index) == 50
+    assert balena.models.device.request_count == 0
+
+
+def test_refresh_removes_abandoned_lock(fleet, tmp_path):
+    # A lock left behind by a process that was killed while listing the fleet does not block the daemon.
+    owner = subprocess.Popen([sys.executable, '-c', 'pass'])
+    owner.wait()
+
+    resolver = daemon.ResolverDaemon(balena=FakeBalena(devices=fleet.devices), auth_token=TEST_AUTH_TOKEN,
+                                     socket_path=str(tmp_path / 'd.sock'), use_cache=True)
+    lock_path = cache.get_fetch_lock_path(resolver.endpoint, TEST_AUTH_TOKEN)
+    assert cache._try_acquire_fetch_lock(lock_path)
+    owner_info = cache.read_json(lock_path)
+    owner_info['pid'] = owner.pid
+    cache.atomic_write_json(lock_path, owner_info)
+
+    resolver.refresh()
+    assert len(resolver.index) == len(fleet.devices)
+    assert not os.path.exists(lock_path)
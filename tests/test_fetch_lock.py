@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from conftest import TEST_AUTH_TOKEN
+from fake_sdk import FakeBalena, generate_devices
+from point_one.balena import cache
+from point_one.balena.auth import get_api_endpoint
+
+NUM_DEVICES = 500
+
+# Resolve a query with an empty device cache using a fake SDK with a slow API, and print the result along with the
+# number of API requests made by this process.
+_WORKER_SCRIPT = """
+import json, sys
+from point_one.balena.device import get_device_uuids
+from fake_sdk import FakeBalena, generate_devices
+balena = FakeBalena(devices=generate_devices(int(sys.argv[1])), latency_sec=float(sys.argv[2]))
+results = get_device_uuids(sys.argv[3:], balena=balena, auth_token='%s')
+print(json.dumps({'statuses': [r.status for r in results], 'requests': balena.models.device.request_count}))
+""" % TEST_AUTH_TOKEN
+
+
+def _run_workers(num_processes, queries, latency_sec):
+    command = [sys.executable, '-c', _WORKER_SCRIPT, str(NUM_DEVICES), str(latency_sec)] + list(queries)
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE) for _ in range(num_processes)]
+    return [json.loads(process.communicate(timeout=60)[0]) for process in processes]
+
+
+def test_concurrent_processes_list_fleet_once():
+    # Several processes that all miss the cache at the same time share a single fleet listing.
+    devices = generate_devices(NUM_DEVICES)
+    queries = [devices[5]['device_name'], devices[123]['uuid'][:8]]
+    results = _run_workers(6, queries, latency_sec=1.0)
+
+    assert all(r['statuses'] == ['found', 'found'] for r in results)
+    assert sum(r['requests'] for r in results) == 1
+    assert len(cache.load_devices(get_api_endpoint(), TEST_AUTH_TOKEN)) == NUM_DEVICES
+
+
+def test_fetch_devices_waits_for_other_fetch():
+    endpoint = get_api_endpoint()
+    devices = generate_devices(50)
+    lock_path = cache.get_fetch_lock_path(endpoint, TEST_AUTH_TOKEN)
+    assert cache._try_acquire_fetch_lock(lock_path)
+
+    balena = FakeBalena(devices=devices)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        cache.fetch_devices(endpoint, TEST_AUTH_TOKEN, lambda: balena.models.device.get_all())))
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+
+    cache.save_devices(endpoint, TEST_AUTH_TOKEN, devices)
+    os.unlink(lock_path)
+    thread.join(timeout=5.0)
+
+    assert len(result[0]) == len(devices)
+    assert balena.models.device.request_count == 0
+
+
+def test_fetch_devices_takes_over_failed_fetch():
+    # If the process holding the lock exits without saving a device list (e.g., its request failed), a waiting process
+    # lists the fleet itself.
+    endpoint = get_api_endpoint()
+    devices = generate_devices(50)
+    lock_path = cache.get_fetch_lock_path(endpoint, TEST_AUTH_TOKEN)
+    assert cache._try_acquire_fetch_lock(lock_path)
+    threading.Timer(0.2, os.unlink, args=(lock_path,)).start()
+
+    balena = FakeBalena(devices=devices)
+    result = cache.fetch_devices(endpoint, TEST_AUTH_TOKEN, lambda: balena.models.device.get_all())
+    assert len(result) == len(devices)
+    assert balena.models.device.request_count == 1
+
+
+def test_wait_for_fetch_without_fetch():
+    assert cache.wait_for_fetch(get_api_endpoint(), TEST_AUTH_TOKEN) is None
@@ -0,0 +1,157 @@
+import pytest
+
+from fake_sdk import generate_devices
+from point_one.balena.index import AMBIGUOUS, FOUND, NOT_FOUND, Device, DeviceIndex
+
+DEVICES = [
+    ('0123456789abcdef0123456789abcdef', 'rover-1'),
+    ('0123456789abcdef0123456789abcde0', 'rover-10'),
+    ('abc123456789abcdef0123456789abcd', 'rover-2-lidar'),
+    ('fedcba9876543210fedcba9876543210', 'abc-bench'),
+    ('fedcba9876543210fedcba9876543211', 'bench-unit'),
+    ('22222222222222222222222222222222', 'duplicate'),
+    ('33333333333333333333333333333333', 'duplicate'),
+    # A device named after another device's UUID.
+    ('44444444444444444444444444444444', 'fedcba9876543210fedcba9876543210'),
+    # Older devices have 62-character UUIDs.
+    ('5' * 62, 'old-device'),
+]
+
+# A fleet large enough to exercise prefix lookups at every UUID length.
+FLEET = generate_devices(3000, seed=11)
+
+
+@pytest.fixture(scope='module')
+def index():
+    return DeviceIndex(DEVICES)
+
+
+def _names(devices):
+    return sorted(d.name for d in devices)
+
+
+def test_get_by_uuid(index):
+    assert index.get_by_uuid('abc123456789abcdef0123456789abcd').name == 'rover-2-lidar'
+    assert index.get_by_uuid('5' * 62).name == 'old-device'
+    assert index.get_by_uuid('abc123456789abcdef0123456789abce') is None
+    assert index.get_by_uuid('ABC123456789ABCDEF0123456789ABCD') is None
+
+
+def test_exact_uuid_before_exact_name(index):
+    # A full UUID resolves to that device, even if another device is named after it, unless the query is a name.
+    assert index.resolve('fedcba9876543210fedcba9876543210').name == 'abc-bench'
+    assert index.resolve('fedcba9876543210fedcba9876543210', is_name=True).uuid == '4' * 32
+
+
+def test_exact_name_before_prefix(index):
+    # rover-1 is also a prefix of rover-10, but an exact name match takes precedence.
+    device, devices_by_name, devices_by_uuid = index.find('rover-1')
+    assert (device.uuid, devices_by_name, devices_by_uuid) == ('0123456789abcdef0123456789abcdef', [], [])
+
+
+def test_duplicate_exact_names(index):
+    device, devices_by_name, devices_by_uuid = index.find('duplicate')
+    assert device is None
+    assert [d.uuid for d in devices_by_name] == ['2' * 32, '3' * 32]
+    assert index.resolve('duplicate') is None
+    assert index.match('duplicate').status == AMBIGUOUS
+
+
+def test_partial_name(index):
+    assert index.resolve('rover-2').name == 'rover-2-lidar'
+    assert index.resolve('rover-') is None
+    assert _names(index.find('rover-')[1]) == ['rover-1', 'rover-10', 'rover-2-lidar']
+
+
+def test_partial_uuid(index):
+    assert index.resolve('abc1').name == 'rover-2-lidar'
+    assert index.resolve('fedcba987654321', is_name=False) is None
+    assert index.resolve('0123456789abcdef0123456789abcde') is None
+    assert index.resolve('0123456789abcdef0123456789abcde0').name == 'rover-10'
+    assert index.resolve('5555').name == 'old-device'
+
+
+def test_partial_name_and_uuid(index):
+    # `abc` is both a name prefix (abc-bench) and a UUID prefix (rover-2-lidar).
+    device, devices_by_name, devices_by_uuid = index.find('abc')
+    assert device is None
+    assert (_names(devices_by_name), _names(devices_by_uuid)) == (['abc-bench'], ['rover-2-lidar'])
+    assert index.match('abc').status == AMBIGUOUS
+
+    assert index.resolve('abc', is_name=True).name == 'abc-bench'
+    assert index.resolve('abc', is_name=False).name == 'rover-2-lidar'
+
+
+def test_substring_search_only_without_prefix_matches(index):
+    # `bench` is a prefix of bench-unit, so the substring match in abc-bench is not considered.
+    assert index.resolve('bench').name == 'bench-unit'
+    assert index.resolve('lidar').name == 'rover-2-lidar'
+    assert index.resolve('unit').name == 'bench-unit'
+    assert index.resolve('lidar', is_name=False) is None
+
+
+def test_case_insensitive_match(index):
+    assert index.resolve('ROVER-1').name == 'rover-1'
+    assert index.resolve('Bench-Unit').name == 'bench-unit'
+
+
+def test_wildcard(index):
+    assert index.resolve('rover-*-lidar').name == 'rover-2-lidar'
+    assert _names(index.find('rover-?')[1]) == ['rover-1']
+
+
+def test_resolve_exact(index):
+    assert index.resolve_exact('rover-1').name == 'rover-1'
+    assert index.resolve_exact('0123456789abcdef0123456789abcde0').name == 'rover-10'
+    assert index.resolve_exact('fedcba9876543210fedcba9876543210', is_name=True).uuid == '4' * 32
+    assert index.resolve_exact('rover-10', is_name=False) is None
+    for query in ('rover-2', 'abc1', 'lidar', 'ROVER-1', 'rover-*-lidar', 'duplicate'):
+        assert index.resolve_exact(query) is None
+
+
+def test_match(index):
+    result = index.match('rover-2')
+    assert (result.query, result.status, result.uuid, result.name, result.candidates) == \
+        ('rover-2', FOUND, 'abc123456789abcdef0123456789abcd', 'rover-2-lidar', [])
+
+    result = index.match('rover-')
+    assert result.status == AMBIGUOUS
+    assert _names(result.candidates) == ['rover-1', 'rover-10', 'rover-2-lidar']
+
+    result = index.match('bench-unt')
+    assert result.status == NOT_FOUND
+    assert result.candidates[0].name == 'bench-unit'
+
+
+def test_match_check_exact_match():
+    index = DeviceIndex([('1' * 32, 'rover'), ('2' * 32, 'rover'), ('3' * 32, 'rover-2')])
+    assert index.match('rover').status == AMBIGUOUS
+    assert index.match('rover', check_exact_match=True).name == 'rover'
+
+
+@pytest.mark.parametrize('length', range(1, 33))
+def test_find_by_uuid_prefix(length):
+    # Odd-length prefixes end in the middle of a byte of the packed UUIDs, and must match the same devices as a string
+    # comparison.
+    index = DeviceIndex(FLEET)
+    for device in FLEET[:50]:
+        prefix = device['uuid'][:length]
+        expected = sorted(d['uuid'] for d in FLEET if d['uuid'].startswith(prefix))
+        assert sorted(d.uuid for d in index.find_by_uuid_prefix(prefix)) == expected
+
+
+def test_find_by_uuid_prefix_limit():
+    index = DeviceIndex(FLEET)
+    assert len(index.find_by_uuid_prefix('a')) > 10
+    assert len(index.find_by_uuid_prefix('a', limit=10)) == 10
+    assert len(index.find_by_uuid_prefix('ab', limit=3)) == 3
+
+
+def test_device_formats():
+    # SDK dicts, (uuid, name) pairs, and Device records produce the same index.
+    pairs = [(d['uuid'], d['device_name']) for d in FLEET[:20]]
+    for devices in (FLEET[:20], pairs, [Device(*p) for p in pairs]):
+        index = DeviceIndex(devices)
+        assert len(index) == 20
+        assert sorted((d.uuid, d.name) for d in index) == sorted(pairs)
+        assert index.get_by_uuid(pairs[3][0]).name == pairs[3][1]
@@ -0,0 +1,147 @@
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import REPO_DIR, TEST_AUTH_TOKEN
+from point_one.balena import cache, cli, pool
+from point_one.balena.auth import get_api_endpoint
+from point_one.balena.commands import find_device_name
+
+FAKE_CLI_PATH = os.path.join(REPO_DIR, 'tests', 'fake_cli.py')
+FAKE_SSH_PATH = os.path.join(REPO_DIR, 'tests', 'fake_ssh.py')
+CLI_PATH = os.path.join(REPO_DIR, 'point_one', 'balena', 'cli.py')
+
+UUID = '0123456789abcdef0123456789abcdef'
+
+
+class _EchoHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            self.wfile.write(line)
+
+
+@pytest.fixture
+def echo_server():
+    # Stands in for the device's SSH server, behind the fake Balena CLI's tunnel.
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _EchoHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch, echo_server):
+    monkeypatch.setenv('BALENA_WRAPPER_SSH', '%s %s' % (sys.executable, FAKE_SSH_PATH))
+    monkeypatch.setenv('FAKE_BALENA_TUNNEL_TARGET', '127.0.0.1:%d' % echo_server.server_address[1])
+    monkeypatch.setenv('FAKE_BALENA_LOG', str(tmp_path / 'cli.log'))
+    monkeypatch.setenv('FAKE_SSH_LOG', str(tmp_path / 'ssh.log'))
+    yield tmp_path
+    pool.stop_session(UUID)
+
+
+def _read_lines(path):
+    try:
+        with open(path) as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+
+def _count_tunnels(tmp_path):
+    return len([line for line in _read_lines(tmp_path / 'cli.log') if ' device tunnel %s ' % UUID in line])
+
+
+def test_connection_reused(fake_ssh):
+    args = ['device', 'ssh', UUID, '--', 'uptime']
+    first = cli._get_pooled_ssh_command(args, 2, FAKE_CLI_PATH)
+    assert first is not None
+    assert _count_tunnels(fake_ssh) == 1
+
+    # The second command uses the same tunnel and control master, without starting the Balena CLI again.
+    second = cli._get_pooled_ssh_command(args, 2, FAKE_CLI_PATH)
+    assert second == first
+    assert _count_tunnels(fake_ssh) == 1
+
+    output = subprocess.check_output(second, stdin=subprocess.DEVNULL).decode('utf-8')
+    assert output.strip() == 'ran: uptime'
+
+    sessions = pool.list_sessions()
+    assert [(s['uuid'], s['running']) for s in sessions] == [(UUID, True)]
+
+
+def test_stopped_connection_restarted(fake_ssh):
+    args = ['device', 'ssh', UUID, '--', 'uptime']
+    assert cli._get_pooled_ssh_command(args, 2, FAKE_CLI_PATH) is not None
+    assert pool.stop_session(UUID)
+    assert pool.get_session(UUID) is None
+
+    assert cli._get_pooled_ssh_command(args, 2, FAKE_CLI_PATH) is not None
+    assert _count_tunnels(fake_ssh) == 2
+
+
+def test_fallback_when_connection_fails(fake_ssh, monkeypatch, tmp_path):
+    # Nothing is listening behind the tunnel, so the control master cannot connect. The command falls back to the
+    # Balena CLI.
+    monkeypatch.setenv('FAKE_BALENA_TUNNEL_TARGET', '127.0.0.1:%d' % pool._find_free_port())
+    monkeypatch.setattr(pool, 'DEFAULT_START_TIMEOUT_SEC', 10.0)
+    assert cli._get_pooled_ssh_command(['device', 'ssh', UUID, '--', 'uptime'], 2, FAKE_CLI_PATH) is None
+    assert pool.get_session(UUID) is None
+    assert 'SSH connection to %s failed' % UUID in open(pool.get_log_path(UUID)).read()
+
+
+@pytest.mark.parametrize('args', [
+    ['device', 'ssh', UUID, 'main'],
+    ['device', 'ssh', UUID, 'main', '--', 'uptime'],
+    ['device', 'ssh', '--noproxy', UUID],
+    ['device', 'ssh', UUID, '--port', '22'],
+    ['logs', UUID],
+])
+def test_fallback_for_unsupported_commands(fake_ssh, args):
+    # Commands that a pooled connection cannot run (e.g., a shell in a service container) are passed to the Balena CLI,
+    # without starting a session.
+    id_index = find_device_name(args)
+    assert args[id_index] == UUID
+    assert cli._get_pooled_ssh_command(args, id_index, FAKE_CLI_PATH) is None
+    assert _count_tunnels(fake_ssh) == 0
+
+
+@pytest.mark.parametrize('args, expected', [
+    (['device', 'ssh', UUID], ([], [])),
+    (['device', 'ssh', '-t', UUID, '--', 'ls', '-l'], (['ls', '-l'], ['-t'])),
+    (['device', 'ssh', UUID, '--'], ([], [])),
+])
+def test_get_ssh_command(args, expected):
+    assert pool.get_ssh_command(args, find_device_name(args)) == expected
+
+
+@pytest.fixture
+def wrapper(fake_ssh, monkeypatch):
+    # Run the wrapper as a command, with the fake Balena CLI on the PATH and the device in the device cache.
+    bin_dir = fake_ssh / 'bin'
+    bin_dir.mkdir()
+    os.symlink(FAKE_CLI_PATH, str(bin_dir / 'balena'))
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    cache.save_devices(get_api_endpoint(), TEST_AUTH_TOKEN, [{'uuid': UUID, 'device_name': 'my-device'}])
+
+    def _run(*args):
+        return subprocess.check_output([sys.executable, CLI_PATH, '--quiet', '--pool'] + list(args),
+                                       stdin=subprocess.DEVNULL).decode('utf-8').strip()
+    return _run
+
+
+def test_wrapper_host_command(wrapper, fake_ssh):
+    assert wrapper('ssh', 'my-device', '--', 'uptime') == 'ran: uptime'
+    assert wrapper('device', 'ssh', 'my-device', '--', 'df', '-h') == 'ran: df -h'
+    assert _count_tunnels(fake_ssh) == 1
+
+
+def test_wrapper_service_shell(wrapper, fake_ssh):
+    # `balena device ssh DEVICE SERVICE` opens a shell in a container, which is left to the Balena CLI.
+    assert wrapper('ssh', 'my-device', 'main') == 'device ssh %s main' % UUID
+    assert _count_tunnels(fake_ssh) == 0
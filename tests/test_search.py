@@ -0,0 +1,59 @@
+import pytest
+
+from fake_sdk import generate_devices
+from point_one.balena.search import TrigramIndex, compile_name_matcher, is_wildcard
+
+DEVICES = generate_devices(2000, seed=7)
+
+
+@pytest.fixture(scope='module')
+def index():
+    return TrigramIndex(DEVICES)
+
+
+@pytest.mark.parametrize('query', [
+    'lidar', '0142', 'SF-01', 'ro', 'x',
+    'rover-*-lidar', 'rover-sf-01?2-*', '*-0042-*', '*gnss',
+    'rover-[ab]*', 'rover-[!c]*', '[r]over-s[fj]-00*', 'rover-[l-n]*-imu', '*[]]*', 'rover-[sn]*-cam', 'a[b',
+])
+def test_search_matches_name_matcher(index, query):
+    # search() must return exactly the devices accepted by compile_name_matcher(), which is used to filter device
+    # listings that are streamed instead of indexed.
+    matcher = compile_name_matcher(query)
+    expected = sorted(d['uuid'] for d in DEVICES if matcher(d['device_name']))
+    assert sorted(d['uuid'] for d in index.search(query)) == expected
+
+
+def test_search_character_classes(index):
+    assert len(index.search('rover-[ab]*')) > 0
+    assert len(index.search('rover-[!c]*')) == len(DEVICES)
+    assert all(d['device_name'].startswith('rover-s') for d in index.search('[r]over-s[!l]*'))
+
+
+def test_search_ranking(index):
+    results = index.search('sf-0042-lidar')
+    assert results[0]['device_name'] == 'rover-sf-0042-lidar'
+
+    # Matches at the start of a word rank above matches in the middle of one.
+    names = [d['device_name'] for d in TrigramIndex([{'uuid': '1', 'device_name': 'xcam'},
+                                                     {'uuid': '2', 'device_name': 'rover-cam'},
+                                                     {'uuid': '3', 'device_name': 'cam'}]).search('cam')]
+    assert names == ['cam', 'rover-cam', 'xcam']
+
+
+def test_search_limit(index):
+    assert len(index.search('rover', limit=5)) == 5
+
+
+def test_suggest(index):
+    names = [d['device_name'] for d in index.suggest('rover-sf-0042-lidr')]
+    assert names[0] == 'rover-sf-0042-lidar'
+    assert len(names) == len(set(names)) <= 5
+    assert index.suggest('zzzzzz') == []
+    assert index.suggest('ab') == []
+
+
+def test_is_wildcard():
+    assert is_wildcard('rover-*')
+    assert is_wildcard('rover-[ab]')
+    assert not is_wildcard('rover-sf')
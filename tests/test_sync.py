@@ -0,0 +1,120 @@
+from conftest import TEST_AUTH_TOKEN
+from fake_sdk import FakeBalena, FakeFleet
+from point_one.balena import cache, device
+from point_one.balena.auth import get_api_endpoint
+from point_one.balena.sync import DeviceSync, sync_devices
+
+PAGE_SIZE = 100
+
+
+def _expected(fleet):
+    return [(d['uuid'], d['device_name']) for d in sorted(fleet.devices, key=lambda d: d['id'])]
+
+
+def _synced_fleet(num_devices=500):
+    fleet = FakeFleet(num_devices=num_devices, seed=3)
+    balena = FakeBalena(devices=fleet.devices)
+    device_sync = DeviceSync(check_interval_sec=3600.0, page_size=PAGE_SIZE)
+    result = device_sync.sync(balena)
+    assert result.full
+    assert result.devices == _expected(fleet)
+    balena.models.device.request_count = 0
+    return fleet, balena, device_sync
+
+
+def test_sync_changes():
+    fleet, balena, device_sync = _synced_fleet()
+    renamed = fleet.rename(5)
+    added = fleet.add(3)
+
+    result = device_sync.sync(balena)
+    assert not result.full
+    assert result.devices == _expected(fleet)
+    assert result.num_changed == len(renamed) + len(added)
+    assert not result.checked_deletions
+
+    # Only the changed devices are listed, in a single page.
+    assert balena.models.device.request_count == 1
+
+
+def test_sync_same_device_renamed_twice():
+    fleet, balena, device_sync = _synced_fleet()
+    renamed = fleet.rename(1)[0]
+    device_sync.sync(balena)
+
+    index = next(i for i, d in enumerate(fleet.devices) if d['id'] == renamed['id'])
+    fleet.devices[index] = dict(fleet.devices[index], device_name='rover-replaced', modified_at=fleet._now())
+    result = device_sync.sync(balena)
+    assert result.devices == _expected(fleet)
+    assert (renamed['uuid'], 'rover-replaced') in result.devices
+
+
+def test_sync_deletions():
+    fleet, balena, device_sync = _synced_fleet()
+    removed = fleet.remove(4)
+    renamed = fleet.rename(2)
+
+    # Deleted devices are not visible in the list of changes, so they remain until the next deletion check.
+    result = device_sync.sync(balena, check_deletions=False)
+    assert len(result.devices) == len(fleet.devices) + len(removed)
+
+    result = device_sync.sync(balena, check_deletions=True)
+    assert result.checked_deletions
+    assert result.num_deleted == len(removed)
+    assert result.devices == _expected(fleet)
+    assert all((d['uuid'], d['device_name']) in result.devices for d in renamed)
+
+
+def test_sync_deletion_check_interval():
+    fleet, balena, device_sync = _synced_fleet()
+    device_sync.check_interval_sec = 0.0
+    fleet.remove(2)
+
+    result = device_sync.sync(balena)
+    assert result.checked_deletions
+    assert result.devices == _expected(fleet)
+
+
+def test_sync_unknown_devices_relists_fleet():
+    # If the server has devices the local copy has never seen (e.g., one was added with an old timestamp), the local
+    # copy has diverged, and the fleet is listed again.
+    fleet, balena, device_sync = _synced_fleet()
+    added = fleet.add(1)[0]
+    added['modified_at'] = '2000-01-01T00:00:00.000Z'
+
+    result = device_sync.sync(balena, check_deletions=True)
+    assert result.full
+    assert result.devices == _expected(fleet)
+
+
+def test_sync_state_shared_between_processes():
+    # The sync state is saved alongside the device cache, so a later process only lists the changes.
+    fleet = FakeFleet(num_devices=300, seed=4)
+    balena = FakeBalena(devices=fleet.devices)
+    assert sync_devices(balena, get_api_endpoint(), TEST_AUTH_TOKEN).full
+
+    fleet.rename(3)
+    fleet.remove(2)
+    fleet.add(2)
+    result = sync_devices(balena, get_api_endpoint(), TEST_AUTH_TOKEN, check_deletions=True)
+    assert not result.full
+    assert result.num_deleted == 2
+    assert result.devices == _expected(fleet)
+
+
+def test_refresh_device_cache():
+    fleet = FakeFleet(num_devices=300, seed=5)
+    balena = FakeBalena(devices=fleet.devices)
+    device.refresh_device_cache(balena=balena, auth_token=TEST_AUTH_TOKEN)
+
+    renamed = fleet.rename(1)[0]
+    removed = fleet.remove(1)[0]
+    device.refresh_device_cache(balena=balena, auth_token=TEST_AUTH_TOKEN)
+    cached = cache.load_devices(get_api_endpoint(), TEST_AUTH_TOKEN)
+    assert (renamed['uuid'], renamed['device_name']) in cached
+    assert len(cached) == len(fleet.devices) + 1
+
+    device.refresh_device_cache(balena=balena, auth_token=TEST_AUTH_TOKEN, full=True)
+    cached = cache.load_devices(get_api_endpoint(), TEST_AUTH_TOKEN)
+    assert removed['uuid'] not in [uuid for uuid, _ in cached]
+    assert sorted(cached) == sorted(_expected(fleet))
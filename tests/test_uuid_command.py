@@ -0,0 +1,106 @@
+import io
+import json
+
+import pytest
+
+from conftest import TEST_AUTH_TOKEN
+from fake_sdk import FakeBalena
+from point_one.balena import cache, cli, device
+from point_one.balena.auth import get_api_endpoint
+from point_one.balena.index import AMBIGUOUS, FOUND, NOT_FOUND, DeviceIndex
+
+DEVICES = [
+    {'id': 1, 'uuid': 'a1' * 16, 'device_name': 'rover-sf-0001-lidar'},
+    {'id': 2, 'uuid': 'a2' * 16, 'device_name': 'rover-sf-0001-lidar-old'},
+    {'id': 3, 'uuid': 'a3' * 16, 'device_name': 'rover-sf-0002-cam'},
+    {'id': 4, 'uuid': 'b4' * 16, 'device_name': 'bench-unit-07'},
+]
+
+
+@pytest.fixture
+def balena(monkeypatch):
+    # Answer live queries from a fake SDK, with the same devices in the device cache.
+    balena = FakeBalena(devices=DEVICES)
+    monkeypatch.setattr(device, 'authenticate', lambda auth_token=None: balena)
+    cache.save_devices(get_api_endpoint(), TEST_AUTH_TOKEN, DEVICES)
+    return balena
+
+
+def test_get_device_uuids():
+    queries = ['rover-sf-0002', 'b4b4', 'rover-sf-0001', 'rover-sf-0001-lidar', 'rover-la', 'rover-sf-0002']
+    results = device.get_device_uuids(queries, device_index=DeviceIndex(DEVICES))
+    assert [(r.query, r.status, r.uuid) for r in results] == [
+        ('rover-sf-0002', FOUND, 'a3' * 16),
+        ('b4b4', FOUND, 'b4' * 16),
+        ('rover-sf-0001', AMBIGUOUS, None),
+        ('rover-sf-0001-lidar', FOUND, 'a1' * 16),
+        ('rover-la', NOT_FOUND, None),
+        ('rover-sf-0002', FOUND, 'a3' * 16),
+    ]
+    assert [d.name for d in results[2].candidates] == ['rover-sf-0001-lidar', 'rover-sf-0001-lidar-old']
+
+
+def test_get_device_uuids_lists_fleet_once(balena):
+    # Queries resolved from the cache need no requests. Everything else is resolved with a single fleet listing.
+    results = device.get_device_uuids(['rover-sf-0002', 'bench'], use_daemon=False)
+    assert [r.status for r in results] == [FOUND, FOUND]
+    assert balena.models.device.request_count == 0
+
+    results = device.get_device_uuids(['rover-sf-0002', 'rover-sf-0001', 'unit-07', 'missing-1', 'missing-2'],
+                                      use_daemon=False)
+    assert [r.status for r in results] == [FOUND, AMBIGUOUS, FOUND, NOT_FOUND, NOT_FOUND]
+    assert balena.models.device.request_count == 1
+
+
+def _run(capsys, *args):
+    exit_code = cli._run_uuid_command(list(args), use_daemon=False)
+    return exit_code, capsys.readouterr().out
+
+
+def test_uuid_single(balena, capsys):
+    assert _run(capsys, 'rover-sf-0002') == (0, 'a3' * 16 + '\n')
+    assert _run(capsys, '--format', 'uuid', 'rover-sf-0002', 'bench') == (0, 'a3' * 16 + '\n' + 'b4' * 16 + '\n')
+
+
+def test_uuid_not_found(balena, capsys):
+    exit_code, output = _run(capsys, 'rover-sf-0001')
+    assert (exit_code, output) == (1, '')
+
+
+def test_uuid_tsv(balena, capsys):
+    exit_code, output = _run(capsys, 'rover-sf-0002', 'rover-sf-0001', 'missing')
+    assert exit_code == 1
+    assert output.splitlines() == [
+        'rover-sf-0002\tfound\t%s\trover-sf-0002-cam' % ('a3' * 16),
+        'rover-sf-0001\tambiguous\t\t',
+        'missing\tnot_found\t\t',
+    ]
+
+
+def test_uuid_json(balena, capsys):
+    exit_code, output = _run(capsys, '--format', 'json', 'bench', 'rover-sf-0001', 'rover-sf-0002-cma')
+    assert exit_code == 1
+    found, ambiguous, not_found = json.loads(output)
+    assert found == {'query': 'bench', 'status': 'found', 'uuid': 'b4' * 16, 'name': 'bench-unit-07', 'candidates': []}
+    assert ambiguous == {'query': 'rover-sf-0001', 'status': 'ambiguous', 'uuid': None, 'name': None,
+                         'candidates': [{'uuid': 'a1' * 16, 'name': 'rover-sf-0001-lidar'},
+                                        {'uuid': 'a2' * 16, 'name': 'rover-sf-0001-lidar-old'}]}
+
+    # Devices that were not found include similar device names.
+    assert (not_found['status'], not_found['uuid']) == ('not_found', None)
+    assert not_found['candidates'][0] == {'uuid': 'a3' * 16, 'name': 'rover-sf-0002-cam'}
+
+
+def test_uuid_jsonl(balena, capsys):
+    exit_code, output = _run(capsys, '--format', 'jsonl', 'bench', 'rover-sf-0002')
+    assert exit_code == 0
+    assert [(r['query'], r['uuid']) for r in map(json.loads, output.splitlines())] == [
+        ('bench', 'b4' * 16), ('rover-sf-0002', 'a3' * 16)]
+
+
+def test_uuid_stdin(balena, capsys, monkeypatch):
+    monkeypatch.setattr('sys.stdin', io.StringIO('bench\n\nrover-sf-0002\n'))
+    exit_code, output = _run(capsys, '-')
+    assert exit_code == 0
+    assert [line.split('\t')[:3] for line in output.splitlines()] == [
+        ['bench', 'found', 'b4' * 16], ['rover-sf-0002', 'found', 'a3' * 16]]